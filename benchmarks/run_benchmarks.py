@@ -0,0 +1,319 @@
+"""
+This script benchmarks the conversion, retrieval, comparison and plotting steps of the pipeline on synthetic data (see
+synthetic.py), so no FTP access is needed.  Results are saved as JSON, and can be compared against the results of an
+earlier commit with --baseline.  See README of this repository for an example of how to run this.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import pathlib
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+repo_dir = pathlib.Path(__file__).absolute().parent.parent
+sys.path.insert(0, str(repo_dir))
+
+from modules import agreement  # noqa: E402
+from modules import compare  # noqa: E402
+from modules import download as dwn  # noqa: E402
+from modules import regions  # noqa: E402
+from modules import summary  # noqa: E402
+from benchmarks import synthetic  # noqa: E402
+
+results_dir = os.path.join(repo_dir, "benchmarks", "results")
+
+# The thresholds swept by the area benchmarks - the defaults of the stats output in main.py
+SWEEP_LOWER = 0.1
+SWEEP_UPPER = 1.0
+SWEEP_INTERVAL = 0.05
+
+# The thresholds of the footprint benchmark
+FOOTPRINT_MIN = 0.15
+FOOTPRINT_MAX = 0.8
+
+
+def bench_cdr_to_np(ctx):
+    dwn.cdr_to_np(ctx.start, ctx.end, ctx.cdr_folder, clobber=True, hemisphere=ctx.hemisphere)
+    return len(ctx.days)
+
+
+def bench_nic_to_np(ctx):
+    # Drop the reprojected shapes cached by earlier runs, so every repeat reads and reprojects every shapefile
+    shutil.rmtree(os.path.join(ctx.nic_folder, dwn.GEOMETRY_CACHE_FOLDER), ignore_errors=True)
+    return bench_nic_to_np_cached(ctx)
+
+
+def bench_nic_to_np_cached(ctx):
+    # Rasterizes from the reprojected shapes cached by the last nic_to_np run (or this benchmark's first repeat)
+    dwn.nic_to_np(ctx.start, ctx.end, ctx.nic_folder, ctx.meta, ctx.lats.shape, clobber=True,
+                  hemisphere=ctx.hemisphere, n_jobs=ctx.jobs, pool=ctx.pool)
+    return len(ctx.days)
+
+
+def bench_get_cdr(ctx):
+    # Sum each grid so the data is actually read, not just mapped
+    for day in ctx.days:
+        np.asarray(dwn.get_cdr(day, ctx.cdr_folder, ctx.hemisphere)).sum()
+    return len(ctx.days)
+
+
+def bench_get_nic(ctx):
+    for day in ctx.days:
+        np.asarray(dwn.get_nic(day, ctx.nic_folder, ctx.hemisphere)).sum()
+    return len(ctx.days)
+
+
+def bench_calculate_ice_area(ctx):
+    for cdr_grid, nic_grid in ctx.grids:
+        for thresh in ctx.thresholds:
+            compare.calculate_ice_area(cdr_grid, nic_grid, thresh, SWEEP_UPPER, thresh, SWEEP_UPPER)
+    return len(ctx.grids) * len(ctx.thresholds)
+
+
+def bench_calculate_ice_areas(ctx):
+    for cdr_grid, nic_grid in ctx.grids:
+        compare.calculate_ice_areas(cdr_grid, nic_grid, ctx.thresholds, SWEEP_UPPER, ctx.thresholds, SWEEP_UPPER)
+    return len(ctx.grids) * len(ctx.thresholds)
+
+
+def bench_calculate_ice_area_range(ctx):
+    compare.calculate_ice_area_range(ctx.start, ctx.end, ctx.cdr_folder, ctx.nic_folder, ctx.hemisphere,
+                                     ctx.thresholds, SWEEP_UPPER, ctx.thresholds, SWEEP_UPPER)
+    return len(ctx.days) * len(ctx.thresholds)
+
+
+def bench_calculate_region_area_range(ctx):
+    names, labels = regions.region_labels(ctx.cdr_folder, ctx.hemisphere, ctx.lats, ctx.lons, ctx.meta)
+    regions.calculate_region_area_range(ctx.start, ctx.end, ctx.cdr_folder, ctx.nic_folder, ctx.hemisphere, labels,
+                                        len(names), ctx.thresholds, SWEEP_UPPER, ctx.thresholds, SWEEP_UPPER)
+    return len(ctx.days) * len(ctx.thresholds) * len(names)
+
+
+def bench_summary_ice_areas(ctx):
+    # The first run builds any missing histograms - later runs only read the summary
+    summary.calculate_ice_areas(ctx.days, ctx.cdr_folder, ctx.nic_folder, ctx.hemisphere, ctx.thresholds, SWEEP_UPPER,
+                                ctx.thresholds, SWEEP_UPPER)
+    return len(ctx.days) * len(ctx.thresholds)
+
+
+def bench_median_grid(ctx):
+    compare.median_cdr(FOOTPRINT_MAX, ctx.start, ctx.end, ctx.cdr_folder, ctx.hemisphere)
+    compare.median_nic(FOOTPRINT_MAX, ctx.start, ctx.end, ctx.nic_folder, ctx.hemisphere)
+    return 2 * len(ctx.days)
+
+
+def bench_calculate_ice_footprint_diff(ctx):
+    for cdr_grid, nic_grid in ctx.grids:
+        compare.calculate_ice_footprint_diff(nic_grid, FOOTPRINT_MIN, FOOTPRINT_MAX, cdr_grid, FOOTPRINT_MIN,
+                                             FOOTPRINT_MAX)
+    return len(ctx.grids)
+
+
+def bench_accumulate_agreement(ctx):
+    agreement.accumulate_agreement(ctx.start, ctx.end, ctx.cdr_folder, ctx.nic_folder, ctx.hemisphere, FOOTPRINT_MIN,
+                                   FOOTPRINT_MAX, FOOTPRINT_MIN, FOOTPRINT_MAX)
+    return len(ctx.days)
+
+
+def _plot_grids(cdr_grid, nic_grid):
+    return [{'grid': compare.threshold_mask(nic_grid, FOOTPRINT_MAX), 'color': 'magenta', 'legend_label': 'NIC Extent'},
+            {'grid': compare.threshold_mask(cdr_grid, FOOTPRINT_MAX), 'color': 'cyan', 'legend_label': 'CDR Extent'}]
+
+
+def bench_create_basemap_plot(ctx):
+    for day, (cdr_grid, nic_grid) in zip(ctx.plot_days, ctx.grids):
+        ctx.display.create_basemap_plot(f"{day:%Y-%m-%d}", ctx.lats, ctx.lons, ctx.meta,
+                                        _plot_grids(cdr_grid, nic_grid), show=False,
+                                        save=os.path.join(ctx.plot_folder, f"basemap_{day:%Y%m%d}.png"))
+    return len(ctx.plot_days)
+
+
+def bench_basemap_renderer(ctx):
+    renderer = ctx.display.BasemapRenderer(ctx.lats, ctx.lons, ctx.meta)
+    try:
+        for day, (cdr_grid, nic_grid) in zip(ctx.plot_days, ctx.grids):
+            renderer.plot(f"{day:%Y-%m-%d}", _plot_grids(cdr_grid, nic_grid), show=False,
+                          save=os.path.join(ctx.plot_folder, f"renderer_{day:%Y%m%d}.png"))
+    finally:
+        renderer.close()
+    return len(ctx.plot_days)
+
+
+# Benchmarks in the order they run - conversions first, since everything after them reads the converted grids
+BENCHMARKS = {
+    'cdr_to_np': bench_cdr_to_np,
+    'nic_to_np': bench_nic_to_np,
+    'nic_to_np_cached': bench_nic_to_np_cached,
+    'get_cdr': bench_get_cdr,
+    'get_nic': bench_get_nic,
+    'calculate_ice_area': bench_calculate_ice_area,
+    'calculate_ice_areas': bench_calculate_ice_areas,
+    'calculate_ice_area_range': bench_calculate_ice_area_range,
+    'calculate_region_area_range': bench_calculate_region_area_range,
+    'summary_ice_areas': bench_summary_ice_areas,
+    'median_grid': bench_median_grid,
+    'calculate_ice_footprint_diff': bench_calculate_ice_footprint_diff,
+    'accumulate_agreement': bench_accumulate_agreement,
+    'create_basemap_plot': bench_create_basemap_plot,
+    'basemap_renderer': bench_basemap_renderer,
+}
+PLOT_BENCHMARKS = ('create_basemap_plot', 'basemap_renderer')
+
+
+def time_benchmark(func, ctx, repeat):
+    """
+    Run a benchmark repeat times.
+    :param func: benchmark function - takes the context and returns the number of items it processed
+    :param ctx: argparse.Namespace - benchmark context
+    :param repeat: int - number of runs
+    :return: dict of timings
+    """
+    seconds = []
+    items = 0
+    for _ in range(repeat):
+        run_start = time.perf_counter()
+        items = func(ctx)
+        seconds.append(time.perf_counter() - run_start)
+    return {
+        'items': items,
+        'repeat': repeat,
+        'seconds': seconds,
+        'min': min(seconds),
+        'median': statistics.median(seconds),
+        'per_item': min(seconds) / items if items else None,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_dir, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(baseline, current):
+    """
+    Print how each benchmark changed from a baseline run.
+    :param baseline: dict - results JSON of the baseline run
+    :param current: dict - results JSON of this run
+    :return:
+    """
+    print(f"{'benchmark':<30}{'baseline (s)':>14}{'current (s)':>14}{'ratio':>8}")
+    for name, result in current['results'].items():
+        base = baseline['results'].get(name)
+        if 'min' not in result or not base or 'min' not in base:
+            continue
+        print(f"{name:<30}{base['min']:>14.4f}{result['min']:>14.4f}{result['min'] / base['min']:>8.2f}")
+
+
+def main():
+    """
+    Main function - see argparse help section below for more information.
+    """
+    datetime_format = "%Y%m%d"
+    parser = argparse.ArgumentParser(description='Benchmark the MIZ comparison pipeline on synthetic data.')
+    parser.add_argument('--start', type=lambda s: datetime.datetime.strptime(s, datetime_format),
+                        default=datetime.datetime(2020, 1, 1), help='First synthetic day.  Format YYYYmmdd.')
+    parser.add_argument('--days', type=int, default=30, help='The number of synthetic days.')
+    parser.add_argument('--hemisphere', choices=['north', 'south'], default='south', help='The hemisphere to model.')
+    parser.add_argument('--repeat', type=int, default=3, help='The number of runs of each benchmark.')
+    parser.add_argument('--plot-days', type=int, default=3, help='The number of days plotted by plot benchmarks.')
+    parser.add_argument('--jobs', type=int, default=-1, help='The number of workers used to rasterize NIC data.')
+    parser.add_argument('--pool', choices=['thread', 'process'], default='thread',
+                        help='Whether NIC rasterization workers are threads or processes.')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='Only run these benchmarks.')
+    parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'miz-benchmarks'),
+                        help='Folder for synthetic data and plots.  Data is reused between runs.')
+    parser.add_argument('--regenerate', action='store_true', help='Regenerate synthetic data that already exists.')
+    parser.add_argument('--output', help='Path of the results JSON.  Defaults to benchmarks/results/[commit].json.')
+    parser.add_argument('--baseline', help='Results JSON of an earlier run to compare against.')
+    args = parser.parse_args()
+
+    ctx = argparse.Namespace(hemisphere=args.hemisphere, jobs=args.jobs, pool=args.pool)
+    ctx.start = args.start
+    ctx.end = args.start + datetime.timedelta(days=args.days - 1)
+    ctx.days = pd.date_range(start=ctx.start, end=ctx.end)
+    ctx.cdr_folder = os.path.join(args.workdir, args.hemisphere, 'inputs', 'cdr')
+    ctx.nic_folder = os.path.join(args.workdir, args.hemisphere, 'inputs', 'nic')
+    ctx.plot_folder = os.path.join(args.workdir, args.hemisphere, 'outputs', 'png')
+    ctx.thresholds = np.arange(SWEEP_LOWER, SWEEP_UPPER, SWEEP_INTERVAL)
+
+    generate_start = time.perf_counter()
+    written = synthetic.generate(ctx.start, ctx.end, ctx.cdr_folder, ctx.nic_folder, hemisphere=args.hemisphere,
+                                 regenerate=args.regenerate)
+    print(f"Generated {written[0]} CDR and {written[1]} NIC files in {time.perf_counter() - generate_start:.1f}s")
+
+    ctx.lats, ctx.lons, ctx.meta = dwn.cdr_metadata(ctx.cdr_folder, args.hemisphere)
+
+    selected = args.only or list(BENCHMARKS)
+    results = {}
+    for name, func in BENCHMARKS.items():
+        if name not in selected:
+            continue
+
+        if name in PLOT_BENCHMARKS and not hasattr(ctx, 'display'):
+            try:
+                from modules import display
+            except ImportError as exc:
+                results[name] = {'skipped': f"plotting isn't available; {exc}"}
+                print(f"Skipping {name} because {exc}")
+                continue
+            display.use_agg_backend()
+            ctx.display = display
+
+        if not hasattr(ctx, 'grids') and name not in ('cdr_to_np', 'nic_to_np', 'nic_to_np_cached'):
+            # Benchmarks that compare grids use the same grids, loaded once, so they only time the comparison
+            ctx.grids = [(np.array(dwn.get_cdr(day, ctx.cdr_folder, args.hemisphere)),
+                          np.array(dwn.get_nic(day, ctx.nic_folder, args.hemisphere))) for day in ctx.days]
+        if name in PLOT_BENCHMARKS:
+            ctx.plot_days = ctx.days[:args.plot_days]
+
+        results[name] = time_benchmark(func, ctx, args.repeat)
+        per_item = results[name]['per_item']
+        print(f"{name:<30} {results[name]['min']:.4f}s best of {args.repeat}"
+              + (f", {per_item * 1e3:.3f} ms per item" if per_item else ""))
+
+    commit = _git_commit()
+    report = {
+        'commit': commit,
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'config': {
+            'start': f"{ctx.start:%Y%m%d}",
+            'days': args.days,
+            'hemisphere': args.hemisphere,
+            'repeat': args.repeat,
+            'plot_days': args.plot_days,
+            'jobs': args.jobs,
+            'pool': args.pool,
+            'thresholds': len(ctx.thresholds),
+        },
+        'results': results,
+    }
+
+    output = args.output or os.path.join(results_dir, f"{(commit or 'unknown')[:10]}_{args.hemisphere}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"Saved results to {output}")
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            compare_results(json.load(baseline_file), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+'''
+A module that generates synthetic CDR and NIC input files so the pipeline can be benchmarked without FTP access.
+
+CDR files are netCDFs with the seaice_conc_cdr, latitude, longitude and projection variables and attributes that the
+conversion and plotting code reads, on the real 25 km polar stereographic grids.  NIC files are zipped shapefiles of
+CT18 and CT81 polygons.  Both describe the same ragged ice edge that moves with the seasons, so the products roughly
+agree the way the real ones do.  Files are named with the download formatters so the pipeline finds them as if they had
+been downloaded.
+'''
+
+import os
+import zipfile
+
+import geopandas as gpd
+import netCDF4 as nc
+import numpy as np
+import pandas as pd
+import pyproj
+from shapely.geometry import Polygon
+
+from modules import download as dwn
+
+GRID_CELL_SIZE = 25000
+
+# The NSIDC polar stereographic grids the CDR is distributed on
+GRIDS = {
+    'south': {
+        'proj4text': '+proj=stere +lat_0=-90 +lat_ts=-70 +lon_0=0 +k=1 +x_0=0 +y_0=0 +a=6378273 +rf=298.279411123064 '
+                     '+units=m +no_defs',
+        'top': 4350000.0,
+        'bottom': -3950000.0,
+        'left': -3950000.0,
+        'right': 3950000.0,
+        'standard_parallel': -70.0,
+        'latitude_of_projection_origin': -90.0,
+        'longitude_of_projection_origin': 0.0,
+    },
+    'north': {
+        'proj4text': '+proj=stere +lat_0=90 +lat_ts=70 +lon_0=-45 +k=1 +x_0=0 +y_0=0 +a=6378273 +rf=298.279411123064 '
+                     '+units=m +no_defs',
+        'top': 5850000.0,
+        'bottom': -5350000.0,
+        'left': -3850000.0,
+        'right': 3750000.0,
+        'standard_parallel': 70.0,
+        'latitude_of_projection_origin': 90.0,
+        'longitude_of_projection_origin': -45.0,
+    },
+}
+
+# NIC shapefiles are written in a different (WGS84) polar stereographic projection so reading them reprojects
+NIC_CRS = {'south': 'EPSG:3031', 'north': 'EPSG:3413'}
+
+# The ice model, in projected meters - land out to LAND_RADIUS, pack ice out to the edge, and concentration falling to
+# zero over EDGE_WIDTH.  The edge moves by SEASONAL_AMPLITUDE over a year and is ragged around the pole.
+LAND_RADIUS = 1800000.0
+EDGE_RADIUS = 2900000.0
+EDGE_WIDTH = 350000.0
+SEASONAL_AMPLITUDE = 500000.0
+RAGGEDNESS = 120000.0
+
+# Ice codes with the concentration range each covers
+CT81_MIN_CONCENTRATION = 0.8
+CT18_MIN_CONCENTRATION = 0.1
+
+CDR_FILL = 255
+CDR_LAND_FLAG = 254
+
+
+def grid_shape(hemisphere):
+    """
+    Get the (y, x) shape of the CDR grid for a hemisphere.
+    :param hemisphere: string - 'south' or 'north'
+    :return: tuple of ints
+    """
+    grid = GRIDS[hemisphere]
+    return (int(round((grid['top'] - grid['bottom']) / GRID_CELL_SIZE)),
+            int(round((grid['right'] - grid['left']) / GRID_CELL_SIZE)))
+
+
+def _cell_centers(hemisphere):
+    """
+    Get the projected x and y of every cell center.
+    :return: (x, y) np arrays of the grid shape
+    """
+    grid = GRIDS[hemisphere]
+    rows, cols = grid_shape(hemisphere)
+    x_coord = grid['left'] + (np.arange(cols) + 0.5) * GRID_CELL_SIZE
+    y_coord = grid['top'] - (np.arange(rows) + 0.5) * GRID_CELL_SIZE
+    return np.meshgrid(x_coord, y_coord)
+
+
+def _edge_radius(date, theta, seed):
+    """
+    Get the ice edge radius for a day at angles theta around the pole.
+    :param date: datetime - day
+    :param theta: np array - angles in radians
+    :param seed: int - seed of the ragged edge
+    :return: np array of radii in projected meters
+    """
+    season = np.sin(2 * np.pi * (pd.Timestamp(date).dayofyear / 365.25))
+    rng = np.random.default_rng(seed)
+    phases = rng.uniform(0, 2 * np.pi, 6)
+    wobble = sum(np.sin((k + 2) * theta + phases[k] + 0.05 * pd.Timestamp(date).dayofyear) / (k + 1)
+                 for k in range(len(phases)))
+    return EDGE_RADIUS + SEASONAL_AMPLITUDE * season + RAGGEDNESS * wobble
+
+
+def cdr_concentration(date, hemisphere, seed=0):
+    """
+    Model a day's CDR sea ice concentration.
+    :param date: datetime - day
+    :param hemisphere: string - 'south' or 'north'
+    :param seed: int - random seed
+    :return: np uint8 array of percent codes, with CDR_LAND_FLAG over land
+    """
+    x_coord, y_coord = _cell_centers(hemisphere)
+    radius = np.hypot(x_coord, y_coord)
+    edge = _edge_radius(date, np.arctan2(y_coord, x_coord), seed)
+
+    concentration = np.clip((edge - radius) / EDGE_WIDTH, 0, 1)
+    noise = np.random.default_rng(seed + pd.Timestamp(date).toordinal()).normal(0, 0.03, concentration.shape)
+    concentration = np.where(concentration > 0, np.clip(concentration + noise, 0, 1), 0)
+
+    codes = np.rint(concentration * 100).astype(np.uint8)
+    codes[radius < LAND_RADIUS] = CDR_LAND_FLAG
+    return codes
+
+
+def write_cdr_file(date, folder, hemisphere, seed=0):
+    """
+    Write a day's synthetic CDR netCDF.
+    :param date: datetime - day
+    :param folder: string - CDR input folder
+    :param hemisphere: string - 'south' or 'north'
+    :param seed: int - random seed
+    :return: string - path of the file written
+    """
+    grid = GRIDS[hemisphere]
+    rows, cols = grid_shape(hemisphere)
+    _, file_name = dwn.datetime_to_cdr_fname(date, hemisphere)
+    path = os.path.join(folder, file_name)
+
+    x_coord, y_coord = _cell_centers(hemisphere)
+    to_lonlat = pyproj.Transformer.from_crs(grid['proj4text'], 'EPSG:4326', always_xy=True)
+    lons, lats = to_lonlat.transform(x_coord, y_coord)
+
+    with nc.Dataset(path, 'w') as cdr_file:
+        cdr_file.createDimension('time', 1)
+        cdr_file.createDimension('y', rows)
+        cdr_file.createDimension('x', cols)
+
+        concentration = cdr_file.createVariable('seaice_conc_cdr', 'u1', ('time', 'y', 'x'), fill_value=CDR_FILL,
+                                                zlib=True)
+        concentration.scale_factor = 0.01
+        concentration.add_offset = 0.0
+        concentration.valid_range = np.array([0, 100], dtype=np.uint8)
+        concentration.flag_values = np.array([251, 252, 253, 254, 255], dtype=np.uint8)
+        concentration[0] = cdr_concentration(date, hemisphere, seed)
+
+        latitude = cdr_file.createVariable('latitude', 'f8', ('y', 'x'), zlib=True)
+        latitude[:] = lats
+        longitude = cdr_file.createVariable('longitude', 'f8', ('y', 'x'), zlib=True)
+        longitude[:] = lons
+
+        projection = cdr_file.createVariable('projection', 'S1')
+        projection.proj4text = grid['proj4text']
+        projection.GeoTransform = f"{grid['left']:.0f} {GRID_CELL_SIZE} 0 {grid['top']:.0f} 0 -{GRID_CELL_SIZE}"
+        projection.grid_boundary_top_projected_y = grid['top']
+        projection.grid_boundary_bottom_projected_y = grid['bottom']
+        projection.grid_boundary_left_projected_x = grid['left']
+        projection.grid_boundary_right_projected_x = grid['right']
+        projection.standard_parallel = grid['standard_parallel']
+        projection.latitude_of_projection_origin = grid['latitude_of_projection_origin']
+        projection.longitude_of_projection_origin = grid['longitude_of_projection_origin']
+
+    return path
+
+
+def _sector(theta_start, theta_end, inner, outer, vertices):
+    """
+    Build a polygon between two radii (arrays along the arc) from theta_start to theta_end.
+    """
+    theta = np.linspace(theta_start, theta_end, vertices)
+    outer_ring = np.column_stack([outer * np.cos(theta), outer * np.sin(theta)])
+    inner_ring = np.column_stack([inner[::-1] * np.cos(theta[::-1]), inner[::-1] * np.sin(theta[::-1])])
+    return Polygon(np.concatenate([outer_ring, inner_ring]))
+
+
+def nic_polygons(date, hemisphere, seed=0, sectors=36, vertices=200):
+    """
+    Model a day's NIC ice polygons - CT81 sectors out to the 80% line and CT18 sectors from there to the 10% line.
+    :param date: datetime - day
+    :param hemisphere: string - 'south' or 'north'
+    :param seed: int - random seed
+    :param sectors: int - number of sectors around the pole for each ice code
+    :param vertices: int - vertices along each arc of a sector
+    :return: GeoDataFrame in the CDR projection with an ICECODE column
+    """
+    edges = np.linspace(-np.pi, np.pi, sectors + 1)
+    geometries = []
+    icecodes = []
+    for theta_start, theta_end in zip(edges[:-1], edges[1:]):
+        theta = np.linspace(theta_start, theta_end, vertices)
+        edge = _edge_radius(date, theta, seed)
+        pack_edge = edge - EDGE_WIDTH * CT81_MIN_CONCENTRATION
+        outer_edge = edge - EDGE_WIDTH * CT18_MIN_CONCENTRATION
+        land = np.full(vertices, LAND_RADIUS)
+
+        geometries.append(_sector(theta_start, theta_end, land, pack_edge, vertices))
+        icecodes.append('CT81')
+        geometries.append(_sector(theta_start, theta_end, pack_edge, outer_edge, vertices))
+        icecodes.append('CT18')
+
+    return gpd.GeoDataFrame({'ICECODE': icecodes}, geometry=geometries, crs=GRIDS[hemisphere]['proj4text'])
+
+
+def write_nic_file(date, folder, hemisphere, seed=0, sectors=36, vertices=200):
+    """
+    Write a day's synthetic NIC zipped shapefile.
+    :param date: datetime - day
+    :param folder: string - NIC input folder
+    :param hemisphere: string - 'south' or 'north'
+    :param seed: int - random seed
+    :param sectors: int - number of sectors around the pole for each ice code
+    :param vertices: int - vertices along each arc of a sector
+    :return: string - path of the file written
+    """
+    _, file_name = dwn.datetime_to_nic_fname(date, hemisphere)
+    path = os.path.join(folder, file_name)
+    shapefile_folder = path + '.shp.tmp'
+    layer = os.path.splitext(file_name)[0]
+
+    gdf = nic_polygons(date, hemisphere, seed, sectors, vertices).to_crs(NIC_CRS[hemisphere])
+    os.makedirs(shapefile_folder, exist_ok=True)
+    gdf.to_file(os.path.join(shapefile_folder, layer + '.shp'), driver='ESRI Shapefile')
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zipped:
+        for name in sorted(os.listdir(shapefile_folder)):
+            zipped.write(os.path.join(shapefile_folder, name), name)
+            os.remove(os.path.join(shapefile_folder, name))
+    os.rmdir(shapefile_folder)
+
+    return path
+
+
+def generate(start, end, cdr_folder, nic_folder, hemisphere='south', seed=0, regenerate=False, vertices=200):
+    """
+    Write synthetic CDR and NIC input files for every day from start to end (inclusive).
+    :param start: datetime - first day
+    :param end: datetime - last day
+    :param cdr_folder: string - CDR input folder
+    :param nic_folder: string - NIC input folder
+    :param hemisphere: string - 'south' or 'north'
+    :param seed: int - random seed
+    :param regenerate: bool - overwrite files that already exist
+    :param vertices: int - vertices along each arc of an NIC polygon
+    :return: (number of CDR files written, number of NIC files written)
+    """
+    os.makedirs(cdr_folder, exist_ok=True)
+    os.makedirs(nic_folder, exist_ok=True)
+
+    written = [0, 0]
+    for date in pd.date_range(start=start, end=end):
+        if regenerate or not os.path.exists(os.path.join(cdr_folder, dwn.datetime_to_cdr_fname(date, hemisphere)[1])):
+            write_cdr_file(date, cdr_folder, hemisphere, seed)
+            written[0] += 1
+        if regenerate or not os.path.exists(os.path.join(nic_folder, dwn.datetime_to_nic_fname(date, hemisphere)[1])):
+            write_nic_file(date, nic_folder, hemisphere, seed, vertices=vertices)
+            written[1] += 1
+    return tuple(written)
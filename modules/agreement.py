@@ -0,0 +1,117 @@
+'''
+A module that accumulates where the NIC and CDR ice footprints agree over time.
+
+Each day, every pixel is in one of four footprint classes - ice in neither product, CDR only, NIC only or both (see
+compare.footprint_classes).  Days are streamed one at a time: the pixels in each class are counted with a single bincount
+per day, and the days each pixel spent in each class are summed in place with a single indexed add, so a whole season
+costs one pass over the grids and only a few grids of memory however many days it spans.
+'''
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from . import compare
+from . import download as dwn
+from . import instrument
+
+CLASS_COUNT = len(compare.FOOTPRINT_CLASSES)
+
+
+def accumulate_agreement(start, end, cdr_folder, nic_folder, hemisphere, min_cdr, max_cdr, min_nic, max_nic,
+                         verbose=False):
+    """
+    Count the pixels in each footprint class for every day from start to end (inclusive) that has both grids, and the
+    number of those days each pixel spent in each class.
+    :param start: datetime - first day
+    :param end: datetime - last day
+    :param cdr_folder: string - folder holding the CDR grids
+    :param nic_folder: string - folder holding the NIC grids
+    :param hemisphere: string - 'south' or 'north'
+    :param min_cdr: float - min cdr threshold
+    :param max_cdr: float - max cdr threshold
+    :param min_nic: float - min nic threshold
+    :param max_nic: float - max nic threshold
+    :param verbose: bool - increase verbosity
+    :return: (
+        pandas DatetimeIndex of the days compared,
+        np int array (days, classes) of pixels in each class on each day,
+        np uint32 array (classes, y, x) of the days each pixel was in each class
+    ) - classes are ordered as compare.FOOTPRINT_CLASSES
+    """
+    dates = pd.date_range(start=start, end=end)
+    compared = dates.intersection(dwn.available_cdr_dates(start, end, cdr_folder, hemisphere)).intersection(
+        dwn.available_nic_dates(start, end, nic_folder, hemisphere))
+
+    if verbose:
+        print(f"Comparing footprints on {len(compared)} of {len(dates)} days")
+
+    if compared.empty:
+        raise ValueError(f"No days with both cdr and nic grids between {dates[0]:%Y%m%d} and {dates[-1]:%Y%m%d}")
+
+    day_counts = np.zeros((len(compared), CLASS_COUNT), dtype=np.int64)
+    pixel_days = None
+    pixel_offsets = None
+
+    for idx, day in enumerate(compared):
+        with instrument.day_timer('footprint agreement', day):
+            classes = compare.footprint_classes(dwn.get_nic(day, nic_folder, hemisphere), min_nic, max_nic,
+                                                dwn.get_cdr(day, cdr_folder, hemisphere), min_cdr, max_cdr)
+            day_counts[idx] = np.bincount(classes.ravel(), minlength=CLASS_COUNT)
+
+            if pixel_days is None:
+                pixel_days = np.zeros((CLASS_COUNT,) + classes.shape, dtype=np.uint32)
+                pixel_offsets = np.arange(classes.size)
+
+            # Each pixel adds one day to its own class's slot in the flattened sums, so no slot is hit twice and a
+            # single indexed add counts every class
+            pixel_days.reshape(-1)[classes.ravel().astype(np.intp) * classes.size + pixel_offsets] += 1
+        instrument.count('footprint days compared')
+
+    return compared, day_counts, pixel_days
+
+
+def agreement_table(dates, day_counts):
+    """
+    Turn daily class counts into a table of the area in each footprint class and the agreement of the two footprints
+    (the area in both over the area in either), NaN on days neither product has ice.
+    :param dates: pandas DatetimeIndex of the days compared
+    :param day_counts: np int array (days, classes) from accumulate_agreement
+    :return: pandas DataFrame indexed by date
+    """
+    table = pd.DataFrame(day_counts * compare.GRID_CELL_AREA, index=dates,
+                         columns=[f'{name} area' for name in compare.FOOTPRINT_CLASSES])
+    either = day_counts[:, compare.FOOTPRINT_NEITHER + 1:].sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        table['agreement'] = day_counts[:, compare.FOOTPRINT_BOTH] / either
+    return table
+
+
+def class_frequency(pixel_days, footprint_class):
+    """
+    Get the fraction of the days compared that each pixel was in a footprint class.
+    :param pixel_days: np array (classes, y, x) from accumulate_agreement
+    :param footprint_class: int - eg compare.FOOTPRINT_NIC_ONLY
+    :return: np float32 array (y, x)
+    """
+    days = pixel_days.sum(axis=0, dtype=np.int64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (pixel_days[footprint_class] / days).astype(np.float32)
+
+
+def save_agreement(path, dates, day_counts, pixel_days):
+    """
+    Export accumulated agreement to an npz file.
+    :param path: string - output path
+    :param dates: pandas DatetimeIndex of the days compared
+    :param day_counts: np int array (days, classes) from accumulate_agreement
+    :param pixel_days: np array (classes, y, x) from accumulate_agreement
+    :return:
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savez_compressed(path,
+                        dates=dates.strftime('%Y%m%d').values,
+                        classes=np.array(compare.FOOTPRINT_CLASSES),
+                        day_counts=day_counts,
+                        pixel_days=pixel_days)
@@ -0,0 +1,141 @@
+'''
+A module that stores the daily sea ice area statistics in a long, columnar layout and reads them back filtered.
+
+The wide stats csv has a NIC and a CDR column per threshold.  Here every area is its own row - date, product, lower
+and upper bound of the sea ice concentration and area - saved as Parquet or Feather (uncompressed Arrow IPC, so it can
+be memory mapped).  Rows are sorted by date and written in row groups of ROW_GROUP_DAYS days, so reading a date range
+only touches the row groups that overlap it, and reading a few columns or thresholds never parses the rest of the file.
+'''
+
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+
+from . import compare
+
+COLUMNS = ('date', 'product', 'lower', 'upper', 'area', 'error')
+
+# The file formats supported, keyed by file extension
+FORMATS = {'.parquet': 'parquet', '.feather': 'feather'}
+
+# Days per row group - date range reads skip the row groups outside of the range
+ROW_GROUP_DAYS = 365
+
+# Bounds are rounded so they can be matched exactly when filtering, eg 0.15 rather than 0.15000000000000002
+BOUND_DECIMALS = 4
+
+
+def _format(path):
+    """
+    Get the format of a stats file from its extension.
+    """
+    extension = os.path.splitext(path)[1]
+    if extension not in FORMATS:
+        raise ValueError(f"Unsupported stats file {path} - must be one of {', '.join(FORMATS)}")
+    return FORMATS[extension]
+
+
+def long_table(stats_df, threshold_range, upper_threshold):
+    """
+    Convert the wide stats table to one row per day, product and threshold.
+    :param stats_df: pandas DataFrame indexed by day with a NIC and a CDR area column per threshold, in
+        threshold_range order, and an 'error' column - see main.create_stats
+    :param threshold_range: np array - lower thresholds
+    :param upper_threshold: float - upper threshold shared by all lower thresholds
+    :return: pandas DataFrame with COLUMNS, sorted by date
+    """
+    stats_df = stats_df.sort_index()
+    day_count = len(stats_df)
+    # (days, thresholds, products) in compare.AREA_PRODUCTS order, matching the column pairs of the wide table
+    day_areas = stats_df.drop(columns='error').to_numpy(dtype=float).reshape(day_count, len(threshold_range),
+                                                                             len(compare.AREA_PRODUCTS))
+    rows_per_day = day_areas[0].size if day_count else 0
+    return pd.DataFrame({
+        'date': np.repeat(stats_df.index.values, rows_per_day),
+        'product': np.tile(np.array(compare.AREA_PRODUCTS), day_count * len(threshold_range)),
+        'lower': np.tile(np.repeat(np.round(threshold_range, BOUND_DECIMALS), len(compare.AREA_PRODUCTS)), day_count),
+        'upper': round(upper_threshold, BOUND_DECIMALS),
+        'area': day_areas.reshape(-1),
+        'error': np.repeat(stats_df['error'].to_numpy(dtype=object), rows_per_day),
+    }, columns=list(COLUMNS))
+
+
+def write_stats(path, long_df):
+    """
+    Write a long stats table to a Parquet or Feather file, replacing it in one step.
+    :param path: string - .parquet or .feather file to write
+    :param long_df: pandas DataFrame - see long_table
+    :return:
+    """
+    file_format = _format(path)
+    long_df = long_df.sort_values('date', kind='stable').reset_index(drop=True)
+    rows_per_day = max(len(long_df) // max(long_df['date'].nunique(), 1), 1)
+    row_group_rows = ROW_GROUP_DAYS * rows_per_day
+
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    if file_format == 'parquet':
+        long_df.to_parquet(tmp_path, index=False, row_group_size=row_group_rows)
+    else:
+        long_df.to_feather(tmp_path, chunksize=row_group_rows, compression='uncompressed')
+    os.replace(tmp_path, path)
+
+
+def merge_stats(path, long_df):
+    """
+    Add days to a stats file, replacing any of them it already holds.
+    :param path: string - .parquet or .feather file
+    :param long_df: pandas DataFrame - see long_table
+    :return:
+    """
+    if os.path.exists(path):
+        saved_df = read_stats(path)
+        long_df = pd.concat([saved_df[~saved_df['date'].isin(long_df['date'])], long_df], ignore_index=True)
+    write_stats(path, long_df)
+
+
+def read_stats(path, start=None, end=None, products=None, thresholds=None, regions=None, columns=None):
+    """
+    Read the rows of a stats file matching the filters, without reading the rest of the file.
+    :param path: string - .parquet or .feather file
+    :param start: datetime - first day to read.  From the first day in the file if None.
+    :param end: datetime - last day to read (inclusive).  Through the last day in the file if None.
+    :param products: iterable of strings - products to read, eg ['cdr'].  All products if None.
+    :param thresholds: iterable of floats - lower bounds to read, eg [0.15, 0.8].  All thresholds if None.
+    :param regions: iterable of strings - specific to regional stats files (see the regions module), regions to read,
+        eg ['Ross Sea'].  All regions if None.
+    :param columns: iterable of strings - columns to read, from COLUMNS.  All columns if None.
+    :return: pandas DataFrame sorted by date
+    """
+    conditions = []
+    if start is not None:
+        conditions.append(ds.field('date') >= pd.Timestamp(start).to_pydatetime())
+    if end is not None:
+        conditions.append(ds.field('date') <= pd.Timestamp(end).to_pydatetime())
+    if products is not None:
+        conditions.append(ds.field('product').isin(list(products)))
+    if thresholds is not None:
+        conditions.append(ds.field('lower').isin(np.round(np.asarray(list(thresholds), dtype=float),
+                                                          BOUND_DECIMALS).tolist()))
+    if regions is not None:
+        conditions.append(ds.field('region').isin(list(regions)))
+
+    row_filter = None
+    for condition in conditions:
+        row_filter = condition if row_filter is None else row_filter & condition
+
+    dataset = ds.dataset(path, format=_format(path))
+    table = dataset.to_table(columns=list(columns) if columns is not None else None, filter=row_filter)
+    return table.to_pandas()
+
+
+def wide_table(long_df):
+    """
+    Pivot long stats rows back to one row per day with an area column per product and lower bound, eg to plot the
+    areas over time.
+    :param long_df: pandas DataFrame - see read_stats
+    :return: pandas DataFrame indexed by date with (product, lower) columns
+    """
+    return long_df.pivot_table(index='date', columns=['product', 'lower'], values='area', aggfunc='first',
+                               dropna=False)
@@ -0,0 +1,229 @@
+'''
+A module that keeps a persistent index of which days are available locally for a product and hemisphere.
+
+The index holds two bitmaps over a contiguous range of days - whether the raw downloaded file exists and whether a
+converted grid exists (in the grid cube or as a per-day .npy file).  It is built from a single listing of the product
+folder, saved next to the data, and only rebuilt when the folder or the grid cube's header changes.  Loops can then
+iterate over available days and report gaps up front instead of trying to load every day.
+'''
+
+import datetime
+import os
+import re
+import threading
+
+import numpy as np
+import pandas as pd
+
+from . import cube
+from . import instrument
+
+# Indexes are kept in a subfolder so saving one doesn't change the modification time of the folder it indexes
+INDEX_FOLDER = '.availability'
+INDEX_FNAME_FMT = '{hemisphere}_{product}_availability.npz'
+GRID_FNAME_PATTERN = r'^(\d{{8}})_{hemisphere}_{product}\.npy$'
+
+# Indexes loaded by this process, keyed by (folder, product, hemisphere) - see load_index
+_LOADED_INDEXES = {}
+_LOADED_INDEXES_LOCK = threading.Lock()
+
+
+class AvailabilityIndex:
+    """
+    Raw file and grid availability bitmaps for one product and hemisphere, starting at the start date.
+    """
+
+    def __init__(self, start, raw, grid, folder_mtime, cube_stamp=None):
+        """
+        :param start: datetime.date - date of the first bit, or None for an empty index
+        :param raw: np bool array - True where the raw downloaded file exists
+        :param grid: np bool array - True where a converted grid exists.  Same length as raw.
+        :param folder_mtime: int - modification time (ns) of the folder the index was built from
+        :param cube_stamp: tuple of ints - see _cube_stamp - of the grid cube header the index was built from
+        """
+        self.start = start
+        self.raw = raw
+        self.grid = grid
+        self.folder_mtime = folder_mtime
+        self.cube_stamp = cube_stamp
+
+    def is_current(self, folder_mtime, cube_stamp):
+        """
+        True if neither the folder nor the grid cube's header changed since the index was built.
+        """
+        return self.folder_mtime == folder_mtime and self.cube_stamp == cube_stamp
+
+    def _bits(self, kind, start, end):
+        """
+        Get the bitmap for every day from start to end, with days outside of the index as False.
+        """
+        dates = pd.date_range(start=start, end=end)
+        bits = np.zeros(len(dates), dtype=bool)
+        if self.start is None or dates.empty:
+            return dates, bits
+        offsets = (dates.date - self.start).astype('timedelta64[D]').astype(np.int64)
+        inside = (offsets >= 0) & (offsets < len(self.raw))
+        bits[inside] = getattr(self, kind)[offsets[inside]]
+        return dates, bits
+
+    def dates(self, start, end, kind='grid'):
+        """
+        Get the days from start to end (inclusive) that are available.
+        :param start: datetime - first day
+        :param end: datetime - last day
+        :param kind: string - 'grid' for converted grids or 'raw' for downloaded files
+        :return: pandas DatetimeIndex
+        """
+        dates, bits = self._bits(kind, start, end)
+        return dates[bits]
+
+    def gaps(self, start, end, kind='grid'):
+        """
+        Get the days from start to end (inclusive) that are not available.
+        :param start: datetime - first day
+        :param end: datetime - last day
+        :param kind: string - 'grid' for converted grids or 'raw' for downloaded files
+        :return: pandas DatetimeIndex
+        """
+        dates, bits = self._bits(kind, start, end)
+        return dates[~bits]
+
+
+def _index_path(folder, product, hemisphere):
+    return os.path.join(folder, INDEX_FOLDER, INDEX_FNAME_FMT.format(hemisphere=hemisphere, product=product))
+
+
+def _cube_stamp(folder, product, hemisphere):
+    """
+    Identify the current version of a grid cube's header by its modification time, size and inode.  The header is
+    replaced whenever grids are added (see GridCube.refresh), which only changes the folder's modification time if
+    it lands on a new timestamp tick, so the index is keyed on both.
+    :return: tuple of ints - (0, 0, 0) if there is no cube
+    """
+    try:
+        header_stat = os.stat(os.path.join(folder, cube.HEADER_FNAME_FMT.format(hemisphere=hemisphere,
+                                                                                product=product)))
+    except FileNotFoundError:
+        return 0, 0, 0
+    return header_stat.st_mtime_ns, header_stat.st_size, header_stat.st_ino
+
+
+def build_index(folder, product, hemisphere, raw_date_func):
+    """
+    Build the availability index from one listing of the product folder and the grid cube's header.
+    :param folder: string - product input folder
+    :param product: string - 'cdr' or 'nic'
+    :param hemisphere: string - 'south' or 'north'
+    :param raw_date_func: Function returning the date of a raw file name for the hemisphere, or None if the name isn't
+     one of the product's raw files
+    :return: AvailabilityIndex
+    """
+    folder_mtime = os.stat(folder).st_mtime_ns
+    cube_stamp = _cube_stamp(folder, product, hemisphere)
+    grid_pattern = re.compile(GRID_FNAME_PATTERN.format(hemisphere=hemisphere, product=product))
+
+    raw_dates = []
+    grid_dates = []
+    for name in os.listdir(folder):
+        grid_match = grid_pattern.match(name)
+        if grid_match:
+            grid_dates.append(datetime.datetime.strptime(grid_match.group(1), '%Y%m%d').date())
+            continue
+        raw_date = raw_date_func(name, hemisphere)
+        if raw_date is not None:
+            raw_dates.append(raw_date)
+
+    grid_cube = cube.GridCube(folder, product, hemisphere)
+    grid_dates.extend(grid_cube.dates.date)
+
+    if not raw_dates and not grid_dates:
+        return AvailabilityIndex(None, np.zeros(0, dtype=bool), np.zeros(0, dtype=bool), folder_mtime, cube_stamp)
+
+    start = min(raw_dates + grid_dates)
+    days = (max(raw_dates + grid_dates) - start).days + 1
+    raw = np.zeros(days, dtype=bool)
+    grid = np.zeros(days, dtype=bool)
+    raw[[(date - start).days for date in raw_dates]] = True
+    grid[[(date - start).days for date in grid_dates]] = True
+
+    return AvailabilityIndex(start, raw, grid, folder_mtime, cube_stamp)
+
+
+def save_index(index, folder, product, hemisphere):
+    """
+    Save an availability index in the product folder, with the bitmaps bit-packed.
+    :param index: AvailabilityIndex
+    :param folder: string - product input folder
+    :param product: string - 'cdr' or 'nic'
+    :param hemisphere: string - 'south' or 'north'
+    :return:
+    """
+    path = _index_path(folder, product, hemisphere)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path,
+             start=index.start.toordinal() if index.start else -1,
+             days=len(index.raw),
+             raw=np.packbits(index.raw),
+             grid=np.packbits(index.grid),
+             folder_mtime=index.folder_mtime,
+             cube_stamp=np.array(index.cube_stamp, dtype=np.int64))
+    os.replace(tmp_path, path)
+
+
+def _read_index(path):
+    with np.load(path) as saved:
+        days = int(saved['days'])
+        start = int(saved['start'])
+        return AvailabilityIndex(datetime.date.fromordinal(start) if start >= 0 else None,
+                                 np.unpackbits(saved['raw'], count=days).astype(bool),
+                                 np.unpackbits(saved['grid'], count=days).astype(bool),
+                                 int(saved['folder_mtime']),
+                                 # Indexes saved before the cube header was tracked are rebuilt once
+                                 tuple(int(value) for value in saved['cube_stamp']) if 'cube_stamp' in saved else None)
+
+
+def load_index(folder, product, hemisphere, raw_date_func):
+    """
+    Get the availability index for a product, rebuilding and saving it only if the folder or the grid cube's header
+    changed since it was built.
+    :param folder: string - product input folder
+    :param product: string - 'cdr' or 'nic'
+    :param hemisphere: string - 'south' or 'north'
+    :param raw_date_func: see build_index
+    :return: AvailabilityIndex
+    """
+    if not os.path.isdir(folder):
+        return AvailabilityIndex(None, np.zeros(0, dtype=bool), np.zeros(0, dtype=bool), None)
+
+    key = (os.path.abspath(folder), product, hemisphere)
+    path = _index_path(folder, product, hemisphere)
+    with _LOADED_INDEXES_LOCK:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        folder_mtime = os.stat(folder).st_mtime_ns
+        cube_stamp = _cube_stamp(folder, product, hemisphere)
+        index = _LOADED_INDEXES.get(key)
+        if (index is None or not index.is_current(folder_mtime, cube_stamp)) and os.path.exists(path):
+            index = _read_index(path)
+        if index is None or not index.is_current(folder_mtime, cube_stamp):
+            index = build_index(folder, product, hemisphere, raw_date_func)
+            save_index(index, folder, product, hemisphere)
+            instrument.count('availability indexes rebuilt')
+        _LOADED_INDEXES[key] = index
+        return index
+
+
+def describe_gaps(gaps):
+    """
+    Summarize missing days as a list of date ranges, eg "20200101-20200105, 20200210".
+    :param gaps: pandas DatetimeIndex of missing days
+    :return: string
+    """
+    ranges = []
+    for date in gaps:
+        if ranges and (date - ranges[-1][1]).days == 1:
+            ranges[-1][1] = date
+        else:
+            ranges.append([date, date])
+    return ', '.join(f'{first:%Y%m%d}' if first == last else f'{first:%Y%m%d}-{last:%Y%m%d}'
+                     for first, last in ranges)
@@ -0,0 +1,188 @@
+'''
+A module that catalogs which files actually exist in the remote archives.
+
+Each remote directory (eg one year of one product) is listed once and the listing is cached on disk for a configurable
+time to live.  Downloads are then planned only for files that are in the listing, and file names are resolved by
+pattern so that platform and version suffixes don't have to be hard-coded.
+'''
+
+import ftplib
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+from . import instrument
+from . import transfer
+
+CATALOG_FOLDER = '.catalog'
+
+# The current year's directories get a new file every day, so listings are refreshed daily by default
+DEFAULT_TTL = 24 * 60 * 60
+
+_HREF_PATTERN = re.compile(r'href="([^"?#/]+)"', re.IGNORECASE)
+
+# Listings of local folders, keyed by folder and invalidated when the folder changes - see find_local_file
+_LOCAL_LISTINGS = {}
+_LOCAL_LISTINGS_LOCK = threading.Lock()
+
+
+def list_remote(dir_url, ftp_pool=None, timeout=60):
+    """
+    List the file names in a remote directory.
+    :param dir_url: string - ftp://, http:// or https:// URL of the directory, ending in '/'
+    :param ftp_pool: transfer.FtpConnectionPool - connections to reuse for ftp:// URLs.  A new pool is used if None.
+    :param timeout: float - socket timeout in seconds
+    :return: list of strings
+    """
+    parsed_url = urllib.parse.urlparse(dir_url)
+    if parsed_url.scheme == 'ftp':
+        own_pool = ftp_pool is None
+        ftp_pool = ftp_pool or transfer.FtpConnectionPool(timeout=timeout)
+        key, conn = ftp_pool.acquire(parsed_url)
+        try:
+            names = [name.rsplit('/', 1)[-1] for name in conn.nlst()]
+        except BaseException:
+            ftp_pool.discard(conn)
+            raise
+        ftp_pool.release(key, conn)
+        if own_pool:
+            ftp_pool.close_all()
+        return names
+
+    with urllib.request.urlopen(dir_url, timeout=timeout) as response:
+        index = response.read().decode('utf-8', errors='replace')
+    return sorted(set(urllib.parse.unquote(name) for name in _HREF_PATTERN.findall(index)))
+
+
+def cached_listing(dir_url, cache_folder, ttl=DEFAULT_TTL, ftp_pool=None, verbose=False):
+    """
+    Get the listing of a remote directory, from the on-disk cache if it is younger than ttl.  If the directory can't be
+    listed, a stale cached listing is used if there is one.
+    :param dir_url: string - URL of the directory, ending in '/'
+    :param cache_folder: string - folder holding cached listings
+    :param ttl: float - seconds a cached listing stays fresh
+    :param ftp_pool: transfer.FtpConnectionPool - connections to reuse for ftp:// URLs
+    :param verbose: bool - increase verbosity
+    :return: set of file names, or None if the directory couldn't be listed and isn't cached
+    """
+    cache_path = os.path.join(cache_folder, hashlib.sha1(dir_url.encode()).hexdigest()[:16] + '.json')
+
+    cached = None
+    if os.path.exists(cache_path):
+        with open(cache_path) as cache_file:
+            cached = json.load(cache_file)
+        if time.time() - cached['listed'] < ttl:
+            instrument.count('remote listings from cache')
+            return set(cached['names'])
+
+    try:
+        names = list_remote(dir_url, ftp_pool=ftp_pool)
+    except (OSError, EOFError, ftplib.Error) as exc:
+        if verbose:
+            print(f"Could not list {dir_url}; {exc}")
+        instrument.count('remote listing failures')
+        return set(cached['names']) if cached else None
+
+    os.makedirs(cache_folder, exist_ok=True)
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'w') as cache_file:
+        json.dump({'url': dir_url, 'listed': time.time(), 'names': names}, cache_file)
+    os.replace(tmp_path, cache_path)
+    instrument.count('remote listings fetched')
+
+    return set(names)
+
+
+def resolve_name(names, pattern):
+    """
+    Pick the file name matching a pattern.  If several versions match, the last one in sort order (eg the newest
+    version suffix) is used.
+    :param names: iterable of file names
+    :param pattern: compiled regular expression
+    :return: string, or None if nothing matches
+    """
+    matches = sorted(name for name in names if pattern.match(name))
+    return matches[-1] if matches else None
+
+
+def plan_downloads(sftp_formatter, name_pattern, dates, local_dir, hemisphere, no_clobber=True, ttl=DEFAULT_TTL,
+                   verbose=False):
+    """
+    Plan the downloads for a range of days using the remote catalog.  Each remote directory is listed once, days with
+    no matching file in the archive are skipped, and names are resolved from the listing.  If a directory can't be
+    listed at all, the formatter's file names are used as-is.
+    :param sftp_formatter: Formatter function that returns the sftp directory and file names as tuples when provided a
+     date and hemisphere
+    :param name_pattern: Function that returns a compiled regular expression matching any name variant of a day's file
+     when provided a date and hemisphere
+    :param dates: iterable of datetimes to plan
+    :param local_dir: str - Local directory files are saved in.  Listings are cached in a subfolder of it.
+    :param hemisphere: str - hemisphere - either north for the arctic or south for antarctica
+    :param no_clobber: bool - Don't plan files that already exist locally
+    :param ttl: float - seconds a cached listing stays fresh
+    :param verbose: bool - increase verbosity
+    :return: (list of (url, local path) transfers, list of dates that aren't in the archive)
+    """
+    cache_folder = os.path.join(local_dir, CATALOG_FOLDER)
+    ftp_pool = transfer.FtpConnectionPool()
+    listings = {}
+    transfers = []
+    missing = []
+
+    try:
+        for date in dates:
+            ftp_dir, ftp_file = sftp_formatter(date, hemisphere)
+            if ftp_dir not in listings:
+                listings[ftp_dir] = cached_listing(ftp_dir, cache_folder, ttl=ttl, ftp_pool=ftp_pool, verbose=verbose)
+
+            if listings[ftp_dir] is not None:
+                ftp_file = resolve_name(listings[ftp_dir], name_pattern(date, hemisphere))
+                if ftp_file is None:
+                    missing.append(date)
+                    continue
+
+            file_full = os.path.join(local_dir, ftp_file)
+            if no_clobber and os.path.exists(file_full):
+                # No clobber is specified and we already have a file
+                if verbose:
+                    print("Skipping %s - already exists" % (ftp_dir + ftp_file))
+                instrument.count('files already downloaded')
+                continue
+
+            transfers.append((ftp_dir + ftp_file, file_full))
+    finally:
+        ftp_pool.close_all()
+
+    if verbose and missing:
+        print(f"Skipping {len(missing)} days that aren't in the archive")
+    instrument.count('days not in archive', len(missing))
+
+    return transfers, missing
+
+
+def find_local_file(folder, default_name, pattern):
+    """
+    Find a day's downloaded file, which may have been saved under any name variant matching the pattern.
+    :param folder: string - folder files were downloaded to
+    :param default_name: string - the file name from the product's formatter, checked first
+    :param pattern: compiled regular expression matching any name variant of the file
+    :return: string - path to the file.  The default name's path if no variant is found.
+    """
+    default_path = os.path.join(folder, default_name)
+    if os.path.exists(default_path) or not os.path.isdir(folder):
+        return default_path
+
+    mtime = os.stat(folder).st_mtime_ns
+    with _LOCAL_LISTINGS_LOCK:
+        listing = _LOCAL_LISTINGS.get(folder)
+        if listing is None or listing[0] != mtime:
+            listing = (mtime, os.listdir(folder))
+            _LOCAL_LISTINGS[folder] = listing
+
+    name = resolve_name(listing[1], pattern)
+    return os.path.join(folder, name) if name else default_path
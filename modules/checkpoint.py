@@ -0,0 +1,131 @@
+'''
+A module that keeps track of which days an incrementally updated output holds and which inputs they were computed from.
+
+A checkpoint is saved next to its output.  It records the parameters the output was computed with (eg thresholds), the
+days in the output, when each of their input grids was written (see download.grid_write_times) and the size and
+modification time of the output when the checkpoint was saved.  A later run only has to compute days that are new or
+whose grids were written again since.  If the output was changed by anything else in the meantime (eg a full run, or a
+run interrupted before its checkpoint was saved) or the parameters differ, the checkpoint is ignored and the output
+starts over.
+'''
+
+import os
+
+import numpy as np
+import pandas as pd
+
+CHECKPOINT_SUFFIX = '.checkpoint.npz'
+
+
+class Checkpoint:
+    """
+    The days held by an output and the write times of the inputs each day was computed from.
+    """
+
+    def __init__(self, params, input_names, dates, write_times):
+        """
+        :param params: np float array - parameters the output was computed with
+        :param input_names: tuple of strings - names of the inputs, eg ('cdr', 'nic')
+        :param dates: pandas DatetimeIndex - days in the output, sorted
+        :param write_times: np int64 array (days, inputs) - when each day's inputs were written
+        """
+        self.params = params
+        self.input_names = input_names
+        self.dates = dates
+        self.write_times = write_times
+
+    @property
+    def last_day(self):
+        """
+        The last day in the output, or None if it is empty.
+        """
+        return self.dates[-1] if len(self.dates) else None
+
+    def stale(self, days, write_times):
+        """
+        Find the days that are missing from the output or whose inputs were written since they were computed.
+        :param days: pandas DatetimeIndex - days to check
+        :param write_times: np int64 array (days, inputs) - when each day's inputs were last written
+        :return: np bool array - True for the days that need computing
+        """
+        positions = self.dates.get_indexer(days)
+        known = positions >= 0
+        unchanged = np.zeros(len(days), dtype=bool)
+        unchanged[known] = (self.write_times[positions[known]] == write_times[known]).all(axis=1)
+        return ~unchanged
+
+    def updated(self, days, write_times):
+        """
+        Get a checkpoint that also holds days, replacing any of them already held.
+        :param days: pandas DatetimeIndex - days just computed
+        :param write_times: np int64 array (days, inputs) - when those days' inputs were written
+        :return: Checkpoint
+        """
+        kept = ~self.dates.isin(days)
+        dates = self.dates[kept].append(days)
+        order = np.argsort(dates.values, kind='stable')
+        return Checkpoint(self.params, self.input_names, dates[order],
+                          np.concatenate([self.write_times[kept], write_times])[order])
+
+
+def checkpoint_path(output_path):
+    """
+    Get the path of the checkpoint kept for an output.
+    :param output_path: string - path of the output
+    :return: string
+    """
+    return os.path.splitext(output_path)[0] + CHECKPOINT_SUFFIX
+
+
+def new_checkpoint(params, input_names):
+    """
+    Create a checkpoint for an output that doesn't hold any days yet.
+    :param params: np float array - parameters the output is computed with
+    :param input_names: tuple of strings - names of the inputs
+    :return: Checkpoint
+    """
+    return Checkpoint(np.asarray(params, dtype=float), tuple(input_names), pd.DatetimeIndex([]),
+                      np.zeros((0, len(input_names)), dtype=np.int64))
+
+
+def load_checkpoint(output_path, params, input_names):
+    """
+    Load the checkpoint kept for an output, if it still describes the output.
+    :param output_path: string - path of the output
+    :param params: np float array - parameters the output is about to be computed with
+    :param input_names: tuple of strings - names of the inputs
+    :return: Checkpoint, or None if there is no output or checkpoint, the output changed since the checkpoint was saved
+        or it was computed with other parameters or inputs
+    """
+    path = checkpoint_path(output_path)
+    if not os.path.exists(output_path) or not os.path.exists(path):
+        return None
+    output_stat = os.stat(output_path)
+    with np.load(path) as saved:
+        if (int(saved['output_size']) != output_stat.st_size or int(saved['output_mtime']) != output_stat.st_mtime_ns
+                or not np.array_equal(saved['params'], np.asarray(params, dtype=float))
+                or tuple(saved['input_names']) != tuple(input_names)):
+            return None
+        return Checkpoint(saved['params'], tuple(input_names), pd.DatetimeIndex(saved['dates']),
+                          saved['write_times'])
+
+
+def save_checkpoint(output_path, checkpoint):
+    """
+    Save the checkpoint for an output.  Call this right after writing the output, so the checkpoint records its size
+    and modification time.
+    :param output_path: string - path of the output
+    :param checkpoint: Checkpoint
+    :return:
+    """
+    path = checkpoint_path(output_path)
+    output_stat = os.stat(output_path)
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path,
+             params=checkpoint.params,
+             input_names=np.array(checkpoint.input_names),
+             dates=checkpoint.dates.values.astype('datetime64[D]'),
+             write_times=checkpoint.write_times,
+             output_size=output_stat.st_size,
+             output_mtime=output_stat.st_mtime_ns)
+    os.replace(tmp_path, path)
@@ -6,10 +6,49 @@ import numpy as np
 import pandas as pd
 
 from . import download as dwn
+from . import encoding
 
 # Each grid cell is 25 km2
 GRID_CELL_AREA = 25*25
 
+# Histograms resolve sea ice concentration to 1% steps, one bin per percent code - see the encoding module
+CONCENTRATION_BINS = encoding.CONCENTRATION_BINS
+BIN_VALUES = encoding.PERCENT_VALUES
+
+# The product axis of batched areas (see calculate_ice_area_stack)
+AREA_PRODUCTS = ('nic', 'cdr')
+
+# Footprint classes of each pixel (see footprint_classes), in the order they are encoded
+FOOTPRINT_NEITHER, FOOTPRINT_CDR_ONLY, FOOTPRINT_NIC_ONLY, FOOTPRINT_BOTH = range(4)
+FOOTPRINT_CLASSES = ('neither', 'cdr only', 'nic only', 'both')
+
+# The value calculate_ice_footprint_diff gives each footprint class
+_FOOTPRINT_DIFF_VALUES = np.array([4, 3, 2, 1])
+
+# Grid cells binned at once by batched area calculations - about 16 million, which bounds the working memory to a few
+# hundred MB whatever the number of days
+DEFAULT_CHUNK_CELLS = 16 * 1024 * 1024
+
+
+def threshold_mask(grid, min_sic, max_sic=None):
+    """
+    Get a mask of where a grid is between thresholds.  Encoded grids are compared against the equivalent percent codes,
+    so the grid is never decoded to floats; float grids are compared directly.
+    :param grid: np array - percent codes or fractional sea ice concentration
+    :param min_sic: float - 0 to 1 - fractional percentage SIC lower threshold, inclusive
+    :param max_sic: float - 0 to 1 - fractional percentage SIC upper threshold, inclusive.  No upper bound if None.
+    :return: np bool array
+    """
+    if encoding.is_encoded(grid):
+        mask = grid >= encoding.lower_code(min_sic)
+        if max_sic is not None:
+            mask &= grid <= encoding.upper_code(max_sic)
+        return mask
+    mask = grid >= min_sic
+    if max_sic is not None:
+        mask &= grid <= max_sic
+    return mask
+
 
 def median_cdr(thresh, start, end, folder, hemisphere):
     """
@@ -19,9 +58,10 @@ def median_cdr(thresh, start, end, folder, hemisphere):
     :param end: End date
     :param folder: Folder to look for data
     :param hemisphere: Hemisphere
-    :return:
+    :return: np bool array
+    :raises ValueError: if there are no grids between start and end
     """
-    return _median_grid(dwn.get_cdr, thresh, start, end, folder, hemisphere)
+    return _median_grid(dwn.get_cdr, dwn.available_cdr_dates, thresh, start, end, folder, hemisphere)
 
 
 def median_nic(thresh, start, end, folder, hemisphere):
@@ -32,21 +72,25 @@ def median_nic(thresh, start, end, folder, hemisphere):
     :param end: End date
     :param folder: Folder to look for data
     :param hemisphere: Hemisphere
-    :return:
+    :return: np bool array
+    :raises ValueError: if there are no grids between start and end
     """
-    return _median_grid(dwn.get_nic, thresh, start, end, folder, hemisphere)
+    return _median_grid(dwn.get_nic, dwn.available_nic_dates, thresh, start, end, folder, hemisphere)
 
 
-def _median_grid(retrieval_func, thresh, start, end, folder, hemisphere):
+def _median_grid(retrieval_func, availability_func, thresh, start, end, folder, hemisphere):
     """
-    Return the median grid values between the provided dates and at the specified threshold
+    Return the median grid values between the provided dates and at the specified threshold.  See
+    composite.monthly_median for calendar months that are reused between runs.
     :param retrieval_func: Function that is called with date, folder and hemisphere to retrieve grid
+    :param availability_func: Function that is called with start, end, folder and hemisphere to find days with grids
     :param thresh: Threshold for median sea ice
     :param start: Start date
     :param end: End date
     :param folder: Folder to look for data
     :param hemisphere: Hemisphere
-    :return:
+    :return: np bool array
+    :raises ValueError: if there are no grids between start and end
     """
     sum_grid = None
     counter = 0
@@ -54,17 +98,16 @@ def _median_grid(retrieval_func, thresh, start, end, folder, hemisphere):
     # should always be 0.5 - we're looking for qualifying ice concentrations 50% of the time or greater.
     median_percentage = 0.5
 
-    # This one loops on a daily frequency
-    for date in pd.date_range(start=start, end=end):
-        try:
-            grid = retrieval_func(date, folder, hemisphere)
-            mask = np.where(grid >= thresh, True, False)
+    # This one loops on a daily frequency, skipping days without a grid
+    for date in availability_func(start, end, folder, hemisphere):
+        mask = threshold_mask(retrieval_func(date, folder, hemisphere), thresh)
+
+        # Either add onto the sum grid or make the sum grid the mask, updated as int type (instead of bool)
+        sum_grid = sum_grid + mask if sum_grid is not None else 1*mask
+        counter += 1
 
-            # Either add onto the sum grid or make the sum grid the mask, updated as int type (instead of bool)
-            sum_grid = sum_grid + mask if sum_grid is not None else 1*mask
-            counter += 1
-        except Exception as exc:
-            print(f"Could not run {date} because {exc}; continuing")
+    if not counter:
+        raise ValueError(f"No grids in {folder} between {start:%Y%m%d} and {end:%Y%m%d} to take the median of")
 
     percent_hit_grid = sum_grid / counter
 
@@ -74,8 +117,8 @@ def _median_grid(retrieval_func, thresh, start, end, folder, hemisphere):
 def calculate_ice_area(cdr_grid, nic_grid, min_sic_nic, max_sic_nic, min_sic_cdr, max_sic_cdr, verbose=False):
     """
     Calculate the total ice area between two thresholds
-    :param cdr_grid: np array - cdr data array
-    :param nic_grid: np array - nic data array - same shape as cdr_grid
+    :param cdr_grid: np array - cdr data array, percent codes or fractional
+    :param nic_grid: np array - nic data array, percent codes or fractional - same shape as cdr_grid
     :param min_sic_nic: float - 0 to 1 - fractional percentage SIC lower threshold for nic data
     :param max_sic_nic: float - 0 to 1 - fractional percentage SIC upper threshold for nic data
     :param min_sic_cdr: float - 0 to 1 - fractional percentage SIC lower threshold for cdr data
@@ -88,12 +131,9 @@ def calculate_ice_area(cdr_grid, nic_grid, min_sic_nic, max_sic_nic, min_sic_cdr
     assert min_sic_nic <= max_sic_nic
     assert min_sic_cdr <= max_sic_cdr
 
-    cdr_cell_count = np.where((cdr_grid >= min_sic_cdr) &
-                              (cdr_grid <= max_sic_cdr) &
-                              (cdr_grid >= 0), True, False).sum()
-    nic_cell_count = np.where((nic_grid >= min_sic_nic) &
-                              (nic_grid <= max_sic_nic) &
-                              (cdr_grid >= 0), True, False).sum()
+    cdr_valid = cdr_grid >= 0
+    cdr_cell_count = np.count_nonzero(threshold_mask(cdr_grid, min_sic_cdr, max_sic_cdr) & cdr_valid)
+    nic_cell_count = np.count_nonzero(threshold_mask(nic_grid, min_sic_nic, max_sic_nic) & cdr_valid)
 
     if verbose:
         cdr_initial_count = np.where((cdr_grid > 0), True, False).sum()
@@ -108,33 +148,241 @@ def calculate_ice_area(cdr_grid, nic_grid, min_sic_nic, max_sic_nic, min_sic_cdr
     return cdr_area, nic_area
 
 
+def concentration_histogram(grid, valid=None):
+    """
+    Count the grid cells in each 1% sea ice concentration bin in a single pass over the grid.  Cells below 0% (eg the
+    NIC fill value) or above 100% are not counted.  Encoded grids are counted directly from their codes.
+    :param grid: np array - percent codes or fractional sea ice concentration data array (0 to 1)
+    :param valid: np bool array - optional, only count cells where this is True.  Same shape as grid.
+    :return: np int array of length CONCENTRATION_BINS
+    """
+    if encoding.is_encoded(grid):
+        if valid is None:
+            return encoding.code_histogram(grid)
+        codes = np.asarray(grid)
+    else:
+        codes = np.rint(np.asarray(grid) * 100)
+    keep = (codes >= 0) & (codes < CONCENTRATION_BINS)
+    if valid is not None:
+        keep &= valid
+    return np.bincount(codes[keep].astype(np.intp), minlength=CONCENTRATION_BINS)
+
+
+def areas_from_histogram(histogram, min_sic, max_sic):
+    """
+    Read the total ice area between thresholds from a concentration histogram.  Any number of thresholds can be read
+    from the same histogram - each costs a lookup into the cumulative histogram rather than a pass over the grid.
+    :param histogram: np array - counts per bin from concentration_histogram, or (..., CONCENTRATION_BINS) counts for
+        several histograms at once (eg one per region)
+    :param min_sic: float or np array - 0 to 1 - fractional percentage SIC lower threshold(s), inclusive
+    :param max_sic: float or np array - 0 to 1 - fractional percentage SIC upper threshold(s), inclusive
+    :return: np array of areas - (..., thresholds) with the thresholds broadcast over min_sic and max_sic
+    """
+    histogram = np.asarray(histogram)
+    cumulative = np.zeros(histogram.shape[:-1] + (histogram.shape[-1] + 1,), dtype=np.int64)
+    np.cumsum(histogram, axis=-1, out=cumulative[..., 1:])
+    lower, upper = _threshold_bins(min_sic, max_sic)
+    return (cumulative[..., upper] - cumulative[..., lower]) * GRID_CELL_AREA
+
+
+def _threshold_bins(min_sic, max_sic):
+    """
+    Get the first bin at or above the lower threshold and one past the last bin at or below the upper threshold.
+    :return: (np int array, np int array)
+    """
+    lower = np.searchsorted(BIN_VALUES, min_sic, side='left')
+    upper = np.maximum(np.searchsorted(BIN_VALUES, max_sic, side='right'), lower)
+    return lower, upper
+
+
+def calculate_ice_areas(cdr_grid, nic_grid, min_sic_nic, max_sic_nic, min_sic_cdr, max_sic_cdr, verbose=False):
+    """
+    Calculate the total ice area between many pairs of thresholds at once.  Same as calculate_ice_area, but each grid is
+    binned once and every threshold's area is read from the histogram.
+    :param cdr_grid: np array - cdr data array
+    :param nic_grid: np array - nic data array - same shape as cdr_grid
+    :param min_sic_nic: float or np array - 0 to 1 - fractional percentage SIC lower threshold(s) for nic data
+    :param max_sic_nic: float or np array - 0 to 1 - fractional percentage SIC upper threshold(s) for nic data
+    :param min_sic_cdr: float or np array - 0 to 1 - fractional percentage SIC lower threshold(s) for cdr data
+    :param max_sic_cdr: float or np array - 0 to 1 - fractional percentage SIC upper threshold(s) for cdr data
+    :param verbose: bool - Add additional output
+    :return: (np array of cdr areas, np array of nic areas)
+    """
+
+    # We need lower thresholds that are less than upper thresholds
+    assert np.all(np.asarray(min_sic_nic) <= max_sic_nic)
+    assert np.all(np.asarray(min_sic_cdr) <= max_sic_cdr)
+
+    cdr_histogram = concentration_histogram(cdr_grid)
+    nic_histogram = concentration_histogram(nic_grid, valid=cdr_grid >= 0)
+
+    if verbose:
+        print(f"CDR has {cdr_histogram[1:].sum()} cells unfiltered")
+        print(f"NIC has {nic_histogram[1:].sum()} cells unfiltered")
+
+    cdr_areas = areas_from_histogram(cdr_histogram, min_sic_cdr, max_sic_cdr)
+    nic_areas = areas_from_histogram(nic_histogram, min_sic_nic, max_sic_nic)
+
+    return cdr_areas, nic_areas
+
+
+def stack_histograms(stack, valid=None):
+    """
+    Count the grid cells in each 1% sea ice concentration bin for every day of a stack with a single bincount, by
+    offsetting each day's codes into its own block of bins.  See concentration_histogram.
+    :param stack: np array (days, y, x) - percent codes or fractional sea ice concentration
+    :param valid: np bool array (days, y, x) - optional, only count cells where this is True
+    :return: np int array (days, CONCENTRATION_BINS)
+    """
+    days = stack.shape[0]
+    if encoding.is_encoded(stack):
+        codes = stack.reshape(days, -1).astype(np.intp)
+    else:
+        codes = np.rint(stack.reshape(days, -1) * 100).astype(np.intp)
+
+    # Out of range codes would spill into the next day's bins.  CDR codes are never negative, so they only need masking
+    # if something above 100% got in.
+    keep = None
+    if stack.dtype != encoding.CDR_DTYPE or codes.max(initial=0) >= CONCENTRATION_BINS:
+        keep = (codes >= 0) & (codes < CONCENTRATION_BINS)
+    if valid is not None:
+        keep = valid.reshape(days, -1) if keep is None else keep & valid.reshape(days, -1)
+
+    codes += np.arange(days)[:, None] * CONCENTRATION_BINS
+    binned = codes.ravel() if keep is None else codes[keep]
+    return np.bincount(binned, minlength=days * CONCENTRATION_BINS).reshape(days, CONCENTRATION_BINS)
+
+
+def calculate_ice_area_stack(cdr_stack, nic_stack, min_sic_nic, max_sic_nic, min_sic_cdr, max_sic_cdr,
+                             days_valid=None, chunk_cells=DEFAULT_CHUNK_CELLS):
+    """
+    Calculate the total ice area between many pairs of thresholds for a whole stack of days at once.  Same as
+    calculate_ice_area for each day and threshold, but the stack is binned a chunk of days at a time with one bincount
+    per product and every threshold is read from the cumulative histograms, so no per-threshold masks are built.
+    :param cdr_stack: np array (days, y, x) - cdr data, percent codes or fractional (eg a view from get_cdr_range)
+    :param nic_stack: np array (days, y, x) - nic data, percent codes or fractional - same shape as cdr_stack
+    :param min_sic_nic: float or np array - 0 to 1 - fractional percentage SIC lower threshold(s) for nic data
+    :param max_sic_nic: float or np array - 0 to 1 - fractional percentage SIC upper threshold(s) for nic data
+    :param min_sic_cdr: float or np array - 0 to 1 - fractional percentage SIC lower threshold(s) for cdr data
+    :param max_sic_cdr: float or np array - 0 to 1 - fractional percentage SIC upper threshold(s) for cdr data
+    :param days_valid: np bool array (days,) - optional, days to calculate.  Other days are NaN.
+    :param chunk_cells: int - maximum number of grid cells binned at once, which bounds memory use
+    :return: np float array (days, thresholds, 2) - areas, with the last axis ordered as AREA_PRODUCTS
+    """
+    assert cdr_stack.shape == nic_stack.shape
+
+    # We need lower thresholds that are less than upper thresholds
+    min_sic_nic, max_sic_nic, min_sic_cdr, max_sic_cdr = (np.atleast_1d(thresh) for thresh in np.broadcast_arrays(
+        min_sic_nic, max_sic_nic, min_sic_cdr, max_sic_cdr))
+    assert np.all(min_sic_nic <= max_sic_nic)
+    assert np.all(min_sic_cdr <= max_sic_cdr)
+
+    bins = {'nic': _threshold_bins(min_sic_nic, max_sic_nic), 'cdr': _threshold_bins(min_sic_cdr, max_sic_cdr)}
+
+    days = cdr_stack.shape[0]
+    areas = np.full((days, len(min_sic_nic), len(AREA_PRODUCTS)), np.nan)
+    day_indexes = np.arange(days) if days_valid is None else np.flatnonzero(days_valid)
+    chunk_days = max(1, chunk_cells // max(1, int(np.prod(cdr_stack.shape[1:]))))
+
+    for first in range(0, len(day_indexes), chunk_days):
+        chunk = day_indexes[first:first + chunk_days]
+        cdr_chunk = cdr_stack[chunk]
+
+        # Encoded CDR grids can't hold negative values, so only float grids need a validity mask
+        valid = None if encoding.is_encoded(cdr_chunk) and cdr_chunk.dtype == encoding.CDR_DTYPE else cdr_chunk >= 0
+        histograms = {'cdr': stack_histograms(cdr_chunk), 'nic': stack_histograms(nic_stack[chunk], valid=valid)}
+
+        for product_index, product in enumerate(AREA_PRODUCTS):
+            cumulative = np.zeros((len(chunk), CONCENTRATION_BINS + 1), dtype=np.int64)
+            np.cumsum(histograms[product], axis=1, out=cumulative[:, 1:])
+            lower, upper = bins[product]
+            areas[chunk, :, product_index] = (cumulative[:, upper] - cumulative[:, lower]) * GRID_CELL_AREA
+
+    return areas
+
+
+def calculate_ice_area_range(start, end, cdr_folder, nic_folder, hemisphere, min_sic_nic, max_sic_nic, min_sic_cdr,
+                             max_sic_cdr, chunk_cells=DEFAULT_CHUNK_CELLS):
+    """
+    Calculate the total ice area between many pairs of thresholds for every day from start to end (inclusive), read
+    straight from the CDR and NIC grid cubes.  Days only stored as legacy per-day .npy grids are loaded one at a time.
+    See calculate_ice_area_stack.
+    :param start: datetime - first day
+    :param end: datetime - last day
+    :param cdr_folder: string - folder holding the CDR grid cube
+    :param nic_folder: string - folder holding the NIC grid cube
+    :param hemisphere: string - 'south' or 'north'
+    :param min_sic_nic: float or np array - 0 to 1 - fractional percentage SIC lower threshold(s) for nic data
+    :param max_sic_nic: float or np array - 0 to 1 - fractional percentage SIC upper threshold(s) for nic data
+    :param min_sic_cdr: float or np array - 0 to 1 - fractional percentage SIC lower threshold(s) for cdr data
+    :param max_sic_cdr: float or np array - 0 to 1 - fractional percentage SIC upper threshold(s) for cdr data
+    :param chunk_cells: int - maximum number of grid cells binned at once, which bounds memory use
+    :return: (
+        pandas DatetimeIndex of every day from start to end,
+        np float array (days, thresholds, 2) - areas ordered as AREA_PRODUCTS, NaN for days missing either grid
+    )
+    """
+    dates = pd.date_range(start=start, end=end)
+    thresholds = np.broadcast(min_sic_nic, max_sic_nic, min_sic_cdr, max_sic_cdr).size
+    areas = np.full((len(dates), thresholds, len(AREA_PRODUCTS)), np.nan)
+
+    cdr_dates, cdr_stack, cdr_valid = dwn.get_cdr_range(start, end, cdr_folder, hemisphere)
+    nic_dates, nic_stack, nic_valid = dwn.get_nic_range(start, end, nic_folder, hemisphere)
+
+    # Both cubes are clipped to their own extents - only the days both cover can be compared
+    common = cdr_dates.intersection(nic_dates)
+    if not common.empty:
+        cdr_days = slice(cdr_dates.get_loc(common[0]), cdr_dates.get_loc(common[-1]) + 1)
+        nic_days = slice(nic_dates.get_loc(common[0]), nic_dates.get_loc(common[-1]) + 1)
+        days_valid = cdr_valid[cdr_days] & nic_valid[nic_days]
+        areas[dates.get_indexer(common)] = calculate_ice_area_stack(cdr_stack[cdr_days], nic_stack[nic_days],
+                                                                    min_sic_nic, max_sic_nic, min_sic_cdr, max_sic_cdr,
+                                                                    days_valid=days_valid, chunk_cells=chunk_cells)
+
+    # Days only stored as legacy per-day .npy grids aren't in the cubes, so they're loaded one at a time
+    min_sic_nic, max_sic_nic, min_sic_cdr, max_sic_cdr = np.broadcast_arrays(min_sic_nic, max_sic_nic, min_sic_cdr,
+                                                                             max_sic_cdr)
+    for day in dwn.legacy_grid_pair_dates(start, end, cdr_folder, nic_folder, hemisphere):
+        cdr_areas, nic_areas = calculate_ice_areas(dwn.get_cdr(day, cdr_folder, hemisphere),
+                                                   dwn.get_nic(day, nic_folder, hemisphere),
+                                                   min_sic_nic, max_sic_nic, min_sic_cdr, max_sic_cdr)
+        areas[dates.get_loc(day)] = np.stack([nic_areas, cdr_areas], axis=-1).reshape(areas.shape[1:])
+    return dates, areas
+
+
+def footprint_classes(nic_grid, min_nic, max_nic, cdr_grid, min_cdr, max_cdr):
+    """
+    Classify every pixel by which products put ice between their thresholds, in one pass - the class is encoded as
+    2 * nic + cdr from the two threshold masks, so it indexes FOOTPRINT_CLASSES.
+    :param nic_grid: numpy arr - nic data, percent codes or fractional
+    :param min_nic: float - min nic threshold
+    :param max_nic: float - max nic threshold
+    :param cdr_grid: numpy arr - cdr data, percent codes or fractional
+    :param min_cdr: float - min cdr threshold
+    :param max_cdr: float - max cdr threshold
+    :return: np uint8 array of classes - FOOTPRINT_NEITHER, FOOTPRINT_CDR_ONLY, FOOTPRINT_NIC_ONLY or FOOTPRINT_BOTH
+    """
+    classes = np.left_shift(threshold_mask(nic_grid, min_nic, max_nic).view(np.uint8), 1)
+    classes |= threshold_mask(cdr_grid, min_cdr, max_cdr).view(np.uint8)
+    return classes
+
+
 def calculate_ice_footprint_diff(nic_grid, min_nic, max_nic, cdr_grid, min_cdr, max_cdr):
     """
     First, calculate a boolean array between the min and max thresholds for both nic grids and cdr grids.  Then
     create an array that represents the following -
         - value "1" - nic and cdr both True
-        - value "2" - nic and cdr both False
-        - value "3" - nic True and cdr False
-        - value "4" - cdr True and nic False
+        - value "2" - nic True and cdr False
+        - value "3" - cdr True and nic False
+        - value "4" - nic and cdr both False
 
-    :param nic_grid: numpy arr - nic data
+    :param nic_grid: numpy arr - nic data, percent codes or fractional
     :param min_nic: float - min nic threshold
     :param max_nic: float - max nic threshold
-    :param cdr_grid: numpy arr - cdr data
+    :param cdr_grid: numpy arr - cdr data, percent codes or fractional
     :param min_cdr: float - min cdr threshold
     :param max_cdr: float - max cdr threshold
     :return: numpy array as described above
     """
-
-    overlap_grid = np.zeros_like(cdr_grid)
-
-    # Threshold the grids
-    cdr_grid = np.where((cdr_grid >= min_cdr) & (cdr_grid <= max_cdr), True, False)
-    nic_grid = np.where((nic_grid >= min_nic) & (nic_grid <= max_nic), True, False)
-
-    # Create a new grid and populate
-    overlap_grid[(nic_grid & cdr_grid)] = 1
-    overlap_grid[(nic_grid & ~cdr_grid)] = 2
-    overlap_grid[(~nic_grid & cdr_grid)] = 3
-    overlap_grid[(~nic_grid & ~cdr_grid)] = 4
-    return overlap_grid
+    classes = footprint_classes(nic_grid, min_nic, max_nic, cdr_grid, min_cdr, max_cdr)
+    return _FOOTPRINT_DIFF_VALUES.astype(np.asarray(cdr_grid).dtype)[classes]
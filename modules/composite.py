@@ -0,0 +1,235 @@
+'''
+A module that maintains monthly threshold composites incrementally.
+
+For each product, hemisphere, month and threshold, a composite stores the number of days each pixel was at or above the
+threshold ("hits"), the days that have been folded into it and when each of their grids was written (see
+download.grid_write_times).  Composites are saved next to the product grids, so updating a composite only reads the days
+that arrived since it was last saved.  If a day's grid was written again since it was folded in (eg converted with
+clobber), its old mask can't be taken back out, so the month is folded in from scratch.
+
+Rolling composites ("how often was ice present over the last N days") keep a running sum of the daily threshold masks
+in the window - each day adds the mask entering the window and subtracts the one leaving it - so the windows for a whole
+date range cost one pass over the days and only one grid of memory.  The daily masks are kept bit-packed in a grid cube
+per product and threshold, so later runs only threshold days that are new or whose grids were written again since.
+'''
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from . import compare
+from . import cube
+from . import download as dwn
+from . import encoding
+from . import instrument
+
+COMPOSITE_FOLDER = 'composites'
+COMPOSITE_FNAME_FMT = '{hemisphere}_{product}_{month:%Y%m}_{thresh:g}_thresh.npz'
+MASK_PRODUCT_FMT = '{product}_{thresh:g}_mask'
+
+# should always be 0.5 - we're looking for qualifying ice concentrations 50% of the time or greater.
+MEDIAN_PERCENTAGE = 0.5
+
+_PRODUCT_FUNCS = {
+    'cdr': (dwn.get_cdr, dwn.available_cdr_dates),
+    'nic': (dwn.get_nic, dwn.available_nic_dates),
+}
+
+
+def composite_path(product, thresh, month, folder, hemisphere):
+    """
+    Get the path to the saved composite for a product, threshold and month.
+    :param product: string - 'cdr' or 'nic'
+    :param thresh: float - sea ice concentration threshold
+    :param month: datetime - any day in the month
+    :param folder: string - folder holding the product grids
+    :param hemisphere: string - 'south' or 'north'
+    :return: string
+    """
+    return os.path.join(folder, COMPOSITE_FOLDER, COMPOSITE_FNAME_FMT.format(hemisphere=hemisphere,
+                                                                             product=product,
+                                                                             month=month,
+                                                                             thresh=float(thresh)))
+
+
+def update_monthly_composite(product, thresh, month, folder, hemisphere, rebuild=False, verbose=False):
+    """
+    Fold any days of the month that aren't in the saved composite yet into it and save it.  Days are found with the
+    product's availability lookup, so missing days are never loaded.  The composite is rebuilt if any day in it was
+    written again since it was folded in.
+    :param product: string - 'cdr' or 'nic'
+    :param thresh: float - sea ice concentration threshold
+    :param month: datetime - any day in the month
+    :param folder: string - folder holding the product grids
+    :param hemisphere: string - 'south' or 'north'
+    :param rebuild: bool - discard the saved composite and fold in every day again
+    :param verbose: bool - increase verbosity
+    :return: (np uint16 array of hits per pixel, number of days folded in)
+    """
+    retrieval_func, availability_func = _PRODUCT_FUNCS[product]
+
+    month_start = pd.Timestamp(month).replace(day=1)
+    month_end = month_start + pd.offsets.MonthEnd(1)
+    path = composite_path(product, thresh, month_start, folder, hemisphere)
+
+    available = availability_func(month_start, month_end, folder, hemisphere)
+    write_times = dwn.grid_write_times(available, product, folder, hemisphere)
+
+    hits = None
+    folded = np.zeros(0, dtype=np.int64)
+    folded_written = np.zeros(0, dtype=np.int64)
+    if not rebuild and os.path.exists(path):
+        with np.load(path) as saved:
+            hits = saved['hits']
+            folded = saved['days']
+            # Composites saved before write times were kept have 0 (unknown) for every day, so they're rebuilt once
+            folded_written = saved['written'] if 'written' in saved else np.zeros(len(folded), dtype=np.int64)
+
+    # Days whose grids were written again since they were folded in
+    positions = pd.Index(folded).get_indexer([day.toordinal() for day in available])
+    in_composite = positions >= 0
+    rewritten = np.zeros(len(available), dtype=bool)
+    rewritten[in_composite] = folded_written[positions[in_composite]] != write_times[in_composite]
+    if rewritten.any():
+        if verbose:
+            print(f"Rebuilding the {product} composite for {month_start:%Y-%m} at {thresh} - "
+                  f"{np.count_nonzero(rewritten)} days were converted again")
+        instrument.count('composites rebuilt')
+        hits = None
+        folded = np.zeros(0, dtype=np.int64)
+        folded_written = np.zeros(0, dtype=np.int64)
+        in_composite = np.zeros(len(available), dtype=bool)
+
+    new_days = available[~in_composite]
+
+    if verbose:
+        print(f"Folding {len(new_days)} new days into the {product} composite for {month_start:%Y-%m} at {thresh}")
+    instrument.count('composite days reused', len(folded))
+    instrument.count('composite days folded', len(new_days))
+
+    if new_days.empty:
+        return hits, len(folded)
+
+    for day in new_days:
+        grid = retrieval_func(day, folder, hemisphere)
+        if hits is None:
+            hits = np.zeros(grid.shape, dtype=np.uint16)
+        hits += compare.threshold_mask(grid, thresh)
+
+    ordinals = np.concatenate([folded, [day.toordinal() for day in new_days]]).astype(np.int64)
+    written = np.concatenate([folded_written, write_times[~in_composite]]).astype(np.int64)
+    order = np.argsort(ordinals, kind='stable')
+    folded = ordinals[order]
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savez(path, hits=hits, days=folded, written=written[order])
+
+    return hits, len(folded)
+
+
+def monthly_median(product, thresh, month, folder, hemisphere, verbose=False):
+    """
+    Return the monthly median grid at the specified threshold - True where the pixel was at or above the threshold on at
+    least half of the available days in the month.  Only days not yet in the month's composite are read.
+    :param product: string - 'cdr' or 'nic'
+    :param thresh: float - sea ice concentration threshold
+    :param month: datetime - any day in the month
+    :param folder: string - folder holding the product grids
+    :param hemisphere: string - 'south' or 'north'
+    :param verbose: bool - increase verbosity
+    :return: np bool array, or None if there are no days available in the month
+    """
+    hits, day_count = update_monthly_composite(product, thresh, month, folder, hemisphere, verbose=verbose)
+    if not day_count:
+        return None
+    return hits / day_count >= MEDIAN_PERCENTAGE
+
+
+def update_threshold_masks(product, thresh, dates, folder, hemisphere):
+    """
+    Make sure the bit-packed threshold mask of every given day is in the product's mask cube and up to date,
+    thresholding only days that aren't in it yet or whose grids were written after their masks.
+    :param product: string - 'cdr' or 'nic'
+    :param thresh: float - sea ice concentration threshold
+    :param dates: iterable of datetimes with grids available
+    :param folder: string - folder holding the product grids
+    :param hemisphere: string - 'south' or 'north'
+    :return: GridCube of packed masks - unpack a day with encoding.unpack_mask
+    """
+    retrieval_func, _ = _PRODUCT_FUNCS[product]
+    mask_cube = cube.open_cube(os.path.join(folder, COMPOSITE_FOLDER),
+                               MASK_PRODUCT_FMT.format(product=product, thresh=float(thresh)), hemisphere)
+    dates = pd.DatetimeIndex(dates)
+    outdated = mask_cube.written_at(dates) < dwn.grid_write_times(dates, product, folder, hemisphere)
+    for day, day_outdated in zip(dates, outdated):
+        if day in mask_cube and not day_outdated:
+            instrument.count('threshold masks reused')
+        else:
+            grid = retrieval_func(day, folder, hemisphere)
+            mask_cube.write(day, encoding.pack_mask(compare.threshold_mask(grid, thresh)), flush=False)
+            instrument.count('threshold masks built')
+    mask_cube.flush()
+    return mask_cube
+
+
+def rolling_frequency(product, thresh, start, end, window, folder, hemisphere, verbose=False):
+    """
+    For every day from start to end (inclusive), calculate the fraction of available days in the trailing window ending
+    on that day that each pixel was at or above the threshold.  Frequencies are produced a day at a time from a running
+    sum of the masks in the window, so memory doesn't grow with the length of the range or the window.
+    :param product: string - 'cdr' or 'nic'
+    :param thresh: float - sea ice concentration threshold
+    :param start: datetime - first day to calculate
+    :param end: datetime - last day to calculate
+    :param window: int - window length in days, including the day itself
+    :param folder: string - folder holding the product grids
+    :param hemisphere: string - 'south' or 'north'
+    :param verbose: bool - increase verbosity
+    :return: (
+        pandas DatetimeIndex of the days calculated,
+        np int array of the number of available days in each window,
+        iterator of np float32 (y, x) frequencies, one per day - NaN where a window has no available days
+    )
+    :raises ValueError: if no days are available from the start of the first window to end
+    """
+    assert window >= 1
+    retrieval_func, availability_func = _PRODUCT_FUNCS[product]
+
+    dates = pd.date_range(start=start, end=end)
+    loaded_dates = pd.date_range(start=dates[0] - pd.Timedelta(days=window - 1), end=dates[-1])
+    available = availability_func(loaded_dates[0], loaded_dates[-1], folder, hemisphere)
+
+    if verbose:
+        print(f"Building {window}-day {product} frequencies from {len(available)} of {len(loaded_dates)} days")
+
+    if available.empty:
+        raise ValueError(f"No {product} days available between {loaded_dates[0]:%Y%m%d} and {loaded_dates[-1]:%Y%m%d}")
+
+    mask_cube = update_threshold_masks(product, thresh, available, folder, hemisphere)
+
+    valid = np.zeros(len(loaded_dates), dtype=np.int64)
+    valid[loaded_dates.get_indexer(available)] = 1
+    valid_sums = np.concatenate([[0], np.cumsum(valid)])
+
+    # Window i covers loaded days i to i + window - 1
+    window_counts = valid_sums[window:] - valid_sums[:-window]
+
+    shape = retrieval_func(available[0], folder, hemisphere).shape
+    return dates, window_counts, _rolling_frames(mask_cube, loaded_dates, valid, window, window_counts, shape)
+
+
+def _rolling_frames(mask_cube, loaded_dates, valid, window, window_counts, shape):
+    """
+    Yield the frequency of each window, adding the mask of the day entering the window to a running sum and
+    subtracting the mask of the day leaving it.  See rolling_frequency.
+    """
+    hits = np.zeros(shape, dtype=np.uint16 if window < np.iinfo(np.uint16).max else np.uint32)
+    for idx, day in enumerate(loaded_dates):
+        if valid[idx]:
+            hits += encoding.unpack_mask(mask_cube.get(day), shape[-1])
+        if idx >= window and valid[idx - window]:
+            hits -= encoding.unpack_mask(mask_cube.get(loaded_dates[idx - window]), shape[-1])
+        if idx >= window - 1:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                yield hits.astype(np.float32) / window_counts[idx - window + 1]
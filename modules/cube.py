@@ -0,0 +1,368 @@
+'''
+A module that holds daily grids in a single consolidated, memory-mapped (time, y, x) store per product and hemisphere.
+
+Each cube is a raw binary file of contiguous daily slots with a small JSON header alongside it.  The header records
+the dtype and grid shape, the date of the first slot, the number of slots and which slots have been written and when.
+Because the slots are contiguous in time, a single day or a range of days is a zero-copy view into the memory map.
+'''
+
+import datetime
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+CUBE_FNAME_FMT = '{hemisphere}_{product}_cube.dat'
+HEADER_FNAME_FMT = '{hemisphere}_{product}_cube.json'
+
+# Cubes opened by this process, keyed by (folder, product, hemisphere) - see open_cube
+_OPEN_CUBES = {}
+_OPEN_CUBES_LOCK = threading.Lock()
+
+
+def _to_day(date):
+    """
+    Normalize a datetime-like to a datetime.date so it can be used for slot arithmetic.
+    :param date: datetime, date, string or pandas Timestamp
+    :return: datetime.date
+    """
+    return pd.Timestamp(date).date()
+
+
+class GridCube:
+    """
+    A (time, y, x) memory-mapped store of daily grids for a single product and hemisphere.  Slots are one day apart
+    starting at the header's start date.  Only slots marked valid hold data; the rest are unwritten gaps.
+    """
+
+    def __init__(self, folder, product, hemisphere):
+        """
+        Open (or prepare to create) the cube stored in folder.  Nothing is written until the first grid is stored.
+        :param folder: string - folder holding the cube files (typically the product input folder)
+        :param product: string - product name, eg 'cdr' or 'nic'
+        :param hemisphere: string - 'south' or 'north'
+        """
+        self.folder = folder
+        self.product = product
+        self.hemisphere = hemisphere
+        self.path = os.path.join(folder, CUBE_FNAME_FMT.format(hemisphere=hemisphere, product=product))
+        self.header_path = os.path.join(folder, HEADER_FNAME_FMT.format(hemisphere=hemisphere, product=product))
+
+        self._lock = threading.RLock()
+        self._data = None
+        self.dtype = None
+        self.shape = None
+        self.start = None
+        self.days = 0
+        self.valid = np.zeros(0, dtype=bool)
+        self.written = np.zeros(0, dtype=np.int64)
+        self._header_mtime = None
+
+        self.refresh()
+
+    def refresh(self):
+        """
+        Re-read the header if another process has updated it since it was last read.
+        :return:
+        """
+        with self._lock:
+            if not os.path.exists(self.header_path):
+                return
+            mtime = os.stat(self.header_path).st_mtime_ns
+            if mtime != self._header_mtime:
+                self._read_header()
+                self._header_mtime = mtime
+
+    def _read_header(self):
+        with open(self.header_path) as header_file:
+            header = json.load(header_file)
+        self.dtype = np.dtype(header['dtype'])
+        self.shape = tuple(header['shape'])
+        self.start = datetime.date.fromisoformat(header['start'])
+        self.days = header['days']
+        self.valid = np.zeros(self.days, dtype=bool)
+        self.valid[header['valid']] = True
+        # Headers written before write times were kept have 0 (unknown) for every slot
+        self.written = np.zeros(self.days, dtype=np.int64)
+        self.written[header['valid']] = header.get('written', 0)
+        self._data = None
+
+    def _write_header(self):
+        header = {
+            'dtype': self.dtype.str,
+            'shape': list(self.shape),
+            'start': self.start.isoformat(),
+            'days': self.days,
+            'valid': np.flatnonzero(self.valid).tolist(),
+            'written': self.written[self.valid].tolist()
+        }
+        tmp_path = self.header_path + '.tmp'
+        with open(tmp_path, 'w') as header_file:
+            json.dump(header, header_file)
+        os.replace(tmp_path, self.header_path)
+        self._header_mtime = os.stat(self.header_path).st_mtime_ns
+
+    @property
+    def exists(self):
+        """
+        True if this cube has been created on disk.
+        """
+        return self.dtype is not None
+
+    @property
+    def end(self):
+        """
+        The date of the last slot in the cube (written or not), or None if the cube doesn't exist yet.
+        """
+        if not self.exists or not self.days:
+            return None
+        return self.start + datetime.timedelta(days=self.days - 1)
+
+    @property
+    def dates(self):
+        """
+        A pandas DatetimeIndex of every day that has been written to the cube.
+        """
+        if not self.exists:
+            return pd.DatetimeIndex([])
+        return pd.to_datetime(self.start) + pd.to_timedelta(np.flatnonzero(self.valid), unit='D')
+
+    @property
+    def data(self):
+        """
+        The full (time, y, x) memory map.  Opened read/write lazily and reused between calls.
+        """
+        if self._data is None and self.exists and self.days:
+            self._data = np.memmap(self.path, dtype=self.dtype, mode='r+', shape=(self.days,) + self.shape)
+        return self._data
+
+    def index(self, date):
+        """
+        Get the slot index for a date.  The index may be out of bounds of the cube.
+        :param date: datetime - date to look up
+        :return: int
+        """
+        return (_to_day(date) - self.start).days
+
+    def __contains__(self, date):
+        if not self.exists:
+            return False
+        idx = self.index(date)
+        return 0 <= idx < self.days and bool(self.valid[idx])
+
+    def reserve(self, start, end, shape, dtype, flush=True):
+        """
+        Make sure the cube has slots for every day from start to end (inclusive), creating or growing the file as
+        needed.  Growing at the end only extends the file; growing at the start rewrites it once.
+        :param start: datetime - first day that needs a slot
+        :param end: datetime - last day that needs a slot
+        :param shape: tuple of ints - shape of a single day grid
+        :param dtype: numpy dtype of the grids
+        :param flush: bool - persist the header right away when growing at the end.  Otherwise it's persisted by the
+            next flush.  Growing at the start always persists it since every slot moves.
+        :return:
+        """
+        start = _to_day(start)
+        end = _to_day(end)
+        with self._lock:
+            if not self.exists:
+                self.dtype = np.dtype(dtype)
+                self.shape = tuple(shape)
+                self.start = start
+                self.days = 0
+                os.makedirs(self.folder, exist_ok=True)
+                open(self.path, 'wb').close()
+
+            if tuple(shape) != self.shape or np.dtype(dtype) != self.dtype:
+                raise ValueError(f"Grid {shape} {np.dtype(dtype)} does not match cube {self.shape} {self.dtype} "
+                                 f"in {self.path}")
+
+            if start < self.start:
+                self._prepend((self.start - start).days)
+            if self.days == 0 or end > self.end:
+                self._extend((end - self.start).days + 1, flush=flush)
+
+    def _slot_bytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def _extend(self, days, flush=True):
+        self._data = None
+        with open(self.path, 'r+b') as cube_file:
+            cube_file.truncate(days * self._slot_bytes())
+        self.valid = np.concatenate([self.valid, np.zeros(days - self.days, dtype=bool)])
+        self.written = np.concatenate([self.written, np.zeros(days - self.days, dtype=np.int64)])
+        self.days = days
+        if flush:
+            self._write_header()
+
+    def _prepend(self, days):
+        # Data for earlier dates only comes from backfills (conversions reserve their whole range first), so just
+        # rewrite the cube with the new leading slots
+        self._data = None
+        tmp_path = self.path + '.tmp'
+        with open(self.path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            dst.truncate(days * self._slot_bytes())
+            dst.seek(0, os.SEEK_END)
+            while True:
+                block = src.read(64 * 1024 * 1024)
+                if not block:
+                    break
+                dst.write(block)
+        os.replace(tmp_path, self.path)
+        self.valid = np.concatenate([np.zeros(days, dtype=bool), self.valid])
+        self.written = np.concatenate([np.zeros(days, dtype=np.int64), self.written])
+        self.start = self.start - datetime.timedelta(days=days)
+        self.days += days
+        self._write_header()
+
+    def convert(self, dtype, convert_func, block_days=256):
+        """
+        Rewrite every slot of the cube with a new dtype (eg to migrate a cube to a new encoding), a block of days at a
+        time so the whole cube is never held in memory.
+        :param dtype: numpy dtype to store grids as
+        :param convert_func: Function converting a (days, y, x) block of grids to dtype
+        :param block_days: int - number of days converted at a time
+        :return:
+        """
+        with self._lock:
+            if not self.exists or np.dtype(dtype) == self.dtype:
+                return
+            tmp_path = self.path + '.tmp'
+            if self.days:
+                converted = np.memmap(tmp_path, dtype=dtype, mode='w+', shape=(self.days,) + self.shape)
+                for first in range(0, self.days, block_days):
+                    converted[first:first + block_days] = convert_func(self.data[first:first + block_days])
+                converted.flush()
+                del converted
+            else:
+                open(tmp_path, 'wb').close()
+            self._data = None
+            os.replace(tmp_path, self.path)
+            self.dtype = np.dtype(dtype)
+            self._write_header()
+
+    def put(self, date, grid):
+        """
+        Copy a grid into an already reserved slot without touching the header.  See mark_valid and flush.
+        :param date: datetime - date of the grid
+        :param grid: np array - grid matching the cube's shape
+        :return:
+        """
+        idx = self.index(date)
+        if not 0 <= idx < self.days:
+            raise IndexError(f"{date:%Y%m%d} is outside of {self.path} - reserve it first")
+        self.data[idx] = grid
+
+    def mark_valid(self, dates, written=None):
+        """
+        Mark slots as written.  Call flush to persist this.
+        :param dates: iterable of datetimes
+        :param written: int - when the slots' grids were written (ns since the epoch), eg to keep the write time of a
+            grid imported from elsewhere.  Now if None.
+        :return:
+        """
+        with self._lock:
+            if written is None:
+                written = time.time_ns()
+            for date in dates:
+                self.valid[self.index(date)] = True
+                self.written[self.index(date)] = written
+
+    def flush(self):
+        """
+        Flush grid data to disk and persist the header.
+        :return:
+        """
+        with self._lock:
+            if self._data is not None:
+                self._data.flush()
+            if self.exists:
+                self._write_header()
+
+    def write(self, date, grid, flush=True):
+        """
+        Store a single day's grid, growing the cube as needed.
+        :param date: datetime - date of the grid
+        :param grid: np array - grid to store
+        :param flush: bool - persist the header right away
+        :return:
+        """
+        with self._lock:
+            self.reserve(date, date, grid.shape, grid.dtype, flush=flush)
+            self.put(date, grid)
+            self.mark_valid([date])
+            if flush:
+                self.flush()
+
+    def get(self, date):
+        """
+        Get a zero-copy, read-only view of a single day's grid.
+        :param date: datetime - date to load
+        :return: np memmap view of shape (y, x)
+        """
+        if date not in self:
+            raise KeyError(f"{date:%Y%m%d} is not in {self.path}")
+        return self._read_only(self.data[self.index(date)])
+
+    def get_range(self, start, end):
+        """
+        Get a zero-copy, read-only view of all slots from start to end (inclusive), clipped to the extent of the cube.
+        :param start: datetime - first day
+        :param end: datetime - last day
+        :return: (
+            pandas DatetimeIndex of the slots returned,
+            np memmap view of shape (days, y, x) - None if the cube doesn't exist yet,
+            bool array - which of those slots hold data
+        )
+        """
+        if not self.exists:
+            return pd.DatetimeIndex([]), None, np.zeros(0, dtype=bool)
+        first = max(self.index(start), 0)
+        last = min(self.index(end), self.days - 1)
+        if last < first:
+            return pd.DatetimeIndex([]), self._read_only(self.data[0:0]), np.zeros(0, dtype=bool)
+        dates = pd.date_range(start=self.start + datetime.timedelta(days=first), periods=last - first + 1)
+        return dates, self._read_only(self.data[first:last + 1]), self.valid[first:last + 1].copy()
+
+    def written_at(self, dates):
+        """
+        Get when each day's slot was last written, eg to tell whether a grid changed since it was last read without
+        loading it.
+        :param dates: pandas DatetimeIndex - days to look up
+        :return: np int64 array - nanoseconds since the epoch, 0 for days that aren't in the cube (or were written
+            before write times were kept)
+        """
+        written = np.zeros(len(dates), dtype=np.int64)
+        if not self.exists or not len(dates):
+            return written
+        idx = np.asarray((dates - pd.Timestamp(self.start)).days)
+        inside = (idx >= 0) & (idx < self.days)
+        written[inside] = np.where(self.valid[idx[inside]], self.written[idx[inside]], 0)
+        return written
+
+    @staticmethod
+    def _read_only(view):
+        # The memory map is opened read/write for put - don't let readers modify the cube through a view
+        view.flags.writeable = False
+        return view
+
+
+def open_cube(folder, product, hemisphere):
+    """
+    Get the GridCube for a folder, product and hemisphere.  Cubes are cached per process so readers and writers
+    share one memory map; the header is re-read if another process changed it.
+    :param folder: string - folder holding the cube files
+    :param product: string - 'cdr' or 'nic'
+    :param hemisphere: string - 'south' or 'north'
+    :return: GridCube
+    """
+    key = (os.path.abspath(folder), product, hemisphere)
+    with _OPEN_CUBES_LOCK:
+        if key not in _OPEN_CUBES:
+            _OPEN_CUBES[key] = GridCube(folder, product, hemisphere)
+        else:
+            _OPEN_CUBES[key].refresh()
+        return _OPEN_CUBES[key]
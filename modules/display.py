@@ -5,11 +5,15 @@ A module that contains functions to display MIZ data.
 import glob
 import os
 import pathlib
+import re
+import subprocess
+import tempfile
+import threading
 
+import matplotlib
 from matplotlib import colors
 import matplotlib.image as mplimg
 import matplotlib.pyplot as plt
-from matplotlib import animation
 from mpl_toolkits.basemap import Basemap
 import numpy as np
 
@@ -19,16 +23,27 @@ NIC_COLOR = 'blue'
 CDR_COLOR = 'red'
 ALPHA = .5
 
+# Default animation frame rate - one frame every 100 ms
+ANIMATION_FPS = 10
+
+# pyplot isn't thread safe - renderers used from more than one thread (eg both hemispheres rendering in the main
+# process) draw one at a time
+_PYPLOT_LOCK = threading.RLock()
+
 
 def create_basemap_plot(title, lats, lons, meta, grids, save=None, show=True, legend=True):
     """
-    Create a basemap plot of either the southern hemisphere or northern hemisphere with the provided grid(s) overlayed
+    Create a basemap plot of either the southern hemisphere or northern hemisphere with the provided grid(s) overlayed.
+    To plot many days on the same grid, use a BasemapRenderer (see get_renderer) so the basemap is only built once.
     :param title: str - Title for the plot
     :param lats: np array - Latitude values associated with the data
     :param lons: np array - Longitude values associated with the data
     :param meta: Projection information from the CDR NetCDF
     :param grids: list of dictionaries - {
             'color' - the color of the plotted data.  If no color specified, then a plt.cm.Blues cmap applied.
+            'cmap' - optional, the name of the cmap applied when no color is specified.
+            'colorbar_label' - optional, the colorbar label when no color is specified.  Sea Ice Concentration if
+                not specified.
             'grid' - the numpy array to plot.  Must match dimensions of lats/lons.
             'legend_label' - The label for the plot legend for this dataset.  Ignored if legend keyword is False.
         }
@@ -37,91 +52,298 @@ def create_basemap_plot(title, lats, lons, meta, grids, save=None, show=True, le
     :param legend: bool - Include a legend.  Legend information must also be in the grid dictionary.
     :return:
     """
-    fig, axis = plt.subplots(dpi=FIG_DPI, figsize=(7, 7))
-
-    height = meta.grid_boundary_top_projected_y - meta.grid_boundary_bottom_projected_y
-    width = meta.grid_boundary_right_projected_x - meta.grid_boundary_left_projected_x
-
-    # I don't understand why basemap isn't respecting the bounding lat.  Data is cut off in the
-    # north if we don't adjust the standard parallel.
-    standard_parallel = 20 if meta.standard_parallel == 70 else meta.standard_parallel
-
-    bmap = Basemap(
-        ax=axis,
-        projection='stere',
-        lat_0=meta.latitude_of_projection_origin,
-        lat_ts=standard_parallel,
-        lon_0=meta.longitude_of_projection_origin,
-        resolution='i',
-        round=True,
-        height=height,
-        width=width
-    )
-
-    bmap.drawcoastlines(linewidth=.25)
-    bmap.drawmeridians(np.arange(0, 360, 30), linewidth=.1)
-    bmap.drawparallels(np.arange(-90, 90, 10), linewidth=.1)
-    x_coord, y_coord = bmap(lons, lats)
-    for grid in grids:
-        if 'color' in grid.keys():
-            cmap = colors.ListedColormap(grid['color'])
-            cmap.set_bad(alpha=0)
+    renderer = BasemapRenderer(lats, lons, meta)
+    try:
+        renderer.plot(title, grids, save=save, show=show, legend=legend)
+    finally:
+        renderer.close()
+
+
+class BasemapRenderer:
+    """
+    Renders basemap plots of one hemisphere onto reusable figures.  The projection and projected extent are built once,
+    and a figure with the coastlines, meridians, parallels, legend or colorbar is drawn once per set of layers (colors,
+    labels and legend).  Each plot then only swaps the image data and title before saving.
+    """
+
+    def __init__(self, lats, lons, meta):
+        """
+        :param lats: np array - Latitude values associated with the data
+        :param lons: np array - Longitude values associated with the data
+        :param meta: Projection information from the CDR NetCDF
+        """
+        height = meta.grid_boundary_top_projected_y - meta.grid_boundary_bottom_projected_y
+        width = meta.grid_boundary_right_projected_x - meta.grid_boundary_left_projected_x
+
+        # I don't understand why basemap isn't respecting the bounding lat.  Data is cut off in the
+        # north if we don't adjust the standard parallel.
+        standard_parallel = 20 if meta.standard_parallel == 70 else meta.standard_parallel
+
+        self.bmap = Basemap(
+            projection='stere',
+            lat_0=meta.latitude_of_projection_origin,
+            lat_ts=standard_parallel,
+            lon_0=meta.longitude_of_projection_origin,
+            resolution='i',
+            round=True,
+            height=height,
+            width=width
+        )
+
+        x_coord, y_coord = self.bmap(lons, lats)
+        self.extent = (x_coord.min(), x_coord.max(), y_coord.min(), y_coord.max())
+
+        # (figure, axis, images) keyed by layers - see plot
+        self._figures = {}
+
+    def _new_figure(self, grids, legend):
+        """
+        Draw a figure with the basemap, an image per grid and the legend or colorbar.
+        :return: (figure, axis, list of images)
+        """
+        fig, axis = plt.subplots(dpi=FIG_DPI, figsize=(7, 7))
+
+        self.bmap.drawcoastlines(linewidth=.25, ax=axis)
+        self.bmap.drawmeridians(np.arange(0, 360, 30), linewidth=.1, ax=axis)
+        self.bmap.drawparallels(np.arange(-90, 90, 10), linewidth=.1, ax=axis)
+
+        images = []
+        for grid in grids:
+            if 'color' in grid.keys():
+                cmap = colors.ListedColormap(grid['color'])
+                cmap.set_bad(alpha=0)
+            else:
+                # Choose a good cmap for ice
+                cmap = plt.get_cmap(grid.get('cmap', 'Blues'))
+
+            images.append(axis.imshow(np.ma.masked_where(grid['grid'] <= 0, grid['grid']),
+                                      cmap=cmap,
+                                      vmin=0,
+                                      vmax=1,
+                                      alpha=ALPHA,
+                                      extent=self.extent))
+        if 'color' in grids[0].keys() and legend:
+            axis.legend([plt.Rectangle((0, 0), 1, .1, fc=grid['color'], alpha=.5) for grid in grids],
+                        [grid['legend_label'] for grid in grids], loc='lower left', ncol=2)
         else:
-            # Choose a good cmap for ice
-            cmap = plt.cm.Blues
+            cbar = fig.colorbar(images[-1], ax=axis)
+            cbar.set_label(grids[-1].get('colorbar_label', 'Sea Ice Concentration'))
+
+        return fig, axis, images
 
-        plt.imshow(np.ma.masked_where(grid['grid'] <= 0, grid['grid']),
-                   cmap=cmap,
-                   vmin=0,
-                   vmax=1,
-                   alpha=ALPHA,
-                   extent=(x_coord.min(), x_coord.max(), y_coord.min(), y_coord.max()))
-    if 'color' in grids[0].keys() and legend:
-        plt.legend([plt.Rectangle((0, 0), 1, .1, fc=grid['color'], alpha=.5) for grid in grids],
-                   [grid['legend_label'] for grid in grids], loc='lower left', ncol=2)
-    else:
-        cbar = plt.colorbar()
-        cbar.set_label('Sea Ice Concentration')
+    def _draw(self, title, grids, legend):
+        """
+        Put grids and a title on the figure for their layers.
+        :return: figure
+        """
+        layers = tuple((grid.get('color'), grid.get('cmap'), grid.get('legend_label'), grid.get('colorbar_label'))
+                       for grid in grids) + (legend,)
+        if layers in self._figures:
+            fig, axis, images = self._figures[layers]
+            for image, grid in zip(images, grids):
+                image.set_data(np.ma.masked_where(grid['grid'] <= 0, grid['grid']))
+        else:
+            fig, axis, images = self._figures[layers] = self._new_figure(grids, legend)
 
-    axis.set_title(title)
+        axis.set_title(title)
+        return fig
 
-    if save is not None:
-        os.makedirs(os.path.dirname(save), exist_ok=True)
-        plt.savefig(save, dpi=500)
+    def plot(self, title, grids, save=None, show=False, legend=True):
+        """
+        Plot grids on the basemap.  See create_basemap_plot for the arguments.
+        :return:
+        """
+        with _PYPLOT_LOCK:
+            fig = self._draw(title, grids, legend)
 
-    if show:
-        plt.show()
+            if save is not None:
+                os.makedirs(os.path.dirname(save), exist_ok=True)
+                fig.savefig(save, dpi=500)
 
-    plt.close(fig)
+            if show:
+                plt.show()
 
+    def frame(self, title, grids, legend=True, width=None):
+        """
+        Render grids on the basemap to an RGB pixel array in memory instead of a file, eg to stream to an FfmpegWriter.
+        :param title: str - Title for the plot
+        :param grids: list of dictionaries - see create_basemap_plot
+        :param legend: bool - Include a legend
+        :param width: int - approximate frame width in pixels.  Rendered at FIG_DPI if None.
+        :return: np uint8 array (height, width, 3)
+        """
+        with _PYPLOT_LOCK:
+            fig = self._draw(title, grids, legend)
+            dpi = fig.get_dpi()
+            if width:
+                fig.set_dpi(width / fig.get_figwidth())
+            try:
+                fig.canvas.draw()
+                return np.array(fig.canvas.buffer_rgba())[..., :3]
+            finally:
+                fig.set_dpi(dpi)
 
-def images_to_animation(image_folder, save_path):
-    '''
-    Convert images to animation.  Animation will be created by globbing all .png files in folder
-    :param folder: Folder to glob images from
+    def close(self):
+        """
+        Close the renderer's figures.
+        :return:
+        """
+        with _PYPLOT_LOCK:
+            for fig, _, _ in self._figures.values():
+                plt.close(fig)
+            self._figures = {}
+
+
+def use_agg_backend():
+    """
+    Switch pyplot to the non-interactive Agg backend, eg in worker processes that only save plots.  Switching closes
+    every open figure, so it waits for any renderer drawing in another thread - call it before starting threads that
+    render so their cached figures aren't closed between draws.
     :return:
-    '''
+    """
+    with _PYPLOT_LOCK:
+        if plt.get_backend().lower() != 'agg':
+            plt.switch_backend('Agg')
+
+
+# Renderers built by this process, keyed by projection - see get_renderer
+_RENDERERS = {}
 
-    files = glob.glob(os.path.join(image_folder, "*.png"))
-    if not files:
-        raise ValueError(f"Couldn't find any png files in {image_folder}")
 
-    fig, ax = plt.subplots(dpi=FIG_DPI)
-    plt.axis('off')
+def get_renderer(lats, lons, meta):
+    """
+    Get the BasemapRenderer for a hemisphere, building it the first time it's needed in this process.
+    :param lats: np array - Latitude values associated with the data
+    :param lons: np array - Longitude values associated with the data
+    :param meta: Projection information from the CDR NetCDF
+    :return: BasemapRenderer
+    """
+    key = (meta.proj4text, meta.GeoTransform, np.shape(lats))
+    with _PYPLOT_LOCK:
+        if key not in _RENDERERS:
+            _RENDERERS[key] = BasemapRenderer(lats, lons, meta)
+        return _RENDERERS[key]
+
+
+class FfmpegWriter:
+    """
+    Encodes frames to a video by piping raw RGB pixels straight to ffmpeg, so no intermediate images are written or
+    re-rendered.  ffmpeg is started with the size of the first frame; every frame must be the same size.
+    """
+
+    def __init__(self, save_path, fps=ANIMATION_FPS, width=None):
+        """
+        :param save_path: str - path of the video to write, eg an .mp4 file
+        :param fps: float - frames per second
+        :param width: int - width of the video in pixels, with the height scaled to keep the aspect ratio.  The frames'
+            width if None.
+        """
+        self.save_path = save_path
+        self.fps = fps
+        self.width = width
+        self.frames = 0
+        self._shape = None
+        self._process = None
+        self._stderr = None
+
+    def _start(self, shape):
+        # yuv420p, which most players need, requires even dimensions
+        scale = f"scale={self.width}:-2" if self.width else "scale=trunc(iw/2)*2:trunc(ih/2)*2"
+        command = [matplotlib.rcParams['animation.ffmpeg_path'], '-y', '-loglevel', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{shape[1]}x{shape[0]}', '-r', str(self.fps),
+                   '-i', '-',
+                   '-vf', scale, '-c:v', 'libx264', '-pix_fmt', 'yuv420p', self.save_path]
 
-    img = mplimg.imread(files[0])
-    imshow = ax.imshow(img, aspect='equal')
+        # Make sure our save path exists
+        pathlib.Path(os.path.dirname(self.save_path)).mkdir(parents=True, exist_ok=True)
+        # ffmpeg's errors go to a file rather than a pipe, so a chatty ffmpeg can't block on a full pipe
+        self._stderr = tempfile.TemporaryFile()
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=self._stderr)
+        self._shape = shape
 
-    def animate(i):
-        img = mplimg.imread(files[i])
-        imshow.set_data(img)
+    def write(self, frame):
+        """
+        Append a frame to the video.
+        :param frame: np uint8 array (height, width, 3)
+        :return:
+        """
+        if self._process is None:
+            self._start(frame.shape)
+        if frame.shape != self._shape:
+            raise ValueError(f"Frame of shape {frame.shape} doesn't match the video's {self._shape}")
+        try:
+            self._process.stdin.write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+        except BrokenPipeError:
+            # ffmpeg exited early - close reports why
+            self.close()
+            raise
+        self.frames += 1
 
-    ani = animation.FuncAnimation(fig, animate, len(files), interval=100)
+    def close(self):
+        """
+        Finish encoding the video.  Nothing is written if no frames were.
+        :return:
+        :raises RuntimeError: with ffmpeg's error output if ffmpeg failed, after removing the partial video
+        """
+        if self._process is None:
+            return
+        process, self._process = self._process, None
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = process.wait()
+        self._stderr.seek(0)
+        errors = self._stderr.read().decode(errors='replace').strip()
+        self._stderr.close()
+        if returncode:
+            if os.path.exists(self.save_path):
+                os.remove(self.save_path)
+            raise RuntimeError(f"ffmpeg failed with exit code {returncode} writing {self.save_path}"
+                               + (f":\n{errors}" if errors else ""))
+
+
+def _frame_sort_key(path):
+    """
+    Sort images by the first date (YYYYmmdd) in their file name, then by name.
+    """
+    name = os.path.basename(path)
+    match = re.search(r'(?<!\d)(\d{8})(?!\d)', name)
+    return (match.group(1) if match else '', name)
+
+
+def _image_to_rgb24(img):
+    """
+    Convert an image read by matplotlib (float 0-1 or uint8, grayscale, RGB or RGBA) to uint8 RGB.
+    """
+    if img.dtype != np.uint8:
+        img = np.rint(np.clip(img, 0, 1) * 255).astype(np.uint8)
+    if img.ndim == 2:
+        img = np.stack([img] * 3, axis=-1)
+    return img[..., :3]
+
+
+def images_to_animation(image_folder, save_path, fps=ANIMATION_FPS, width=None):
+    '''
+    Convert images to animation.  Animation will be created from all .png files in folder, ordered by the date in their
+    file names.  Each image is decoded once and streamed to ffmpeg - see FfmpegWriter.
+    :param image_folder: Folder to glob images from
+    :param save_path: Path of the video to write
+    :param fps: Frames per second
+    :param width: Width of the video in pixels.  The images' width if None.
+    :return:
+    '''
+
+    files = sorted(glob.glob(os.path.join(image_folder, "*.png")), key=_frame_sort_key)
+    if not files:
+        raise ValueError(f"Couldn't find any png files in {image_folder}")
 
-    # Make sure our save path exists
-    pathlib.Path(os.path.dirname(save_path)).mkdir(parents=True, exist_ok=True)
-    ani.save(save_path)
-    plt.clf()
+    writer = FfmpegWriter(save_path, fps=fps, width=width)
+    try:
+        for fname in files:
+            writer.write(_image_to_rgb24(mplimg.imread(fname)))
+    finally:
+        writer.close()
 
 
 def plot_hist(data):
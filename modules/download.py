@@ -3,9 +3,13 @@ A module to assist in the downloading of MIZ files and loading into memory (eg p
 """
 
 import datetime
+import hashlib
+import json
 import os
 from pathlib import Path
-import urllib.request
+import re
+import time
+import types
 
 from joblib import Parallel, delayed
 import geopandas as gpd
@@ -15,6 +19,54 @@ import pandas as pd
 import rasterio
 import rasterio.features
 
+from . import availability
+from . import catalog
+from . import cube
+from . import encoding
+from . import instrument
+from . import transfer
+
+# Grids are stored as percent codes - see the encoding module
+GRID_ENCODINGS = {
+    'cdr': (encoding.CDR_DTYPE, encoding.encode_cdr),
+    'nic': (encoding.NIC_DTYPE, encoding.encode_nic),
+}
+
+# Each product's daily concentration histograms are kept in their own cube next to its grid cube - see the summary
+# module.  Grids have far fewer than 2 ** 32 cells.
+HISTOGRAM_PRODUCT_FMT = '{product}_histogram'
+HISTOGRAM_DTYPE = np.dtype(np.uint32)
+
+# NIC icecodes are rasterized straight to percent codes, with encoding.NIC_FILL where there is no NIC data
+NIC_ICECODE_MAPPING = {
+    "CT18": 18,
+    "CT81": 80
+}
+
+# The attributes of the CDR netCDF projection variable used to rasterize NIC data and plot grids
+PROJECTION_ATTRS = (
+    'proj4text',
+    'GeoTransform',
+    'grid_boundary_top_projected_y',
+    'grid_boundary_bottom_projected_y',
+    'grid_boundary_left_projected_x',
+    'grid_boundary_right_projected_x',
+    'standard_parallel',
+    'latitude_of_projection_origin',
+    'longitude_of_projection_origin',
+)
+
+# The CDR latitudes, longitudes and projection attributes are cached per hemisphere in the CDR input folder - see
+# cdr_metadata
+METADATA_FOLDER = '.metadata'
+METADATA_FNAME_FMT = '{hemisphere}_cdr_metadata'
+METADATA_VERSION = 1
+
+# NIC shapefiles reprojected to the CDR grid's projection are cached in the NIC input folder, keyed by a digest of the
+# source file and of the projection - see reprojected_nic_shapes
+GEOMETRY_CACHE_FOLDER = '.geometries'
+GEOMETRY_CACHE_FNAME_FMT = '{source}_{crs}.feather'
+
 
 def check_hemisphere(hemisphere):
     """
@@ -27,8 +79,9 @@ def check_hemisphere(hemisphere):
 
 def cdr_to_np(start, end, cdr_input_folder, clobber=False, hemisphere='south', verbose=False):
     """
-    Converts CDR netCDF input files to intermediate Numpy arrays saved to disk.  Uses joblib with a threading backend
-    and runs concurrently based on the number of CPUs available.
+    Converts CDR netCDF input files into the consolidated CDR grid cube on disk, storing each converted day's histogram
+    too (see store_histograms).  Uses joblib with a threading backend and runs concurrently based on the number of CPUs
+    available.
     :param start: datetime - start date to convert netcdf to numpy array
     :param end: datetime - end date to convert netcdf to numpy array
     :param cdr_input_folder: string - input folder to pull CDR netcdfs from
@@ -38,10 +91,107 @@ def cdr_to_np(start, end, cdr_input_folder, clobber=False, hemisphere='south', v
     :return:
     """
     check_hemisphere(hemisphere)
-    analyzed_dates = pd.date_range(start=start, end=end)
-    Parallel(n_jobs=-1, backend='threading')(delayed(_cdr_to_np_grid)
-                                             (date, cdr_input_folder, hemisphere, clobber, verbose)
-                                             for date in analyzed_dates)
+    if not os.path.isdir(cdr_input_folder):
+        return
+    index = cdr_availability(cdr_input_folder, hemisphere)
+    if verbose and index.gaps(start, end, kind='raw').size:
+        print(f"No cdr files to convert for {availability.describe_gaps(index.gaps(start, end, kind='raw'))}")
+    analyzed_dates = _convertible_dates(index, start, end)
+    if analyzed_dates.empty:
+        return
+    cdr_cube = _reserved_cube(cdr_input_folder, 'cdr', hemisphere, analyzed_dates[0], analyzed_dates[-1],
+                              shape=_cdr_grid_shape(cdr_input_folder, hemisphere, verbose))
+    histograms = Parallel(n_jobs=-1, backend='threading')(delayed(_cdr_to_np_grid)
+                                                          (date, cdr_input_folder, hemisphere, clobber, verbose)
+                                                          for date in analyzed_dates)
+    cdr_cube.flush()
+    store_histograms(cdr_input_folder, 'cdr', hemisphere, {date: histogram for date, histogram
+                                                           in zip(analyzed_dates, histograms) if histogram is not None})
+
+
+def _reserved_cube(folder, product, hemisphere, start, end, shape=None):
+    """
+    Open a product's grid cube and grow it once to cover start to end so concurrent conversions don't each have to
+    grow it.  Cubes written before grids were encoded are re-encoded first.
+    :param folder: string - folder holding the cube
+    :param product: string - 'cdr' or 'nic'
+    :param hemisphere: string - 'south' or 'north'
+    :param start: datetime - first day to be converted
+    :param end: datetime - last day to be converted
+    :param shape: tuple of ints - shape of a single day grid, used to create the cube if it doesn't exist yet.  If None,
+        a missing cube is left to be created as grids are written.
+    :return: GridCube
+    """
+    grid_cube = _encoded_cube(folder, product, hemisphere)
+    if grid_cube.exists:
+        grid_cube.reserve(start, end, grid_cube.shape, grid_cube.dtype, flush=False)
+    elif shape is not None:
+        grid_cube.reserve(start, end, shape, GRID_ENCODINGS[product][0], flush=False)
+    grid_cube.flush()
+    return grid_cube
+
+
+def _cdr_grid_shape(cdr_input_folder, hemisphere, verbose=False):
+    """
+    Get the shape of a CDR grid from the CDR metadata.
+    :param cdr_input_folder: string - CDR input folder
+    :param hemisphere: str - hemisphere - either north for the arctic or south for antarctica
+    :param verbose: bool - increase verbosity
+    :return: tuple of ints, or None if there is no readable CDR file to read it from (eg only per-day .npy grids)
+    """
+    try:
+        lats, _, _ = cdr_metadata(cdr_input_folder, hemisphere, verbose=verbose)
+    except OSError:
+        return None
+    return lats.shape
+
+
+def _encoded_cube(folder, product, hemisphere):
+    """
+    Open a product's grid cube, migrating it to the product's encoding if it was written with float grids.
+    :param folder: string - folder holding the cube
+    :param product: string - 'cdr' or 'nic'
+    :param hemisphere: string - 'south' or 'north'
+    :return: GridCube
+    """
+    dtype, encode_func = GRID_ENCODINGS[product]
+    grid_cube = cube.open_cube(folder, product, hemisphere)
+    if grid_cube.exists and grid_cube.dtype != dtype:
+        grid_cube.convert(dtype, encode_func)
+    return grid_cube
+
+
+def histogram_cube(folder, product, hemisphere):
+    """
+    Get the cube of daily concentration histograms for a product.
+    :param folder: string - product input folder
+    :param product: string - 'cdr' or 'nic'
+    :param hemisphere: string - 'south' or 'north'
+    :return: cube.GridCube
+    """
+    return cube.open_cube(folder, HISTOGRAM_PRODUCT_FMT.format(product=product), hemisphere)
+
+
+def store_histograms(folder, product, hemisphere, histograms):
+    """
+    Store the concentration histograms of grids that were just written, marking them as written after their grids so
+    they're up to date.
+    :param folder: string - product input folder
+    :param product: string - 'cdr' or 'nic'
+    :param hemisphere: string - 'south' or 'north'
+    :param histograms: dict of np int arrays of length encoding.CONCENTRATION_BINS, keyed by date
+    :return:
+    """
+    if not histograms:
+        return
+    dates = sorted(histograms)
+    histogram_store = histogram_cube(folder, product, hemisphere)
+    histogram_store.reserve(dates[0], dates[-1], (encoding.CONCENTRATION_BINS,), HISTOGRAM_DTYPE, flush=False)
+    for date in dates:
+        histogram_store.put(date, histograms[date])
+    histogram_store.mark_valid(dates)
+    histogram_store.flush()
+    instrument.count(f'{product} histograms built', len(dates))
 
 
 def datetime_to_cdr_fname(date, hemisphere):
@@ -78,6 +228,30 @@ def datetime_to_nic_fname(date, hemisphere):
     return ftp_dir, ftp_file
 
 
+def cdr_fname_pattern(date, hemisphere):
+    """
+    Generate a regular expression matching any platform or version variant of a day's CDR file name.
+    :param date: datetime - desired datetime for file
+    :param hemisphere: string - 'south' or 'north' - hemisphere to generate the pattern for
+    :return: compiled regular expression
+    """
+    check_hemisphere(hemisphere)
+    hemisphere_letter = hemisphere[0]  # "n" for north, "s" for south
+    return re.compile(rf"^seaice_conc_daily_(icdr_)?{hemisphere_letter}h_[a-z0-9]+_{date:%Y%m%d}_v\d+r\d+\.nc$")
+
+
+def nic_fname_pattern(date, hemisphere):
+    """
+    Generate a regular expression matching any variant of a day's NIC file name.
+    :param date: datetime - desired datetime for file
+    :param hemisphere: string - 'south' or 'north' - hemisphere to generate the pattern for
+    :return: compiled regular expression
+    """
+    check_hemisphere(hemisphere)
+    hemisphere_letter = hemisphere[0]  # "n" for north, "s" for south
+    return re.compile(rf"^nic_miz{date:%Y%j}{hemisphere_letter}c_pl_[a-z]\.zip$")
+
+
 def datetime_to_cdr_fname_grid(date, hemisphere):
     """
     Generate a numpy grid filename given the datetime hemisphere.  This grid is used to speed up access to this data.
@@ -100,215 +274,694 @@ def datetime_to_nic_fname_grid(date, hemisphere):
     return f'{date:%Y%m%d}_{hemisphere}_nic.npy'
 
 
-def download_range(sftp_formatter, start, end, local_dir, hemisphere='south', no_clobber=True, verbose=False):
+def download_range(sftp_formatter, start, end, local_dir, hemisphere='south', no_clobber=True, verbose=False, n_jobs=4,
+                   retries=3, name_pattern=None, catalog_ttl=catalog.DEFAULT_TTL, dates=None, executor=None):
     """
-    Download a temporal range of data for a MIZ product
+    Download a temporal range of data for a MIZ product.  Files are downloaded concurrently, reusing FTP connections,
+    retrying with backoff and resuming partial downloads - see transfer.download_many.  If a name pattern is provided,
+    only files listed in the remote catalog are requested - see catalog.plan_downloads.
     :param sftp_formatter: Formatter function that returns the sftp directory and file names as tuples when provided a
      date and hemisphere
+    :param name_pattern: Function that returns a regular expression matching a day's file name variants when provided
+     a date and hemisphere.  If None, every day's formatter file name is requested.
     :param start: datetime - start time for period downloaded
     :param end: datetime - end time for period downloaded
     :param local_dir: str - Local directory to save files
     :param hemisphere: str - hemisphere - either north for the arctic or south for antarctica
     :param no_clobber: bool - Don't clobber files that already exist (existence based on matching filename)
     :param verbose: bool - Add additional output
-    :return:
+    :param n_jobs: int - maximum number of concurrent downloads
+    :param retries: int - number of retries per file after the first attempt
+    :param catalog_ttl: float - seconds a cached remote directory listing stays fresh
+    :param dates: iterable of datetimes - only download these days rather than every day from start to end
+    :param executor: concurrent.futures.Executor - runs the transfers, eg shared with other downloads.  A pool of
+        n_jobs workers is used if None.
+    :return: dict - download summary, see transfer.download_many
     """
     check_hemisphere(hemisphere)
+    download_dates = pd.date_range(start=start, end=end) if dates is None else pd.DatetimeIndex(dates)
 
     # Make directory if it doesn't exist
     Path(local_dir).mkdir(parents=True, exist_ok=True)
 
-    for download_date in pd.date_range(start=start, end=end):
+    if name_pattern is not None:
+        transfers, _ = catalog.plan_downloads(sftp_formatter, name_pattern, download_dates, local_dir, hemisphere,
+                                              no_clobber=no_clobber, ttl=catalog_ttl, verbose=verbose)
+        return _download_many(transfers, n_jobs, retries, verbose, executor)
+
+    transfers = []
+    for download_date in download_dates:
         ftp_dir, ftp_file = sftp_formatter(download_date, hemisphere)
         ftp_full = ftp_dir + ftp_file
         file_full = os.path.join(local_dir, ftp_file)
 
-        try:
-            if no_clobber and os.path.exists(file_full):
-                # No clobber is specified and we already have a file
-                if verbose:
-                    print("Skipping %s - already exists" % ftp_full)
-                continue
-
-            if verbose:
-                print("Downloading %s" % ftp_full)
-            urllib.request.urlretrieve(ftp_full, file_full)
-        except Exception as exc:
+        if no_clobber and os.path.exists(file_full):
+            # No clobber is specified and we already have a file
             if verbose:
-                print(f"Could not download {ftp_full} to {file_full} for some reason; {exc}")
+                print("Skipping %s - already exists" % ftp_full)
+            instrument.count('files already downloaded')
+            continue
+
+        transfers.append((ftp_full, file_full))
+
+    return _download_many(transfers, n_jobs, retries, verbose, executor)
+
+
+def _download_many(transfers, n_jobs, retries, verbose, executor=None):
+    """
+    Run planned transfers and count what was downloaded.
+    :return: dict - download summary, see transfer.download_many
+    """
+    summary = transfer.download_many(transfers, n_jobs=n_jobs, retries=retries, verbose=verbose, executor=executor)
+    instrument.count('files downloaded', summary['files'])
+    instrument.count('bytes downloaded', summary['bytes'])
+    instrument.count('download failures', len(summary['failed']))
+    return summary
 
 
 def download_cdr_miz_range(*args, **kwargs):
     """
-    Downloads a temporal range of CDR data.  See datetime_to_cdr_fname for args and kwargs.
-    :param args: Shares with datetime_to_cdr_fname
-    :param kwargs: Shares with datetime_to_cdr_fname
-    :return:
+    Downloads a temporal range of CDR data, planned from the remote catalog.  See download_range for args and kwargs.
+    :param args: Shares with download_range
+    :param kwargs: Shares with download_range
+    :return: dict - download summary, see transfer.download_many
     """
-    download_range(datetime_to_cdr_fname, *args, **kwargs)
+    kwargs.setdefault('name_pattern', cdr_fname_pattern)
+    return download_range(datetime_to_cdr_fname, *args, **kwargs)
 
 
 def download_nic_miz_range(*args, **kwargs):
     """
-    Downloads a temporal range of NIC data.  See datetime_to_nic_fname for args and kwargs.
-    :param args: Shares with datetime_to_nic_fname
-    :param kwargs: Shares with datetime_to_nic_fname
-    :return:
+    Downloads a temporal range of NIC data, planned from the remote catalog.  See download_range for args and kwargs.
+    :param args: Shares with download_range
+    :param kwargs: Shares with download_range
+    :return: dict - download summary, see transfer.download_many
     """
-    download_range(datetime_to_nic_fname, *args, **kwargs)
+    kwargs.setdefault('name_pattern', nic_fname_pattern)
+    return download_range(datetime_to_nic_fname, *args, **kwargs)
 
 
 def get_nic(date, dirname, hemisphere):
     """
-    Loads an NIC array stored on disk to a numpy array in memory.
+    Loads an NIC grid for a day as percent codes (see the encoding module).  Grids in the NIC cube are
+    returned as zero-copy views; grids only available as per-day .npy files are loaded from disk and encoded.
     :param date: datetime - datetime to load
     :param dirname: string - Directory to search for files
     :param hemisphere: str - hemisphere - either north for the arctic or south for antarctica
     :return:
     """
-    check_hemisphere(hemisphere)
-    fname = datetime_to_nic_fname_grid(date, hemisphere)
-    full_fname = os.path.join(dirname, fname)
-    return np.load(full_fname)
+    return _get_grid('nic', datetime_to_nic_fname_grid, date, dirname, hemisphere)
 
 
 def get_cdr(date, dirname, hemisphere):
     """
-    Loads a CDR numpy array stored on disk to a numpy array in memory.
+    Loads a CDR grid for a day as percent codes (see the encoding module).  Grids in the CDR cube are
+    returned as zero-copy views; grids only available as per-day .npy files are loaded from disk and encoded.
+    :param date: datetime - datetime to load
+    :param dirname: string - Directory to search for files
+    :param hemisphere: str - hemisphere - either north for the arctic or south for antarctica
+    :return:
+    """
+    return _get_grid('cdr', datetime_to_cdr_fname_grid, date, dirname, hemisphere)
+
+
+def get_nic_range(start, end, dirname, hemisphere):
+    """
+    Loads all NIC grids from start to end (inclusive) as a single zero-copy view of the NIC cube.
+    :param start: datetime - first day to load
+    :param end: datetime - last day to load
+    :param dirname: string - Directory holding the NIC cube
+    :param hemisphere: str - hemisphere - either north for the arctic or south for antarctica
+    :return: (dates, (days, y, x) percent code view, bool array of which days hold data) - see GridCube.get_range
+    """
+    check_hemisphere(hemisphere)
+    return _encoded_cube(dirname, 'nic', hemisphere).get_range(start, end)
+
+
+def get_cdr_range(start, end, dirname, hemisphere):
+    """
+    Loads all CDR grids from start to end (inclusive) as a single zero-copy view of the CDR cube.
+    :param start: datetime - first day to load
+    :param end: datetime - last day to load
+    :param dirname: string - Directory holding the CDR cube
+    :param hemisphere: str - hemisphere - either north for the arctic or south for antarctica
+    :return: (dates, (days, y, x) percent code view, bool array of which days hold data) - see GridCube.get_range
+    """
+    check_hemisphere(hemisphere)
+    return _encoded_cube(dirname, 'cdr', hemisphere).get_range(start, end)
+
+
+def cdr_fname_to_date(name, hemisphere):
+    """
+    Get the date of a CDR netCDF file name, whatever its platform or version suffix.
+    :param name: string - file name
+    :param hemisphere: string - 'south' or 'north' - hemisphere of the files to match
+    :return: datetime.date, or None if the name isn't a CDR file for the hemisphere
+    """
+    match = re.match(rf"^seaice_conc_daily_(icdr_)?{hemisphere[0]}h_[a-z0-9]+_(\d{{8}})_v\d+r\d+\.nc$", name)
+    return datetime.datetime.strptime(match.group(2), '%Y%m%d').date() if match else None
+
+
+def nic_fname_to_date(name, hemisphere):
+    """
+    Get the date of an NIC zipped shapefile name.
+    :param name: string - file name
+    :param hemisphere: string - 'south' or 'north' - hemisphere of the files to match
+    :return: datetime.date, or None if the name isn't an NIC file for the hemisphere
+    """
+    match = re.match(rf"^nic_miz(\d{{7}}){hemisphere[0]}c_pl_[a-z]\.zip$", name)
+    return datetime.datetime.strptime(match.group(1), '%Y%j').date() if match else None
+
+
+def cdr_availability(dirname, hemisphere):
+    """
+    Get the availability index of downloaded CDR files and converted CDR grids.
+    :param dirname: string - CDR input folder
+    :param hemisphere: str - hemisphere - either north for the arctic or south for antarctica
+    :return: availability.AvailabilityIndex
+    """
+    check_hemisphere(hemisphere)
+    return availability.load_index(dirname, 'cdr', hemisphere, cdr_fname_to_date)
+
+
+def nic_availability(dirname, hemisphere):
+    """
+    Get the availability index of downloaded NIC files and rasterized NIC grids.
+    :param dirname: string - NIC input folder
+    :param hemisphere: str - hemisphere - either north for the arctic or south for antarctica
+    :return: availability.AvailabilityIndex
+    """
+    check_hemisphere(hemisphere)
+    return availability.load_index(dirname, 'nic', hemisphere, nic_fname_to_date)
+
+
+def available_nic_dates(start, end, dirname, hemisphere):
+    """
+    Find the days from start to end (inclusive) that have an NIC grid, without loading any of them.
+    :param start: datetime - first day to check
+    :param end: datetime - last day to check
+    :param dirname: string - Directory to search for grids
+    :param hemisphere: str - hemisphere - either north for the arctic or south for antarctica
+    :return: pandas DatetimeIndex
+    """
+    return nic_availability(dirname, hemisphere).dates(start, end)
+
+
+def available_cdr_dates(start, end, dirname, hemisphere):
+    """
+    Find the days from start to end (inclusive) that have a CDR grid, without loading any of them.
+    :param start: datetime - first day to check
+    :param end: datetime - last day to check
+    :param dirname: string - Directory to search for grids
+    :param hemisphere: str - hemisphere - either north for the arctic or south for antarctica
+    :return: pandas DatetimeIndex
+    """
+    return cdr_availability(dirname, hemisphere).dates(start, end)
+
+
+def grid_write_times(days, product, dirname, hemisphere):
+    """
+    Get when each day's grid was last written, without loading any of them.  A day's write time changes whenever its
+    grid is converted again, so it tells whether anything computed from the grid is out of date.
+    :param days: pandas DatetimeIndex - days to look up
+    :param product: string - 'cdr' or 'nic'
+    :param dirname: string - Directory to search for grids
+    :param hemisphere: str - hemisphere - either north for the arctic or south for antarctica
+    :return: np int64 array - nanoseconds since the epoch, 0 for days without a grid
+    """
+    check_hemisphere(hemisphere)
+    written = _encoded_cube(dirname, product, hemisphere).written_at(days)
+    grid_fname_func = datetime_to_cdr_fname_grid if product == 'cdr' else datetime_to_nic_fname_grid
+    # Fall back to the modification time of per-day .npy grids written before the cube existed
+    for day_index in np.flatnonzero(written == 0):
+        try:
+            grid_path = os.path.join(dirname, grid_fname_func(days[day_index], hemisphere))
+            written[day_index] = os.stat(grid_path).st_mtime_ns
+        except FileNotFoundError:
+            pass
+    return written
+
+
+def _convertible_dates(index, start, end):
+    """
+    Get the days that can be converted to grids - days with a downloaded file or a per-day .npy grid.
+    :param index: availability.AvailabilityIndex
+    :param start: datetime - first day
+    :param end: datetime - last day
+    :return: pandas DatetimeIndex
+    """
+    return index.dates(start, end, kind='raw').union(index.dates(start, end, kind='grid'))
+
+
+def legacy_grid_dates(start, end, dirname, product, hemisphere):
+    """
+    Find the days from start to end (inclusive) that only have a per-day .npy grid, written before the cube existed.
+    These aren't in range reads of the cube (eg get_cdr_range) until import_legacy_grids folds them in.
+    :param start: datetime - first day to check
+    :param end: datetime - last day to check
+    :param dirname: string - Directory to search for grids
+    :param product: string - 'cdr' or 'nic'
+    :param hemisphere: str - hemisphere - either north for the arctic or south for antarctica
+    :return: pandas DatetimeIndex
+    """
+    check_hemisphere(hemisphere)
+    availability_func = available_cdr_dates if product == 'cdr' else available_nic_dates
+    grid_dates = availability_func(start, end, dirname, hemisphere)
+    if grid_dates.empty:
+        return grid_dates
+    grid_cube = _encoded_cube(dirname, product, hemisphere)
+    return grid_dates[[date not in grid_cube for date in grid_dates]]
+
+
+def legacy_grid_pair_dates(start, end, cdr_dirname, nic_dirname, hemisphere):
+    """
+    Find the days from start to end (inclusive) with both grids where either is only a per-day .npy grid, ie the days
+    range reads of both cubes miss.
+    :param start: datetime - first day to check
+    :param end: datetime - last day to check
+    :param cdr_dirname: string - Directory holding the CDR grids
+    :param nic_dirname: string - Directory holding the NIC grids
+    :param hemisphere: str - hemisphere - either north for the arctic or south for antarctica
+    :return: pandas DatetimeIndex
+    """
+    legacy_dates = legacy_grid_dates(start, end, cdr_dirname, 'cdr', hemisphere).union(
+        legacy_grid_dates(start, end, nic_dirname, 'nic', hemisphere))
+    if legacy_dates.empty:
+        return legacy_dates
+    return legacy_dates.intersection(available_cdr_dates(start, end, cdr_dirname, hemisphere)).intersection(
+        available_nic_dates(start, end, nic_dirname, hemisphere))
+
+
+def import_legacy_grids(start, end, dirname, product, hemisphere, verbose=False):
+    """
+    Fold the per-day .npy grids from start to end (inclusive) that aren't in the product cube yet into it, keeping
+    each file's modification time as the day's write time so nothing computed from it looks out of date, and store
+    their histograms.  The .npy files are left in place.
+    :param start: datetime - first day to import
+    :param end: datetime - last day to import
+    :param dirname: string - Directory holding the grids
+    :param product: string - 'cdr' or 'nic'
+    :param hemisphere: str - hemisphere - either north for the arctic or south for antarctica
+    :param verbose: bool - increase verbosity
+    :return: int - number of grids imported
+    """
+    legacy_dates = legacy_grid_dates(start, end, dirname, product, hemisphere)
+    if legacy_dates.empty:
+        return 0
+    grid_fname_func = datetime_to_cdr_fname_grid if product == 'cdr' else datetime_to_nic_fname_grid
+    dtype, encode_func = GRID_ENCODINGS[product]
+    grid_cube = _encoded_cube(dirname, product, hemisphere)
+    histograms = {}
+    for date in legacy_dates:
+        grid_path = os.path.join(dirname, grid_fname_func(date, hemisphere))
+        try:
+            grid = encode_func(np.load(grid_path))
+            grid_cube.reserve(legacy_dates[0], legacy_dates[-1], grid.shape, dtype)
+            grid_cube.put(date, grid)
+            grid_cube.mark_valid([date], written=os.stat(grid_path).st_mtime_ns)
+            histograms[date] = encoding.code_histogram(grid)
+        except Exception as exc:
+            if verbose:
+                print(f"Couldn't import {grid_path}; {exc}")
+    grid_cube.flush()
+    store_histograms(dirname, product, hemisphere, histograms)
+    instrument.count(f'{product} npy grids imported', len(histograms))
+    if verbose:
+        print(f"Imported {len(histograms)} of {len(legacy_dates)} {product} npy grids into the cube")
+    return len(histograms)
+
+
+def _get_grid(product, grid_fname_func, date, dirname, hemisphere):
+    """
+    Loads a grid from the product cube, falling back to a per-day .npy file written before the cube existed.  Grids are
+    returned as percent codes either way.
+    :param product: string - 'cdr' or 'nic'
+    :param grid_fname_func: function returning the per-day .npy filename for a date and hemisphere
     :param date: datetime - datetime to load
     :param dirname: string - Directory to search for files
     :param hemisphere: str - hemisphere - either north for the arctic or south for antarctica
     :return:
     """
     check_hemisphere(hemisphere)
-    fname = datetime_to_cdr_fname_grid(date, hemisphere)
-    full_fname = os.path.join(dirname, fname)
-    return np.load(full_fname)
+    grid_cube = _encoded_cube(dirname, product, hemisphere)
+    if date in grid_cube:
+        instrument.count(f'{product} grids read from cube')
+        return grid_cube.get(date)
+    instrument.count(f'{product} grids read from npy')
+    return GRID_ENCODINGS[product][1](np.load(os.path.join(dirname, grid_fname_func(date, hemisphere))))
 
 
 def get_cdr_metadata(cdr_file_path):
     """
-    From a CDR netcdf, extract the array shape, proj4 text and extent.
+    From a CDR netcdf, extract the array shape, proj4 text and extent.  The file is closed before returning.
     :param cdr_file_path: string - path to the CDR file
     :return: (
         lats,
         lons,
-        projection variable data
+        projection parameters - see projection_params
     )
     """
-    cdr_file = nc.Dataset(cdr_file_path)
-
-    lats_squeezed = np.squeeze(cdr_file.variables['latitude'][:])
-    lons_squeezed = np.squeeze(cdr_file.variables['longitude'][:])
-    nc_proj_data = cdr_file.variables['projection']
+    with nc.Dataset(cdr_file_path) as cdr_file:
+        lats_squeezed = np.ma.getdata(np.squeeze(cdr_file.variables['latitude'][:]))
+        lons_squeezed = np.ma.getdata(np.squeeze(cdr_file.variables['longitude'][:]))
+        nc_proj_data = projection_params(cdr_file.variables['projection'])
 
     return lats_squeezed, lons_squeezed, nc_proj_data
 
 
-def nic_to_np(start, end, nic_input_folder, cdr_meta, shape, clobber=False, hemisphere='south', verbose=False):
+def _metadata_paths(cdr_input_folder, hemisphere):
+    """
+    Get the paths of the cached CDR metadata arrays and projection attributes.
+    :return: (npz path, json path)
+    """
+    base = os.path.join(cdr_input_folder, METADATA_FOLDER, METADATA_FNAME_FMT.format(hemisphere=hemisphere))
+    return base + '.npz', base + '.json'
+
+
+def load_cdr_metadata(cdr_input_folder, hemisphere):
+    """
+    Load the cached CDR metadata for a hemisphere.  The cache is only used if its version matches and its arrays have
+    the shape recorded alongside the projection attributes.
+    :param cdr_input_folder: string - CDR input folder
+    :param hemisphere: str - hemisphere - either north for the arctic or south for antarctica
+    :return: (lats, lons, projection parameters) like get_cdr_metadata, or None if there is no valid cache
+    """
+    arrays_path, params_path = _metadata_paths(cdr_input_folder, hemisphere)
+    try:
+        with open(params_path) as params_file:
+            header = json.load(params_file)
+        with np.load(arrays_path) as arrays:
+            lats, lons = arrays['lats'], arrays['lons']
+    except (OSError, ValueError, KeyError):
+        return None
+
+    if (header.get('version') != METADATA_VERSION or list(lats.shape) != header.get('shape') or
+            lons.shape != lats.shape or set(header.get('params', {})) != set(PROJECTION_ATTRS)):
+        return None
+    return lats, lons, types.SimpleNamespace(**header['params'])
+
+
+def save_cdr_metadata(cdr_input_folder, hemisphere, lats, lons, nc_proj_data, source=None):
+    """
+    Cache CDR metadata for a hemisphere.
+    :param cdr_input_folder: string - CDR input folder
+    :param hemisphere: str - hemisphere - either north for the arctic or south for antarctica
+    :param lats: np array - latitudes
+    :param lons: np array - longitudes
+    :param nc_proj_data: netCDF projection variable or projection_params output
+    :param source: string - name of the file the metadata was read from, recorded for reference
+    :return:
+    """
+    arrays_path, params_path = _metadata_paths(cdr_input_folder, hemisphere)
+    os.makedirs(os.path.dirname(arrays_path), exist_ok=True)
+    np.savez(arrays_path, lats=lats, lons=lons)
+
+    # The json is written last, so a cache interrupted while saving fails the shape check rather than being used
+    header = {
+        'version': METADATA_VERSION,
+        'shape': list(lats.shape),
+        'source': source,
+        'params': vars(projection_params(nc_proj_data)),
+    }
+    tmp_path = params_path + '.tmp'
+    with open(tmp_path, 'w') as params_file:
+        json.dump(header, params_file)
+    os.replace(tmp_path, params_path)
+
+
+def cdr_metadata(cdr_input_folder, hemisphere, verbose=False):
+    """
+    Get the CDR latitudes, longitudes and projection for a hemisphere from the metadata cache, building the cache from
+    any downloaded CDR file if it isn't there yet.
+    :param cdr_input_folder: string - CDR input folder
+    :param hemisphere: str - hemisphere - either north for the arctic or south for antarctica
+    :param verbose: bool - increase verbosity
+    :return: (lats, lons, projection parameters) - see get_cdr_metadata
+    """
+    check_hemisphere(hemisphere)
+    cached = load_cdr_metadata(cdr_input_folder, hemisphere)
+    if cached is not None:
+        instrument.count('cdr metadata read from cache')
+        return cached
+
+    index = cdr_availability(cdr_input_folder, hemisphere)
+    raw_dates = pd.DatetimeIndex([])
+    if index.start is not None:
+        raw_dates = index.dates(index.start, index.start + datetime.timedelta(days=len(index.raw) - 1), kind='raw')
+    if raw_dates.empty:
+        raise FileNotFoundError(f"No cdr files in {cdr_input_folder} to read {hemisphere} metadata from")
+
+    date = raw_dates[0]
+    _, file_name = datetime_to_cdr_fname(date, hemisphere)
+    file_path = catalog.find_local_file(cdr_input_folder, file_name, cdr_fname_pattern(date, hemisphere))
+    if verbose:
+        print(f"Caching {hemisphere} cdr metadata from {file_path}")
+
+    lats, lons, nc_proj_data = get_cdr_metadata(file_path)
+    save_cdr_metadata(cdr_input_folder, hemisphere, lats, lons, nc_proj_data, source=os.path.basename(file_path))
+    instrument.count('cdr metadata cached')
+    return lats, lons, nc_proj_data
+
+
+def nic_to_np(start, end, nic_input_folder, cdr_meta, shape, clobber=False, hemisphere='south', verbose=False,
+              n_jobs=-1, pool='thread'):
     """
-    Runs _nic_to_np grid on all dates from start to end.
+    Runs _nic_to_np grid on all dates from start to end.  Rasterized grids are written straight into the NIC cube, which
+    is grown to cover the whole range up front so workers only fill their own day's slot, and their histograms are
+    stored once they're marked valid (see store_histograms).
     :param start: datetime - start time for period downloaded
     :param end: datetime - end time for period downloaded
     :param nic_input_folder: string - input folder to look for zipped shapefiles
-    :param cdr_meta: CDR projection information
+    :param cdr_meta: CDR projection information - the netCDF projection variable or projection_params output
     :param shape: tuple of ints - shape of the data array
     :param clobber: bool - overwrite output if it exists
     :param hemisphere: string - 'south' or 'north' - hemisphere to process
     :param verbose: bool - increase verbosity
-    :return:
+    :param n_jobs: int - number of workers, -1 for one per CPU
+    :param pool: string - 'thread' or 'process'.  Reading, reprojecting and rasterizing shapefiles holds the GIL for
+        much of the time, so processes scale better across cores.
+    :return: dict - seconds spent on each day that was rasterized, keyed by date
     """
     check_hemisphere(hemisphere)
-    analyzed_dates = pd.date_range(start=start, end=end)
-    Parallel(n_jobs=-1, backend='threading')(delayed(_nic_to_np_grid)
-                                             (date, nic_input_folder, hemisphere, clobber, cdr_meta, shape, verbose)
-                                             for date in analyzed_dates)
+    if not os.path.isdir(nic_input_folder):
+        return {}
+    nic_cube = _encoded_cube(nic_input_folder, 'nic', hemisphere)
+    index = nic_availability(nic_input_folder, hemisphere)
+    if verbose and index.gaps(start, end, kind='raw').size:
+        print(f"No nic files to rasterize for {availability.describe_gaps(index.gaps(start, end, kind='raw'))}")
+    convertible_dates = _convertible_dates(index, start, end)
+    analyzed_dates = [date for date in convertible_dates if clobber or date not in nic_cube]
+    instrument.count('nic grids already rasterized', len(convertible_dates) - len(analyzed_dates))
+    if not analyzed_dates:
+        return {}
+
+    # Only picklable projection parameters are sent to workers, never the live netCDF variable
+    proj_params = projection_params(cdr_meta)
+    nic_cube.reserve(analyzed_dates[0], analyzed_dates[-1], shape, encoding.NIC_DTYPE)
+    nic_cube.flush()
+
+    backend = 'loky' if pool == 'process' else 'threading'
+    wall_start = time.perf_counter()
+    results = Parallel(n_jobs=n_jobs, backend=backend)(delayed(_nic_to_np_grid)
+                                                       (date, nic_input_folder, hemisphere, clobber, proj_params,
+                                                        shape, verbose)
+                                                       for date in analyzed_dates)
+    wall_time = time.perf_counter() - wall_start
+
+    rasterized = {date: result for date, result in zip(analyzed_dates, results) if result is not None}
+    timings = {date: seconds for date, (seconds, _) in rasterized.items()}
+    nic_cube.mark_valid(timings.keys())
+    nic_cube.flush()
+    store_histograms(nic_input_folder, 'nic', hemisphere,
+                     {date: histogram for date, (_, histogram) in rasterized.items()})
+
+    # Workers may be other processes, so days are recorded here from the timings they return
+    for date, seconds in timings.items():
+        instrument.record_day('rasterize nic', date, seconds)
+    instrument.count('nic grids rasterized', len(timings))
+    instrument.count('nic rasterization failures', len(analyzed_dates) - len(timings))
+
+    if verbose:
+        for date, seconds in timings.items():
+            print(f"Rasterized {date:%Y%m%d} for nic in {seconds:.2f}s")
+        busy_time = sum(timings.values())
+        print(f"Rasterized {len(timings)} of {len(analyzed_dates)} nic days in {wall_time:.1f}s using {pool} workers; "
+              f"{busy_time:.1f}s of work ({busy_time / max(wall_time, 1e-9):.1f}x parallel)")
+
+    return timings
+
+
+def projection_params(nc_proj_data):
+    """
+    Copy the projection attributes used for rasterizing and plotting into a plain, picklable object with the same
+    attribute names as the netCDF projection variable.
+    :param nc_proj_data: netCDF projection variable (or an object already returned by this function)
+    :return: types.SimpleNamespace
+    """
+    params = {}
+    for attr in PROJECTION_ATTRS:
+        value = getattr(nc_proj_data, attr)
+        params[attr] = value.item() if isinstance(value, (np.generic, np.ndarray)) and np.size(value) == 1 else value
+    return types.SimpleNamespace(**params)
+
+
+def cdr_grid_transform(cdr_meta):
+    """
+    Get the affine transform from CDR projected coordinates to grid cells, eg to rasterize shapes onto the CDR grid.
+    :param cdr_meta: CDR projection information - the netCDF projection variable or projection_params output
+    :return: affine.Affine
+    """
+    extent = cdr_meta.GeoTransform.split(" ")
+
+    # The "extent" has the top y, left x values in it...but accessing them from gir grid_boundary_[left|top]
+    # _projected_[y|x] is more clear.  Unfortunately, the order of GeoTransform and what from_origin is
+    # looking for don't line up.
+
+    top_y = cdr_meta.grid_boundary_top_projected_y
+    left_x = cdr_meta.grid_boundary_left_projected_x
+    pixel_y = float(extent[5])
+    pixel_x = float(extent[1])
+
+    return rasterio.transform.from_origin(left_x,
+                                          top_y,
+                                          pixel_x,
+                                          pixel_y)
 
 
 def _cdr_to_np_grid(date, input_folder, hemisphere, clobber, verbose):
     """
-    Loads the CDR netcdf data into memory then saves to disk as a numpy array for easy access.
+    Loads the CDR netcdf data into memory then stores it in the CDR grid cube as percent codes for easy access.  Days
+    already converted to a per-day .npy file are folded into the cube without re-reading the netCDF.
     :param date: datetime - Date to process
     :param input_folder: string - Input folder that holds CDR netcdf files and numpy files
     :param hemisphere: string - 'south' or 'north' - hemisphere to process
     :param clobber: bool - overwrite output
     :param verbose: bool - increase verbosity
-    :return:
+    :return: np int array - the histogram of the converted grid (see encoding.code_histogram), or None if the day was
+        already converted or couldn't be
     """
     check_hemisphere(hemisphere)
     if verbose:
         print(f"Running {date} for cdr")
     try:
+        cdr_cube = cube.open_cube(input_folder, 'cdr', hemisphere)
         grid_fname = os.path.join(input_folder, datetime_to_cdr_fname_grid(date, hemisphere))
-        if clobber or not os.path.exists(grid_fname):
-            _, cdr_fname = datetime_to_cdr_fname(date, hemisphere)
-            cdr_file = nc.Dataset(os.path.join(input_folder, cdr_fname), 'r')
-            grid = np.squeeze(cdr_file.variables['seaice_conc_cdr'][:])
-
-            # This is a masked array - replace all masked values and all <0 values (flags) with 0
-            grid = grid.filled(0)
-            grid[grid < 0] = 0
-
-            np.save(grid_fname, grid)
+        if not clobber and date in cdr_cube:
+            instrument.count('cdr grids already converted')
+            return
+        with instrument.day_timer('convert cdr', date):
+            if not clobber and os.path.exists(grid_fname):
+                grid = np.load(grid_fname)
+                instrument.count('cdr npy grids imported')
+            else:
+                _, cdr_fname = datetime_to_cdr_fname(date, hemisphere)
+                cdr_file = nc.Dataset(catalog.find_local_file(input_folder, cdr_fname,
+                                                              cdr_fname_pattern(date, hemisphere)), 'r')
+                grid = np.squeeze(cdr_file.variables['seaice_conc_cdr'][:])
+
+                # This is a masked array - replace all masked values and all <0 values (flags) with 0
+                grid = grid.filled(0)
+                grid[grid < 0] = 0
+
+            grid = encoding.encode_cdr(grid)
+            cdr_cube.write(date, grid, flush=False)
+        instrument.count('cdr grids converted')
+        return encoding.code_histogram(grid)
     except Exception as exc:
+        instrument.count('cdr conversion failures')
         if verbose:
             print(f"COULDN'T RUN {date} BECAUSE {exc}")
 
 
+def file_digest(path, block_size=1024 * 1024):
+    """
+    Get a short SHA-1 digest of a file's contents.
+    :param path: string - file path
+    :param block_size: int - bytes read at a time
+    :return: string
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as digest_file:
+        for block in iter(lambda: digest_file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()[:20]
+
+
+def reprojected_nic_shapes(nic_full_fname, proj4text, input_folder):
+    """
+    Read the ice polygons of a zipped NIC shapefile reprojected to a projection.  Reprojected polygons are cached as WKB
+    in a Feather file keyed by the source file's contents and the projection, so rasterizing the same file again (eg
+    with clobber, or to another grid in the same projection) skips parsing and reprojecting the shapefile.
+    :param nic_full_fname: string - path to the zipped shapefile
+    :param proj4text: string - proj4 text of the projection to reproject to
+    :param input_folder: string - NIC input folder holding the cache
+    :return: GeoDataFrame with ICECODE and geometry columns
+    """
+    crs_digest = hashlib.sha1(proj4text.encode()).hexdigest()[:12]
+    cache_path = os.path.join(input_folder, GEOMETRY_CACHE_FOLDER,
+                              GEOMETRY_CACHE_FNAME_FMT.format(source=file_digest(nic_full_fname), crs=crs_digest))
+    if os.path.exists(cache_path):
+        instrument.count('nic shapes read from cache')
+        return gpd.read_feather(cache_path)
+
+    gdf = gpd.read_file("zip://" + nic_full_fname)[['ICECODE', 'geometry']]
+    gdf = gdf.to_crs(proj4text)
+
+    # Workers may be separate processes, so each writes its own temporary file before moving it into place
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    gdf.to_feather(tmp_path)
+    os.replace(tmp_path, cache_path)
+    instrument.count('nic shapes reprojected')
+    return gdf
+
+
 def _nic_to_np_grid(date, input_folder, hemisphere, clobber, cdr_meta, shape, verbose):
     """
-    Rasterizes an NIC shapefile input and saves to disk as a numpy array.
+    Rasterizes an NIC shapefile input into the day's slot of the NIC grid cube as percent codes.  Days already
+    rasterized to a per-day .npy file are encoded into the cube without rasterizing again.  The slot must already be
+    reserved; marking it valid and storing its histogram are left to the caller so this can run in a separate process.
     :param date: datetime - Date to process
     :param input_folder: string - Input folder to find NIC zipped shapefiles
     :param hemisphere: string - 'south' or 'north' - hemisphere to process
     :param clobber: bool - overwrite output
     :param cdr_meta: cdr projection information
+    :param shape: tuple of ints - shape of the data array
     :param verbose: bool - increase verbosity
-    :return:
+    :return: (float - seconds spent on this day, np int array - the grid's histogram (see encoding.code_histogram)),
+        or None if it couldn't be run
     """
     check_hemisphere(hemisphere)
     if verbose:
         print(f"Running {date} for nic")
 
+    day_start = time.perf_counter()
     try:
+        nic_cube = cube.open_cube(input_folder, 'nic', hemisphere)
         grid_fname = os.path.join(input_folder, datetime_to_nic_fname_grid(date, hemisphere))
-        if clobber or not os.path.exists(grid_fname):
+        if not clobber and os.path.exists(grid_fname):
+            grid = encoding.encode_nic(np.load(grid_fname))
+        else:
             _, nic_fname = datetime_to_nic_fname(date, hemisphere)
-            nic_full_fname = os.path.join(input_folder, nic_fname)
+            nic_full_fname = catalog.find_local_file(input_folder, nic_fname, nic_fname_pattern(date, hemisphere))
 
             # basic check to make sure we're dealing with a zipfile
             assert os.path.splitext(nic_full_fname)[1] == ".zip"
-            icecode_mapping = {
-                "CT18": .18,
-                "CT81": .8
-            }
-
-            gdf = gpd.read_file("zip://" + nic_full_fname)
-            gdf = gdf.to_crs(cdr_meta.proj4text)
-
-            shapes = ((geom, icecode_mapping[value]) for geom, value in zip(gdf.geometry, gdf.ICECODE))
-            extent = cdr_meta.GeoTransform.split(" ")
-
-            # The "extent" has the top y, left x values in it...but accessing them from gir grid_boundary_[left|top]
-            # _projected_[y|x] is more clear.  Unfortunately, the order of GeoTransform and what from_origin is
-            # looking for don't line up.
 
-            top_y = cdr_meta.grid_boundary_top_projected_y
-            left_x = cdr_meta.grid_boundary_left_projected_x
-            pixel_y = float(extent[5])
-            pixel_x = float(extent[1])
+            gdf = reprojected_nic_shapes(nic_full_fname, cdr_meta.proj4text, input_folder)
 
-            geo_transform = rasterio.transform.from_origin(left_x,
-                                                           top_y,
-                                                           pixel_x,
-                                                           pixel_y)
+            shapes = ((geom, NIC_ICECODE_MAPPING[value]) for geom, value in zip(gdf.geometry, gdf.ICECODE))
 
+            # rasterio can't burn int8 directly, so burn int16 and narrow it
             grid = rasterio.features.rasterize(shapes=shapes,
-                                               transform=geo_transform,
-                                               fill=-1,
-                                               out_shape=shape)
+                                               transform=cdr_grid_transform(cdr_meta),
+                                               fill=encoding.NIC_FILL,
+                                               out_shape=shape,
+                                               dtype=np.int16).astype(encoding.NIC_DTYPE)
 
-            np.save(grid_fname, grid)
+        nic_cube.put(date, grid)
+        return time.perf_counter() - day_start, encoding.code_histogram(grid)
     except Exception as exc:
         if verbose:
             print(f"COULDN'T RUN {date} BECAUSE {exc}")
+        return None
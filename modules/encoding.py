@@ -0,0 +1,111 @@
+'''
+A module that defines the compact integer encoding of the daily grids.
+
+Both products are stored as whole-percent sea ice concentration codes - the CDR is distributed in 1% steps and the NIC
+only has three values.  CDR grids are uint8 codes from 0 to 100.  NIC grids are int8 codes of -1 (no data), 18 (10-80%)
+and 80 (80%+).  Thresholds given as fractions are converted to codes so masks can be computed on the codes directly, and
+threshold masks are bit-packed along x for storage.
+'''
+
+import numpy as np
+
+CDR_DTYPE = np.dtype(np.uint8)
+NIC_DTYPE = np.dtype(np.int8)
+NIC_FILL = -1
+
+# One concentration code per whole percent from 0 to 100
+CONCENTRATION_BINS = 101
+
+# The sea ice concentration of each code from -1 (NIC fill) to 100.  Code values are computed the same way the CDR
+# scale factor is applied so thresholds compare identically against codes and decoded grids.
+PERCENT_VALUES = np.arange(CONCENTRATION_BINS) * 0.01
+_CODE_VALUES = np.concatenate([[float(NIC_FILL)], PERCENT_VALUES])
+
+
+def encode_cdr(grid):
+    """
+    Encode a CDR sea ice concentration grid (0 to 1, anything below 0 treated as 0) as uint8 percent codes.
+    :param grid: np array - CDR sea ice concentration
+    :return: np uint8 array
+    """
+    codes = np.rint(np.asarray(grid, dtype=np.float64) * 100)
+    return np.clip(codes, 0, 100).astype(CDR_DTYPE)
+
+
+def encode_nic(grid):
+    """
+    Encode an NIC sea ice concentration grid (-1 for no data, otherwise 0 to 1) as int8 percent codes.
+    :param grid: np array - NIC sea ice concentration
+    :return: np int8 array
+    """
+    grid = np.asarray(grid, dtype=np.float64)
+    codes = np.clip(np.rint(grid * 100), 0, 100)
+    return np.where(grid < 0, NIC_FILL, codes).astype(NIC_DTYPE)
+
+
+def decode(codes):
+    """
+    Decode a grid of percent codes back to fractional sea ice concentration, with the NIC fill decoded as -1.
+    :param codes: np integer array - encoded grid
+    :return: np float64 array
+    """
+    return _CODE_VALUES[np.asarray(codes).astype(np.intp) + 1]
+
+
+def code_histogram(codes):
+    """
+    Count the cells of an encoded grid holding each concentration code with one bincount.  The NIC fill (or anything
+    else outside 0 to 100) is not counted.
+    :param codes: np integer array - encoded grid
+    :return: np int array of length CONCENTRATION_BINS
+    """
+    codes = np.asarray(codes)
+    if codes.dtype != CDR_DTYPE:
+        codes = codes[(codes >= 0) & (codes < CONCENTRATION_BINS)].astype(np.intp)
+    return np.bincount(codes.ravel(), minlength=CONCENTRATION_BINS)[:CONCENTRATION_BINS]
+
+
+def is_encoded(grid):
+    """
+    Check whether a grid holds percent codes rather than fractional sea ice concentrations.
+    :param grid: np array
+    :return: bool
+    """
+    return np.issubdtype(np.asarray(grid).dtype, np.integer)
+
+
+def lower_code(thresh):
+    """
+    Get the smallest code whose concentration is at or above a threshold - value >= thresh is code >= lower_code.
+    :param thresh: float or np array - fractional sea ice concentration
+    :return: int or np int array.  101 if no code qualifies.
+    """
+    return np.searchsorted(_CODE_VALUES, thresh, side='left') - 1
+
+
+def upper_code(thresh):
+    """
+    Get the largest code whose concentration is at or below a threshold - value <= thresh is code <= upper_code.
+    :param thresh: float or np array - fractional sea ice concentration
+    :return: int or np int array.  -2 if no code qualifies.
+    """
+    return np.searchsorted(_CODE_VALUES, thresh, side='right') - 2
+
+
+def pack_mask(mask):
+    """
+    Bit-pack a boolean mask (or stack of masks) along the last axis.
+    :param mask: np bool array
+    :return: np uint8 array with the last axis ceil(x / 8) long
+    """
+    return np.packbits(mask, axis=-1)
+
+
+def unpack_mask(packed, width):
+    """
+    Unpack a mask packed with pack_mask.
+    :param packed: np uint8 array
+    :param width: int - length of the last axis before packing
+    :return: np bool array
+    """
+    return np.unpackbits(packed, axis=-1, count=width).view(bool)
@@ -0,0 +1,199 @@
+'''
+A module that records where the time of a run goes - timed stages, per-day timers and counters.
+
+Tracing is off until enable() is called, so instrumented code costs next to nothing in normal runs.  Spans and counters
+are recorded by the process that enabled tracing, from any of its threads.  Work done in pool processes is recorded by
+the parent from what the workers return (eg per-day seconds) - see record.  A trace can be written as JSON lines or in
+the Chrome trace event format (viewable in chrome://tracing or Perfetto).
+'''
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+# Span categories
+STAGE = 'stage'
+DAY = 'day'
+
+
+class Tracer:
+    """
+    Collects spans (named, timed intervals) and counters for one run.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.spans = []
+        self.counters = {}
+        self.counter_events = []
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def _now(self):
+        return time.perf_counter() - self._origin
+
+    def record(self, name, seconds, category=DAY, start=None, **args):
+        """
+        Record a span that was timed elsewhere, eg in a worker process.
+        :param name: string - what was timed, eg 'rasterize nic'
+        :param seconds: float - duration
+        :param category: string - STAGE or DAY
+        :param start: float - seconds since tracing started.  Taken as ending now if None.
+        :param args: extra fields for the span, eg date
+        :return:
+        """
+        if not self.enabled:
+            return
+        if start is None:
+            start = max(self._now() - seconds, 0.0)
+        span = {'name': name, 'category': category, 'start': start, 'seconds': seconds,
+                'thread': threading.get_ident(), 'args': args}
+        with self._lock:
+            self.spans.append(span)
+
+    @contextlib.contextmanager
+    def span(self, name, category=STAGE, **args):
+        """
+        Time the body of a with block as a span.
+        :param name: string - what is being timed
+        :param category: string - STAGE or DAY
+        :param args: extra fields for the span
+        """
+        if not self.enabled:
+            yield
+            return
+        start = self._now()
+        try:
+            yield
+        finally:
+            self.record(name, self._now() - start, category=category, start=start, **args)
+
+    def count(self, name, value=1):
+        """
+        Add to a counter.
+        :param name: string - what is counted, eg 'grids converted'
+        :param value: int or float - amount to add
+        :return:
+        """
+        if not self.enabled or not value:
+            return
+        with self._lock:
+            total = self.counters.get(name, 0) + value
+            self.counters[name] = total
+            self.counter_events.append({'name': name, 'time': self._now(), 'value': value, 'total': total})
+
+    def stage_totals(self):
+        """
+        Total seconds spent in each stage and each kind of day.
+        :return: dict of {category: {name: (count, seconds)}}
+        """
+        totals = {STAGE: {}, DAY: {}}
+        with self._lock:
+            for span in self.spans:
+                count, seconds = totals.setdefault(span['category'], {}).get(span['name'], (0, 0.0))
+                totals[span['category']][span['name']] = (count + 1, seconds + span['seconds'])
+        return totals
+
+    def summary(self):
+        """
+        Format the stage timings, day timings and counters as a report.
+        :return: string
+        """
+        totals = self.stage_totals()
+        lines = ['Stages:']
+        lines.extend(f'  {name:<32}{seconds:>10.2f}s' for name, (_, seconds) in totals[STAGE].items())
+        if totals[DAY]:
+            lines.append('Days:')
+            lines.extend(f'  {name:<32}{count:>6} days{seconds:>10.2f}s  {seconds / count:.3f}s per day'
+                         for name, (count, seconds) in totals[DAY].items())
+        if self.counters:
+            lines.append('Counters:')
+            lines.extend(f'  {name:<32}{total:>10}' for name, total in sorted(self.counters.items()))
+        return '\n'.join(lines)
+
+    def write_jsonl(self, path):
+        """
+        Write the trace as JSON lines - a line per span and counter change, then a summary line with the counter totals.
+        :param path: string - output path
+        :return:
+        """
+        with self._lock:
+            lines = ([dict(span, type='span') for span in self.spans] +
+                     [dict(event, type='counter') for event in self.counter_events])
+            counters = dict(self.counters)
+        lines.sort(key=lambda line: line.get('start', line.get('time')))
+        lines.append({'type': 'summary', 'counters': counters})
+
+        _make_parent(path)
+        with open(path, 'w') as trace_file:
+            for line in lines:
+                trace_file.write(json.dumps(line, default=str) + '\n')
+
+    def write_chrome_trace(self, path):
+        """
+        Write the trace in the Chrome trace event format.  Spans are complete events and counters are counter events.
+        :param path: string - output path
+        :return:
+        """
+        pid = os.getpid()
+        with self._lock:
+            events = [{'name': span['name'], 'cat': span['category'], 'ph': 'X', 'pid': pid, 'tid': span['thread'],
+                       'ts': span['start'] * 1e6, 'dur': span['seconds'] * 1e6,
+                       'args': {key: str(value) for key, value in span['args'].items()}}
+                      for span in self.spans]
+            events.extend({'name': event['name'], 'ph': 'C', 'pid': pid, 'ts': event['time'] * 1e6,
+                           'args': {'total': event['total']}}
+                          for event in self.counter_events)
+
+        _make_parent(path)
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
+
+
+def _make_parent(path):
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+
+
+# The tracer of this process
+TRACER = Tracer()
+
+
+def enable():
+    """
+    Start recording spans and counters in this process.
+    :return: Tracer
+    """
+    TRACER._origin = time.perf_counter()
+    TRACER.enabled = True
+    return TRACER
+
+
+def stage(name, **args):
+    """
+    Time a stage of the run, eg 'convert cdr'.  Use as a with block.
+    """
+    return TRACER.span(name, category=STAGE, **args)
+
+
+def day_timer(name, date, **args):
+    """
+    Time one day of a stage, eg rasterizing one day.  Use as a with block.
+    """
+    return TRACER.span(name, category=DAY, date=f'{date:%Y%m%d}', **args)
+
+
+def record_day(name, date, seconds, **args):
+    """
+    Record one day of a stage that was timed elsewhere, eg in a worker process.
+    """
+    TRACER.record(name, seconds, category=DAY, date=f'{date:%Y%m%d}', **args)
+
+
+def count(name, value=1):
+    """
+    Add to a counter of the run, eg 'grids converted'.
+    """
+    TRACER.count(name, value)
@@ -4,23 +4,65 @@ to the notebook.  See README of this repository for more details and some exampl
 """
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import cProfile
 import datetime
+import functools
 import os
 import pathlib
+import time
+import zipfile
 
+from joblib import Parallel, delayed, effective_n_jobs
 import numpy as np
 import pandas as pd
 
 import compare
 import display
+from . import agreement
+from . import areas
+from . import availability
+from . import checkpoint
+from . import composite
 from . import download as dwn
+from . import instrument
+from . import planner
+from . import regions
+from . import summary
 
 data_dir = os.path.join(pathlib.Path(__file__).absolute().parent.parent, "data")
 
+# The data folder of each hemisphere
+HEMISPHERE_FOLDERS = {'north': 'arctic', 'south': 'antarctic'}
+
+# The grids each stats row is computed from, in the order their write times are checkpointed - see create_stats
+STATS_INPUTS = ('cdr', 'nic')
+
 INPUT_FOLDER_FMT = os.path.join(data_dir, "{hemisphere}", "inputs", "{product}")
 
 OUTPUT_PNG_FOLDER_FMT = os.path.join(data_dir, "{hemisphere}", "outputs", "{product}", "png")
 OUTPUT_CSV_FOLDER_FMT = os.path.join(data_dir, "{hemisphere}", "outputs", "{product}", "csv")
+OUTPUT_NPZ_FOLDER_FMT = os.path.join(data_dir, "{hemisphere}", "outputs", "{product}", "npz")
+OUTPUT_MP4_FOLDER_FMT = os.path.join(data_dir, "{hemisphere}", "outputs", "{product}", "mp4")
+OUTPUT_PARQUET_FOLDER_FMT = os.path.join(data_dir, "{hemisphere}", "outputs", "{product}", "parquet")
+OUTPUT_FEATHER_FOLDER_FMT = os.path.join(data_dir, "{hemisphere}", "outputs", "{product}", "feather")
+
+# The folder stats are saved to for each --stats-format
+STATS_FOLDER_FMTS = {
+    'csv': OUTPUT_CSV_FOLDER_FMT,
+    'parquet': OUTPUT_PARQUET_FOLDER_FMT,
+    'feather': OUTPUT_FEATHER_FOLDER_FMT,
+}
+
+# Days are rendered in chunks so each worker builds its basemap once per chunk rather than once per day, with a few
+# chunks per worker to even out the load
+RENDER_CHUNKS_PER_WORKER = 4
+
+# Title, color and legend label of each product's daily plots
+DAILY_PLOT_STYLES = {
+    'cdr': ("Sea Ice Concentration Climate Data Record (CDR)", 'cyan', 'CDR Extent'),
+    'nic': ("US National Ice Center Marginal Ice Zone", 'magenta', 'NIC Extent'),
+}
 
 def main():
     """
@@ -41,10 +83,17 @@ def main():
                         help='End datetime to analyze.  Must be in format YYYYmmdd. Interval includes end.',
                         type=lambda s: datetime.datetime.strptime(s, datetime_format))
     parser.add_argument('--animation',
-                        help='Generate an animation of the files in the provided directory.  Order determined by glob'
-                             ' order of png files in the folder.  Animations are saved to the same folder as the png'
+                        help='Generate an animation of the files in the provided directory.  Frames are ordered by '
+                             'the date in the png file names.  Animations are saved to the same folder as the png'
                              ' files under the name animation.mp4.',
                         type=str)
+    parser.add_argument('--daily-animation',
+                        help='Render the combined daily plots straight into an animation, without writing a png file '
+                             'per day.', action='store_true')
+    parser.add_argument('--fps', type=float, default=display.ANIMATION_FPS,
+                        help='The frame rate of animations.')
+    parser.add_argument('--animation-width', type=int,
+                        help='The width of animations in pixels.  Defaults to the width of the frames.')
 
     parser.add_argument('--daily-plots',
                         help='Generate plots for individual days - products plotted separately.', action='store_true')
@@ -57,128 +106,420 @@ def main():
                         help='Generate plots for individual days - products plotted together.', action='store_true')
     parser.add_argument('--median-plot',
                         help='Generate a plot of the median ice edge at.', action='store_true')
-    parser.add_argument('--cdr-plotting-thresh',
+    parser.add_argument('--cdr-plotting-thresh', type=float,
                         default=0.8, help='The CDR sea ice concentration threshold for plotting.')
-    parser.add_argument('--nic-plotting-thresh',
+    parser.add_argument('--nic-plotting-thresh', type=float,
                         default=0.8, help='The NIC sea ice concentration threshold for plotting.')
 
+    parser.add_argument('--rolling-window', type=int,
+                        help='Calculate rolling composites of how often each pixel was at or above the plotting '
+                             'thresholds over a trailing window of this many days, for every day analyzed.  The '
+                             'composites are exported to an npz file.')
+    parser.add_argument('--rolling-percent', type=float, default=0.5,
+                        help='Specific to the rolling-window action, the fraction of the window a pixel must be at or '
+                             'above the plotting threshold to be included in rendered composites.')
+    parser.add_argument('--rolling-plots',
+                        help='Specific to the rolling-window action, also render a plot of the composites for each '
+                             'day.', action='store_true')
+
+    parser.add_argument('--footprint',
+                        help='Compare where each product puts ice at or above its plotting threshold for every day '
+                             'analyzed.  The area where both, neither, only NIC or only CDR have ice each day is saved '
+                             'to a csv and the days each pixel spent in each class to an npz file.', action='store_true')
+    parser.add_argument('--footprint-plots',
+                        help='Specific to the footprint action, also plot how often each pixel was NIC only and CDR '
+                             'only over the days analyzed.', action='store_true')
+
     parser.add_argument('--stats',
                         help='Calculate total area of sea ice concentration within different contour lines for each '
                              'product.', action='store_true')
-    parser.add_argument('--thresh-lower',
+    parser.add_argument('--thresh-lower', type=float,
                         default=0.1, help='The lower sea ice concentration to use when calculating statistics.')
-    parser.add_argument('--thresh-upper',
+    parser.add_argument('--thresh-upper', type=float,
                         default=1.0, help='The upper sea ice concentration to use when calculating statistics.')
-    parser.add_argument('--thresh-interval',
+    parser.add_argument('--thresh-interval', type=float,
                         default=0.05, help='The sea ice concentration interval to use when calculating statistics.')
+    parser.add_argument('--update',
+                        help='Specific to the stats action, only calculate days that are new or whose grids changed '
+                             'since the last update and add them to the existing csv instead of rewriting it.  Days '
+                             'still missing a grid are left out until it arrives.', action='store_true')
+    parser.add_argument('--stats-format', choices=list(STATS_FOLDER_FMTS), default='csv',
+                        help='Specific to the stats action, save a wide csv with a NIC and a CDR column per threshold, '
+                             'or a long table with a row per day, product and threshold as Parquet or Feather that '
+                             'can be read back filtered by date, product or threshold (see the areas module).')
+    parser.add_argument('--regions',
+                        help='Calculate the same statistics for each ocean region - the Southern Ocean sectors or the '
+                             'Arctic seas - and save them with a row per day, region, product and threshold in the '
+                             'stats format.  Regions are always recalculated for every day, even with --update.',
+                        action='store_true')
+    parser.add_argument('--region-file', type=str,
+                        help='Specific to the regions action, a polygon file (eg a shapefile or GeoJSON) with the '
+                             'regions to use instead of the built-in ones.')
+    parser.add_argument('--region-name-column', type=str, default='name',
+                        help='Specific to the region-file option, the column holding the name of each region.')
+
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='The number of workers that build missing daily histograms for statistics.  -1 uses all '
+                             'CPUs.')
+    parser.add_argument('--pool', choices=['thread', 'process'], default='thread',
+                        help='Whether histogram workers are threads or processes.')
+
+    parser.add_argument('--render-jobs', type=int, default=1,
+                        help='The number of processes used to render daily plots.  -1 uses all CPUs.')
+
+    parser.add_argument('--download-jobs', type=int, default=4,
+                        help='The maximum number of files downloaded at once.')
+    parser.add_argument('--rasterize-jobs', type=int, default=-1,
+                        help='The number of workers used to rasterize NIC shapefiles.  -1 uses all CPUs.')
+    parser.add_argument('--rasterize-pool', choices=['thread', 'process'], default='thread',
+                        help='Whether NIC rasterization workers are threads or processes.  Processes scale better '
+                             'across cores when backfilling many years.')
+
+    parser.add_argument('--profile', type=str,
+                        help='Record how long each stage and day takes and what was downloaded, converted, reused and '
+                             'rendered, and write the trace to this path.  A summary is printed at the end of the run.')
+    parser.add_argument('--profile-format', choices=['chrome', 'jsonl'], default='chrome',
+                        help='Specific to the profile option, write the trace in the Chrome trace event format '
+                             '(chrome://tracing, Perfetto) or as JSON lines.')
+    parser.add_argument('--cprofile', type=str,
+                        help='Profile the run with cProfile and dump the stats to this path (see pstats).')
 
     parser.add_argument('--hemisphere',
-                        choices=['north', 'south'], default='south', help='The hemisphere to analyze.')
+                        choices=['north', 'south', 'both'], default='south',
+                        help='The hemisphere to analyze.  both analyzes the two hemispheres side by side, sharing the '
+                             'download and worker pools, and writes each to its own folder.')
     parser.add_argument('--verbose', action='store_true', help='Increase verbosity.')
     args = parser.parse_args()
 
-    if args.hemisphere == "north":
-        hemi_folder = "arctic"
-    else:
-        hemi_folder = "antarctic"
-
+    if args.profile:
+        instrument.enable()
+    profiler = cProfile.Profile() if args.cprofile else None
+    if profiler:
+        profiler.enable()
+
+    try:
+        run(args)
+    finally:
+        if profiler:
+            profiler.disable()
+            pathlib.Path(os.path.dirname(os.path.abspath(args.cprofile))).mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(args.cprofile)
+        if args.profile:
+            if args.profile_format == 'jsonl':
+                instrument.TRACER.write_jsonl(args.profile)
+            else:
+                instrument.TRACER.write_chrome_trace(args.profile)
+            print(instrument.TRACER.summary())
+
+
+def run(args):
+    """
+    Create the outputs requested by the args for each hemisphere requested.  Both hemispheres run side by side and
+    share one pool of download connections; process pools are shared through joblib's reusable executor.
+    :param args: argparse args (see help)
+    :return:
+    """
     if args.start >= args.end:
         raise argparse.ArgumentTypeError(f"Start {args.start} is greater than or equal to end {args.end}!")
 
-    if not any([args.animation,
-                args.daily_plots,
-                args.daily_plots_combined,
-                args.median_plot,
-                args.stats]):
-        raise argparse.ArgumentTypeError("Must specify what type of output you would like to generate.")
+    if args.daily_plots and not (args.plot_cdr or args.plot_nic):
+        raise argparse.ArgumentTypeError(
+            "Must specify either plot_nic or plot_cdr if plotting daily, single-product plots.")
 
     days = pd.date_range(start=args.start, end=args.end, closed="left")
+    if not _planned_outputs(days, args):
+        raise argparse.ArgumentTypeError("Must specify what type of output you would like to generate.")
+
+    hemispheres = list(HEMISPHERE_FOLDERS) if args.hemisphere == 'both' else [args.hemisphere]
+
+    with ThreadPoolExecutor(max_workers=max(1, args.download_jobs)) as download_executor:
+        if len(hemispheres) == 1:
+            _run_hemisphere(days, args, download_executor)
+        else:
+            # Switching backends closes every figure, so it's done once here rather than by whichever hemisphere
+            # starts an animation while the other is rendering
+            display.use_agg_backend()
+
+            # Each hemisphere gets its own copy of the args, since outputs keep the hemisphere's metadata on them
+            Parallel(n_jobs=len(hemispheres), backend='threading')(
+                delayed(_run_hemisphere)(days, argparse.Namespace(**dict(vars(args), hemisphere=hemisphere)),
+                                         download_executor)
+                for hemisphere in hemispheres)
+
+
+def _run_hemisphere(days, args, download_executor):
+    """
+    Create the outputs requested by the args for args.hemisphere, materializing only the inputs each output needs just
+    before it runs.
+    :param days: A pandas datetime series for the days to analyze
+    :param args: argparse args (see help) - for a single hemisphere
+    :param download_executor: concurrent.futures.Executor - runs downloads
+    :return:
+    """
+    hemi_folder = HEMISPHERE_FOLDERS[args.hemisphere]
 
-    # First, make sure everything is downloaded and download files if necessary
+    # Inputs are downloaded and converted lazily - an output only waits on the days it needs that are missing
     cdr_input_folder = INPUT_FOLDER_FMT.format(hemisphere=hemi_folder, product='cdr')
     nic_input_folder = INPUT_FOLDER_FMT.format(hemisphere=hemi_folder, product='nic')
+    input_planner = planner.Planner(cdr_input_folder, nic_input_folder, args.hemisphere,
+                                    download_jobs=args.download_jobs, rasterize_jobs=args.rasterize_jobs,
+                                    rasterize_pool=args.rasterize_pool, download_executor=download_executor,
+                                    verbose=args.verbose)
 
-    dwn.download_cdr_miz_range(args.start, args.end, cdr_input_folder, hemisphere=args.hemisphere, verbose=args.verbose)
-    dwn.download_nic_miz_range(args.start, args.end, nic_input_folder, hemisphere=args.hemisphere, verbose=args.verbose)
+    for name, create_func, artifacts, first_day in _planned_outputs(days, args):
+        input_planner.require(artifacts, first_day, args.end)
+        if planner.METADATA in artifacts:
+            args.lats, args.lons, args.meta = input_planner.metadata(first_day, args.end)
+        with instrument.stage(name, hemisphere=args.hemisphere):
+            create_func()
 
-    # Optimize the data - save cdr data to numpy array on disk for quick access and rasterize the NIC shapefile
-    # If these files are already present, don't do anything
-    dwn.cdr_to_np(args.start, args.end, cdr_input_folder, hemisphere=args.hemisphere, verbose=args.verbose)
-    _, file_name = dwn.datetime_to_cdr_fname(args.start, args.hemisphere)
-    args.lats, args.lons, args.meta = dwn.get_cdr_metadata(os.path.join(cdr_input_folder, file_name))
 
-    print("Rasterizing numpy array data range - this may take a while if this hasn't already been done...")
-    dwn.nic_to_np(args.start,
-                  args.end,
-                  nic_input_folder,
-                  args.meta,
-                  args.lats.shape,
-                  hemisphere=args.hemisphere,
-                  verbose=args.verbose)
+def _planned_outputs(days, args):
+    """
+    List the requested outputs in the order they are created, each with the artifacts it needs.
+    :param days: A pandas datetime series for the days to analyze
+    :param args: argparse args (see help)
+    :return: list of (stage name, function creating the output, set of planner artifacts, first day the artifacts are
+        needed for) - artifacts are needed through args.end
+    """
+    both_grids = {planner.CDR_GRIDS, planner.NIC_GRIDS}
+    plotted = {planner.METADATA}
+    outputs = []
 
     if args.daily_plots:
-        if not (args.plot_cdr or args.plot_nic):
-            raise argparse.ArgumentTypeError(
-                "Must specify either plot_nic or plot_cdr if plotting daily, single-product plots.")
-        create_daily_plots(days, args)
+        products = ({planner.CDR_GRIDS} if args.plot_cdr else set()) | ({planner.NIC_GRIDS} if args.plot_nic else set())
+        outputs.append(('daily plots', functools.partial(create_daily_plots, days, args), products | plotted,
+                        args.start))
     if args.daily_plots_combined:
-        create_daily_plots_combined(days, args)
+        outputs.append(('daily plots combined', functools.partial(create_daily_plots_combined, days, args),
+                        both_grids | plotted, args.start))
     if args.median_plot:
-        create_median_plot(args)
+        outputs.append(('median plot', functools.partial(create_median_plot, args), both_grids | plotted, args.start))
+    if args.rolling_window:
+        # Windows reach back before the first day analyzed
+        outputs.append(('rolling composites', functools.partial(create_rolling_composites, days, args),
+                        both_grids | (plotted if args.rolling_plots else set()),
+                        args.start - datetime.timedelta(days=args.rolling_window - 1)))
+    if args.footprint:
+        outputs.append(('footprint agreement', functools.partial(create_footprint_agreement, days, args),
+                        both_grids | (plotted if args.footprint_plots else set()), args.start))
+    if args.daily_animation:
+        outputs.append(('daily animation', functools.partial(create_daily_animation, days, args),
+                        both_grids | plotted, args.start))
     if args.animation:
-        create_animation(args)
+        # Only needs the pngs already in the folder
+        outputs.append(('animation', functools.partial(create_animation, args), set(), args.start))
     if args.stats:
-        create_stats(days, args)
+        outputs.append(('stats', functools.partial(create_stats, days, args), both_grids, args.start))
+    if args.regions:
+        # Regions are rasterized onto the CDR grid
+        outputs.append(('regional stats', functools.partial(create_regional_stats, days, args), both_grids | plotted,
+                        args.start))
+
+    return outputs
 
 
 def create_stats(days, args):
     """
     For each day provided, add a row to a pandas dataframe representing total sea ice area within a specified sea ice
-    concentration value.  Save the pandas dataframe out to a csv.
+    concentration value.  Save the pandas dataframe out to a csv, or to a long Parquet or Feather table (see
+    args.stats_format).  With args.update, only days that are new or whose grids were written since the last update
+    are calculated, and a checkpoint of the days saved and when their grids were written is kept next to the output
+    (see the checkpoint module).
     :param days: A pandas datetime series for the days to analyze
     :param args: argparse args (see help)
     :return:
     """
+    hemi_folder = HEMISPHERE_FOLDERS[args.hemisphere]
     nic_input_folder = INPUT_FOLDER_FMT.format(hemisphere=hemi_folder, product='nic')
     cdr_input_folder = INPUT_FOLDER_FMT.format(hemisphere=hemi_folder, product='cdr')
 
-    csv_out_path = OUTPUT_CSV_FOLDER_FMT.format(hemisphere=hemi_folder, product='combined')
+    stats_out_path = STATS_FOLDER_FMTS[args.stats_format].format(hemisphere=hemi_folder, product='combined')
     threshold_range = np.arange(args.thresh_lower, args.thresh_upper, args.thresh_interval)
+    out_path = os.path.join(stats_out_path, f"stats_{int(100*args.thresh_lower)}_to_{int(100*args.thresh_upper)}_sic."
+                                            f"{args.stats_format}")
 
     # 1 since we're calculating the difference between this threshold and 100% SIC
     upper_threshold = 1.0
 
-    stats_df = pd.DataFrame()
-    stats_df.set_index(pd.DatetimeIndex([]))
-
-    for day_analyzed in days:
-        try:
-            cdr_grid = dwn.get_cdr(day_analyzed, cdr_input_folder, args.hemisphere)
-            nic_grid = dwn.get_nic(day_analyzed, nic_input_folder, args.hemisphere)
-
-            for thresh in threshold_range:
-                cdr_area, nic_area = compare.calculate_ice_area(cdr_grid,
-                                                                nic_grid,
-                                                                thresh,
-                                                                upper_threshold,
-                                                                thresh,
-                                                                upper_threshold,
-                                                                verbose=args.verbose)
-                stats_df.at[day_analyzed, f'NIC sea ice area within {thresh:.2f}'] = nic_area
-                stats_df.at[day_analyzed, f'CDR sea ice area within {thresh:.2f}'] = cdr_area
-
-        except Exception as exc:
-            if args.verbose:
-                print(f"Could not run {day_analyzed}; {exc}")
+    # Make sure our save path exists
+    pathlib.Path(os.path.dirname(out_path)).mkdir(parents=True, exist_ok=True)
 
+    # Availability is looked up once, so each gap is only reported once
+    input_folders = {'cdr': cdr_input_folder, 'nic': nic_input_folder}
+    has_grid = {product: days.isin(_available_days(days, product, input_folders[product], args.hemisphere))
+                for product in STATS_INPUTS}
+
+    if not args.update:
+        stats_df = _stats_table(days, cdr_input_folder, nic_input_folder, has_grid['cdr'], has_grid['nic'],
+                                threshold_range, upper_threshold, args)
+        if args.verbose:
+            print(stats_df)
+        _save_stats(out_path, stats_df, threshold_range, upper_threshold)
+        return
+
+    write_times = np.stack([dwn.grid_write_times(days, product, input_folders[product], args.hemisphere)
+                            for product in STATS_INPUTS], axis=-1)
+    saved = checkpoint.load_checkpoint(out_path, threshold_range, STATS_INPUTS)
+
+    has_grids = has_grid['cdr'] & has_grid['nic']
+    stale = has_grids if saved is None else has_grids & saved.stale(days, write_times)
+    instrument.count('stats days up to date', int(np.count_nonzero(has_grids & ~stale)))
+    print(f"Updating stats for {np.count_nonzero(stale)} of {len(days)} days in {out_path}")
+    if not stale.any():
+        return
+
+    stats_df = _stats_table(days[stale], cdr_input_folder, nic_input_folder, has_grid['cdr'][stale],
+                            has_grid['nic'][stale], threshold_range, upper_threshold, args)
     if args.verbose:
         print(stats_df)
+    _save_stats(out_path, stats_df, threshold_range, upper_threshold, saved=saved)
 
-    out_path = os.path.join(csv_out_path, f"stats_{int(100*args.thresh_lower)}_to_{int(100*args.thresh_upper)}_sic.csv")
+    if saved is None:
+        saved = checkpoint.new_checkpoint(threshold_range, STATS_INPUTS)
+    checkpoint.save_checkpoint(out_path, saved.updated(days[stale], write_times[stale]))
+
+
+def _save_stats(out_path, stats_df, threshold_range, upper_threshold, saved=None):
+    """
+    Save stats as a wide csv, or as a long Parquet or Feather table, depending on the extension of out_path.
+    :param out_path: string - .csv, .parquet or .feather file
+    :param stats_df: pandas DataFrame - see _stats_table
+    :param threshold_range: np array - lower thresholds
+    :param upper_threshold: float - upper threshold shared by all lower thresholds
+    :param saved: checkpoint.Checkpoint - the days already saved to out_path, which are kept unless stats_df
+        recalculated them.  The file is overwritten if None.
+    :return:
+    """
+    if not out_path.endswith('.csv'):
+        # Columnar files can't be appended to, so updates rewrite them - which is still quick since they're compact
+        long_df = areas.long_table(stats_df, threshold_range, upper_threshold)
+        if saved is None:
+            areas.write_stats(out_path, long_df)
+        else:
+            areas.merge_stats(out_path, long_df)
+        return
+
+    if saved is not None and stats_df.index[0] > saved.last_day:
+        # The usual daily update - only days after the last one in the csv, so they're appended
+        stats_df.to_csv(out_path, mode='a', header=False)
+        return
+
+    # Days were filled in or recalculated within the csv, or it's starting over, so it's rewritten once
+    if saved is not None:
+        saved_df = pd.read_csv(out_path, index_col=0, parse_dates=True, keep_default_na=False,
+                               na_values={column: [''] for column in stats_df.columns if column != 'error'})
+        stats_df = pd.concat([saved_df.drop(stats_df.index, errors='ignore'), stats_df]).sort_index()
+    tmp_path = out_path + '.tmp'
+    stats_df.to_csv(tmp_path)
+    os.replace(tmp_path, out_path)
+
+
+def create_regional_stats(days, args):
+    """
+    Calculate the same areas as create_stats for every ocean region and save them with a row per day, region, product
+    and threshold, as a csv or a Parquet or Feather table (see args.stats_format).  Regions are labelled once on the CDR
+    grid (see the regions module), so each day costs one bincount per product however many regions there are.
+    :param days: A pandas datetime series for the days to analyze
+    :param args: argparse args (see help)
+    :return:
+    """
+    hemi_folder = HEMISPHERE_FOLDERS[args.hemisphere]
+    nic_input_folder = INPUT_FOLDER_FMT.format(hemisphere=hemi_folder, product='nic')
+    cdr_input_folder = INPUT_FOLDER_FMT.format(hemisphere=hemi_folder, product='cdr')
+
+    stats_out_path = STATS_FOLDER_FMTS[args.stats_format].format(hemisphere=hemi_folder, product='combined')
+    threshold_range = np.arange(args.thresh_lower, args.thresh_upper, args.thresh_interval)
+    out_path = os.path.join(stats_out_path, f"regional_stats_{int(100*args.thresh_lower)}_to_"
+                                            f"{int(100*args.thresh_upper)}_sic.{args.stats_format}")
+
+    # 1 since we're calculating the difference between this threshold and 100% SIC
+    upper_threshold = 1.0
+
+    names, labels = regions.region_labels(cdr_input_folder, args.hemisphere, args.lats, args.lons, args.meta,
+                                          region_file=args.region_file, name_column=args.region_name_column)
+    dates, region_areas = regions.calculate_region_area_range(days[0], days[-1], cdr_input_folder, nic_input_folder,
+                                                              args.hemisphere, labels, len(names), threshold_range,
+                                                              upper_threshold, threshold_range, upper_threshold)
+    instrument.count('regional stats days calculated', len(dates))
+    if len(dates) < len(days):
+        print(f"No regional stats for {len(days) - len(dates)} of {len(days)} days missing a grid; "
+              f"{availability.describe_gaps(days.difference(dates))}")
+
+    regional_df = regions.long_table(dates, names, region_areas, threshold_range, upper_threshold)
+    if args.verbose:
+        print(regional_df)
 
-    # Make sure our save path exists
     pathlib.Path(os.path.dirname(out_path)).mkdir(parents=True, exist_ok=True)
-    stats_df.to_csv(out_path)
+    if args.stats_format == 'csv':
+        regional_df.to_csv(out_path, index=False)
+    else:
+        areas.write_stats(out_path, regional_df)
+
+
+def _stats_table(days, cdr_input_folder, nic_input_folder, has_cdr, has_nic, threshold_range, upper_threshold, args):
+    """
+    Calculate the NIC and CDR areas within each threshold for the days provided from the daily histogram summary (see
+    the summary module), so no grids are read for days that are already summarized.  Missing or out of date histograms
+    are built first in a pool of args.jobs workers.  Days that could not be computed keep empty areas and record why in
+    the 'error' column.
+    :param days: A pandas datetime series for the days to analyze
+    :param cdr_input_folder: string - folder holding the CDR grids
+    :param nic_input_folder: string - folder holding the NIC grids
+    :param has_cdr: np bool array - which days have a CDR grid (see _available_days)
+    :param has_nic: np bool array - which days have an NIC grid
+    :param threshold_range: np array - lower thresholds
+    :param upper_threshold: float - upper threshold shared by all lower thresholds
+    :param args: argparse args (see help)
+    :return: pandas DataFrame indexed by day
+    """
+    # areas[day index, threshold index, product index] - product index 0 is NIC, 1 is CDR
+    stats_start = time.perf_counter()
+    backend = 'loky' if args.pool == 'process' else 'threading'
+    areas, errors = summary.calculate_ice_areas(days, cdr_input_folder, nic_input_folder, args.hemisphere,
+                                                threshold_range, upper_threshold, threshold_range, upper_threshold,
+                                                n_jobs=args.jobs, backend=backend, verbose=args.verbose)
+
+    # Days without both grids are recorded as errors
+    errors[~has_cdr] = 'no cdr grid'
+    errors[~has_nic & has_cdr] = 'no nic grid'
+    errors[~has_nic & ~has_cdr] = 'no cdr or nic grid'
+
+    both_grids = has_cdr & has_nic
+    failed = both_grids & np.isnan(areas).any(axis=(1, 2))
+    errors[failed & (errors == '')] = "couldn't summarize grids"
+    instrument.count('stats days missing grids', int(np.count_nonzero(~both_grids)))
+    instrument.count('stats days calculated', int(np.count_nonzero(both_grids & ~failed)))
+    instrument.count('stats days failed', int(np.count_nonzero(failed)))
+    if args.verbose:
+        for day, error in zip(days[failed], errors[failed]):
+            print(f"Could not run {day}; {error}")
+        print(f"Calculated stats for {np.count_nonzero(both_grids & ~failed)} days in "
+              f"{time.perf_counter() - stats_start:.1f}s")
+
+    columns = [f'{product} sea ice area within {thresh:.2f}' for thresh in threshold_range for product in ['NIC', 'CDR']]
+    stats_df = pd.DataFrame(areas.reshape(len(days), -1), index=days, columns=columns)
+    stats_df['error'] = errors
+    return stats_df
+
+
+def _available_days(days, product, input_folder, hemisphere):
+    """
+    Get the days that have a grid for a product from its availability index, printing any missing days up front.
+    :param days: A pandas datetime series for the days to check
+    :param product: string - 'cdr' or 'nic'
+    :param input_folder: string - product input folder
+    :param hemisphere: string - 'south' or 'north'
+    :return: pandas DatetimeIndex - the days with a grid
+    """
+    if days.empty:
+        return days
+    availability_func = dwn.available_cdr_dates if product == 'cdr' else dwn.available_nic_dates
+    available = days.intersection(availability_func(days[0], days[-1], input_folder, hemisphere))
+    gaps = days.difference(available)
+    if not gaps.empty:
+        print(f"No {product} grids for {len(gaps)} of {len(days)} days; {availability.describe_gaps(gaps)}")
+    return available
 
 
 def create_animation(args):
@@ -187,7 +528,71 @@ def create_animation(args):
     :param args: argparse args (see help)
     :return:
     """
-    display.images_to_animation(args.animation, os.path.join(args.animation, "animation.mp4"))
+    display.images_to_animation(args.animation, os.path.join(args.animation, "animation.mp4"), fps=args.fps,
+                                width=args.animation_width)
+
+
+def create_daily_animation(days, args):
+    """
+    Render the combined daily plots as the frames of an animation, streaming each frame straight to ffmpeg.
+    :param days: The days to animate (pandas datetime series)
+    :param args: argparse args (see help)
+    :return:
+    """
+    hemi_folder = HEMISPHERE_FOLDERS[args.hemisphere]
+    nic_input_folder = INPUT_FOLDER_FMT.format(hemisphere=hemi_folder, product='nic')
+    cdr_input_folder = INPUT_FOLDER_FMT.format(hemisphere=hemi_folder, product='cdr')
+
+    output_name = os.path.join(OUTPUT_MP4_FOLDER_FMT.format(hemisphere=hemi_folder, product='combined'),
+                               f"daily_extent_{args.cdr_plotting_thresh}_{args.nic_plotting_thresh}_"
+                               f"for_{days[0]:%Y%m%d}_to_{days[-1]:%Y%m%d}.mp4")
+
+    plot_days = _available_days(days, 'cdr', cdr_input_folder, args.hemisphere).intersection(
+        _available_days(days, 'nic', nic_input_folder, args.hemisphere))
+
+    # Frames are only ever drawn in memory
+    display.use_agg_backend()
+    renderer = display.get_renderer(args.lats, args.lons, args.meta)
+
+    writer = display.FfmpegWriter(output_name, fps=args.fps, width=args.animation_width)
+    try:
+        for day in plot_days:
+            try:
+                frame = renderer.frame(f"US NIC and NSIDC Marginal Ice Zone\n{day:%Y-%m-%d}",
+                                       _combined_grids(day, args, cdr_input_folder, nic_input_folder),
+                                       width=args.animation_width)
+            except Exception as exc:
+                print(f"Could not generate animation frame for {day:%Y%m%d} because {exc}")
+                continue
+            writer.write(frame)
+            instrument.count('animation frames')
+    finally:
+        writer.close()
+
+    # ffmpeg is only started by the first frame, so no video is left behind if none could be rendered
+    if writer.frames:
+        print(f"Wrote {writer.frames} frames to {output_name}")
+    else:
+        print(f"No animation written for {days[0]:%Y%m%d} to {days[-1]:%Y%m%d} because no frames could be rendered")
+
+
+def _combined_grids(day, args, cdr_input_folder, nic_input_folder):
+    """
+    Get the grids for a day's combined plot - the extent of each product at its plotting threshold.
+    :param day: datetime - day to plot
+    :param args: argparse args (see help)
+    :param cdr_input_folder: string - folder holding the CDR grids
+    :param nic_input_folder: string - folder holding the NIC grids
+    :return: list of grid dictionaries - see display.create_basemap_plot
+    """
+    cdr_grid = dwn.get_cdr(day, cdr_input_folder, args.hemisphere)
+    nic_grid = dwn.get_nic(day, nic_input_folder, args.hemisphere)
+
+    cdr_mask = compare.threshold_mask(cdr_grid, args.cdr_plotting_thresh)
+    nic_mask = compare.threshold_mask(nic_grid, args.nic_plotting_thresh)
+
+    return [{'grid': nic_mask, 'color': 'magenta', 'legend_label': 'NIC Extent'},
+            {'grid': cdr_mask, 'color': 'cyan', 'legend_label': 'CDR Extent'}]
 
 
 def create_daily_plots_combined(days, args):
@@ -197,33 +602,48 @@ def create_daily_plots_combined(days, args):
     :param args: argparse args (see help)
     :return:
     """
-    for day in days:
-        try:
-            nic_input_folder = INPUT_FOLDER_FMT.format(hemisphere=hemi_folder, product='nic')
-            cdr_input_folder = INPUT_FOLDER_FMT.format(hemisphere=hemi_folder, product='cdr')
+    hemi_folder = HEMISPHERE_FOLDERS[args.hemisphere]
+    nic_input_folder = INPUT_FOLDER_FMT.format(hemisphere=hemi_folder, product='nic')
+    cdr_input_folder = INPUT_FOLDER_FMT.format(hemisphere=hemi_folder, product='cdr')
+
+    output_folder = OUTPUT_PNG_FOLDER_FMT.format(hemisphere=hemi_folder, product='combined')
 
-            output_folder = OUTPUT_PNG_FOLDER_FMT.format(hemisphere=hemi_folder, product='combined')
+    plot_days = _available_days(days, 'cdr', cdr_input_folder, args.hemisphere).intersection(
+        _available_days(days, 'nic', nic_input_folder, args.hemisphere))
 
-            cdr_grid = dwn.get_cdr(day, cdr_input_folder, args.hemisphere)
-            nic_grid = dwn.get_nic(day, nic_input_folder, args.hemisphere)
+    _render_days(_render_combined_days, 'render combined plot', plot_days, args, cdr_input_folder, nic_input_folder,
+                 output_folder)
 
-            cdr_mask = np.where(cdr_grid >= args.cdr_plotting_thresh, True, False)
-            nic_mask = np.where(nic_grid >= args.nic_plotting_thresh, True, False)
 
+def _render_combined_days(days, args, cdr_input_folder, nic_input_folder, output_folder):
+    """
+    Render the combined daily plots for a chunk of days.
+    :param days: The days to plot (pandas datetime series)
+    :param args: argparse args (see help)
+    :param cdr_input_folder: string - folder holding the CDR grids
+    :param nic_input_folder: string - folder holding the NIC grids
+    :param output_folder: string - folder to save plots to
+    :return: dict - seconds spent on each day that was plotted, keyed by day
+    """
+    # The basemap is built once and reused for every plot
+    renderer = display.get_renderer(args.lats, args.lons, args.meta)
+
+    timings = {}
+    for day in days:
+        day_start = time.perf_counter()
+        try:
             output_name = os.path.join(output_folder,
-                                    f"daily_extent_{args.cdr_plotting_thresh}_{args.nic_plotting_thresh}_"
-                                    f"for_{day:%Y%m%d}.png")
-
-            display.create_basemap_plot(f"US NIC and NSIDC Marginal Ice Zone\n{day:%Y-%m-%d}",
-                                        args.lats,
-                                        args.lons,
-                                        args.meta,
-                                        [{'grid': nic_mask, 'color': 'magenta', 'legend_label': 'NIC Extent'},
-                                        {'grid': cdr_mask, 'color': 'cyan', 'legend_label': 'CDR Extent'}],
-                                        show=False,
-                                        save=output_name)
+                                       f"daily_extent_{args.cdr_plotting_thresh}_{args.nic_plotting_thresh}_"
+                                       f"for_{day:%Y%m%d}.png")
+
+            renderer.plot(f"US NIC and NSIDC Marginal Ice Zone\n{day:%Y-%m-%d}",
+                          _combined_grids(day, args, cdr_input_folder, nic_input_folder),
+                          show=False,
+                          save=output_name)
+            timings[day] = time.perf_counter() - day_start
         except Exception as exc:
             print(f"Could not generate combined plot for {day:%Y%m%d} because {exc}")
+    return timings
 
 
 def create_daily_plots(days, args):
@@ -233,49 +653,99 @@ def create_daily_plots(days, args):
     :param args: argparse args (see help)
     :return:
     """
+    hemi_folder = HEMISPHERE_FOLDERS[args.hemisphere]
+    for product, selected in (('cdr', args.plot_cdr), ('nic', args.plot_nic)):
+        if not selected:
+            continue
+        input_folder = INPUT_FOLDER_FMT.format(hemisphere=hemi_folder, product=product)
+        output_folder = OUTPUT_PNG_FOLDER_FMT.format(hemisphere=hemi_folder, product=product)
+        plot_days = _available_days(days, product, input_folder, args.hemisphere)
+        _render_days(_render_product_days, f'render {product} plot', plot_days, args, product, input_folder,
+                     output_folder)
+
+
+def _render_product_days(days, args, product, input_folder, output_folder):
+    """
+    Render a single product's daily plots for a chunk of days.
+    :param days: The days to plot (pandas datetime series)
+    :param args: argparse args (see help)
+    :param product: string - 'cdr' or 'nic'
+    :param input_folder: string - folder holding the product grids
+    :param output_folder: string - folder to save plots to
+    :return: dict - seconds spent on each day that was plotted, keyed by day
+    """
+    retrieval_func = dwn.get_cdr if product == 'cdr' else dwn.get_nic
+    thresh = args.cdr_plotting_thresh if product == 'cdr' else args.nic_plotting_thresh
+    title, color, legend_label = DAILY_PLOT_STYLES[product]
+
+    # The basemap is built once and reused for every plot
+    renderer = display.get_renderer(args.lats, args.lons, args.meta)
+
+    timings = {}
     for day in days:
+        day_start = time.perf_counter()
         try:
-            if args.plot_cdr:
-                cdr_input_folder = INPUT_FOLDER_FMT.format(hemisphere=hemi_folder, product='cdr')
-                output_folder = OUTPUT_PNG_FOLDER_FMT.format(hemisphere=hemi_folder, product='cdr')
-
-                cdr_grid = dwn.get_cdr(day, cdr_input_folder, args.hemisphere)
-
-                cdr_mask = np.where(cdr_grid >= args.cdr_plotting_thresh, True, False)
-
-                display.create_basemap_plot(f"Sea Ice Concentration Climate Data Record (CDR)\n{day:%Y-%m-%d}",
-                                            args.lats,
-                                            args.lons,
-                                            args.meta,
-                                            [{'grid': cdr_mask, 'color': 'cyan', 'legend_label': 'CDR Extent'}],
-                                            show=False,
-                                            save=os.path.join(output_folder,
-                                                            f"daily_extent_{day:%Y%m%d}_"
-                                                            f"{int(100*args.cdr_plotting_thresh)}_percent_thresh.png"))
+            mask = compare.threshold_mask(retrieval_func(day, input_folder, args.hemisphere), thresh)
+
+            renderer.plot(f"{title}\n{day:%Y-%m-%d}",
+                          [{'grid': mask, 'color': color, 'legend_label': legend_label}],
+                          show=False,
+                          save=os.path.join(output_folder,
+                                            f"daily_extent_{day:%Y%m%d}_{int(100*thresh)}_percent_thresh.png"))
+            timings[day] = time.perf_counter() - day_start
         except Exception as exc:
-            print(f"Could not generate plot for {day:%Y%m%d} for cdr because {exc}")
+            print(f"Could not generate plot for {day:%Y%m%d} for {product} because {exc}")
+    return timings
 
-        try:
-            if args.plot_nic:
-                nic_input_folder = INPUT_FOLDER_FMT.format(hemisphere=hemi_folder, product='nic')
 
-                output_folder = OUTPUT_PNG_FOLDER_FMT.format(hemisphere=hemi_folder, product='nic')
+def _render_days(render_func, label, days, args, *render_args):
+    """
+    Render plots for days with render_func, either in this process or split into chunks over a pool of processes
+    (--render-jobs).  Each worker renders with the Agg backend and keeps its own basemap between chunks.
+    :param render_func: Function called with a chunk of days, args and render_args, returning the seconds spent on each
+        day it plotted
+    :param label: string - name the days are timed under (see the profile option)
+    :param days: The days to plot (pandas datetime series)
+    :param args: argparse args (see help)
+    :param render_args: extra arguments for render_func
+    :return:
+    """
+    if args.render_jobs == 1 or len(days) <= 1:
+        _record_renders(label, [render_func(days, args, *render_args)])
+        return
 
-                nic_grid = dwn.get_nic(day, nic_input_folder, args.hemisphere)
+    # The netCDF projection variable can't be sent to other processes, so workers get a plain copy of its attributes
+    render_args_ns = argparse.Namespace(**vars(args))
+    render_args_ns.meta = dwn.projection_params(args.meta)
 
-                nic_mask = np.where(nic_grid >= args.nic_plotting_thresh, True, False)
+    n_chunks = min(len(days), effective_n_jobs(args.render_jobs) * RENDER_CHUNKS_PER_WORKER)
+    chunks = [days[chunk] for chunk in np.array_split(np.arange(len(days)), n_chunks)]
+    chunk_timings = Parallel(n_jobs=args.render_jobs, backend='loky')(delayed(_render_worker)
+                                                                      (render_func, chunk, render_args_ns, *render_args)
+                                                                      for chunk in chunks)
+    _record_renders(label, chunk_timings)
 
-                display.create_basemap_plot(f"US National Ice Center Marginal Ice Zone\n{day:%Y-%m-%d}",
-                                            args.lats,
-                                            args.lons,
-                                            args.meta,
-                                            [{'grid': nic_mask, 'color': 'magenta', 'legend_label': 'NIC Extent'}],
-                                            show=False,
-                                            save=os.path.join(output_folder,
-                                                            f"daily_extent_{day:%Y%m%d}_"
-                                                            f"{int(100*args.nic_plotting_thresh)}_percent_thresh.png"))
-        except Exception as exc:
-            print(f"Could not generate plot for {day:%Y%m%d} for nic because {exc}")
+
+def _render_worker(render_func, days, args, *render_args):
+    """
+    Render a chunk of days in a pool process with the non-interactive Agg backend.
+    :return: dict - seconds spent on each day that was plotted, keyed by day
+    """
+    display.use_agg_backend()
+    return render_func(days, args, *render_args)
+
+
+def _record_renders(label, chunk_timings):
+    """
+    Record the days rendered by each chunk - workers may be other processes, so this happens in the parent.
+    :param label: string - name the days are timed under
+    :param chunk_timings: list of dicts of seconds spent on each day, keyed by day
+    :return:
+    """
+    for timings in chunk_timings:
+        for day, seconds in timings.items():
+            instrument.record_day(label, day, seconds)
+        instrument.count('plots rendered', len(timings))
 
 
 def create_median_plot(args):
@@ -285,6 +755,7 @@ def create_median_plot(args):
     :param args:  argparse args (see help)
     :return:
     """
+    hemi_folder = HEMISPHERE_FOLDERS[args.hemisphere]
     nic_input_folder = INPUT_FOLDER_FMT.format(hemisphere=hemi_folder, product='nic')
     cdr_input_folder = INPUT_FOLDER_FMT.format(hemisphere=hemi_folder, product='cdr')
     output_folder = OUTPUT_PNG_FOLDER_FMT.format(hemisphere=hemi_folder, product='combined')
@@ -295,13 +766,21 @@ def create_median_plot(args):
     start_rounded_up = args.start + last_day_of_month_offset
     end_rounded_down = args.end.replace(day=1)
 
+    # The basemap is built once and reused for every plot
+    renderer = display.get_renderer(args.lats, args.lons, args.meta)
+
     for median_start_date in pd.date_range(start=start_rounded_up, end=end_rounded_down, freq=freq):
         median_end_date = median_start_date + last_day_of_month_offset
 
-        cdr_median_threshold_grid = compare.median_cdr(args.cdr_plotting_thresh, median_start_date, median_end_date,
-                                                       cdr_input_folder, args.hemisphere)
-        nic_median_threshold_grid = compare.median_nic(args.nic_plotting_thresh, median_start_date, median_end_date,
-                                                       nic_input_folder, args.hemisphere)
+        # Monthly composites are saved between runs - only days added since the last run are read
+        cdr_median_threshold_grid = composite.monthly_median('cdr', args.cdr_plotting_thresh, median_start_date,
+                                                             cdr_input_folder, args.hemisphere, verbose=args.verbose)
+        nic_median_threshold_grid = composite.monthly_median('nic', args.nic_plotting_thresh, median_start_date,
+                                                             nic_input_folder, args.hemisphere, verbose=args.verbose)
+
+        if cdr_median_threshold_grid is None or nic_median_threshold_grid is None:
+            print(f"Could not generate median plot for {median_start_date:%Y-%m} because no days are available")
+            continue
 
         # Let's only set the pixels on the boundary to True
         cdr_diff_arr = (np.diff(cdr_median_threshold_grid, axis=0, prepend=False) | np.diff(
@@ -313,17 +792,159 @@ def create_median_plot(args):
                                    f"monthy_median_{args.cdr_plotting_thresh}_{args.nic_plotting_thresh}_"
                                    f"for_{median_start_date:%Y%m%d}_to_{median_end_date:%Y%m%d}.png")
 
-        display.create_basemap_plot(f'Monthly Median Sea Ice Extent - {median_start_date:%b, %Y}\n'
-                                    f'Thresholds; NIC={int(100 * args.nic_plotting_thresh)}%, '
-                                    f'CDR={int(100 * args.cdr_plotting_thresh)}%',
-                                    args.lats,
-                                    args.lons,
-                                    args.meta,
-                                    [{'grid': cdr_diff_arr, 'color': 'cyan', 'legend_label': 'CDR Extent'},
-                                     {'grid': nic_diff_arr, 'color': 'magenta', 'legend_label': 'NIC Extent'}],
-                                    show=False,
-                                    legend=True,
-                                    save=output_name)
+        renderer.plot(f'Monthly Median Sea Ice Extent - {median_start_date:%b, %Y}\n'
+                      f'Thresholds; NIC={int(100 * args.nic_plotting_thresh)}%, '
+                      f'CDR={int(100 * args.cdr_plotting_thresh)}%',
+                      [{'grid': cdr_diff_arr, 'color': 'cyan', 'legend_label': 'CDR Extent'},
+                       {'grid': nic_diff_arr, 'color': 'magenta', 'legend_label': 'NIC Extent'}],
+                      show=False,
+                      legend=True,
+                      save=output_name)
+        instrument.count('plots rendered')
+
+
+def create_rolling_composites(days, args):
+    """
+    Create rolling composites of how often each product was at or above its plotting threshold over a trailing window
+    for each day.  The frequencies for both products are exported to one npz file and, optionally, the days where a
+    pixel was present for at least the rolling percentage of the window are plotted.  Frequencies are written out a day
+    at a time as they're calculated, so memory doesn't grow with the number of days.
+    :param days: The days to create composites for (pandas datetime series)
+    :param args: argparse args (see help)
+    :return:
+    """
+    hemi_folder = HEMISPHERE_FOLDERS[args.hemisphere]
+    nic_input_folder = INPUT_FOLDER_FMT.format(hemisphere=hemi_folder, product='nic')
+    cdr_input_folder = INPUT_FOLDER_FMT.format(hemisphere=hemi_folder, product='cdr')
+    npz_output_folder = OUTPUT_NPZ_FOLDER_FMT.format(hemisphere=hemi_folder, product='combined')
+    png_output_folder = OUTPUT_PNG_FOLDER_FMT.format(hemisphere=hemi_folder, product='combined')
+
+    try:
+        dates, cdr_counts, cdr_frames = composite.rolling_frequency('cdr', args.cdr_plotting_thresh, days[0], days[-1],
+                                                                    args.rolling_window, cdr_input_folder,
+                                                                    args.hemisphere, verbose=args.verbose)
+        _, nic_counts, nic_frames = composite.rolling_frequency('nic', args.nic_plotting_thresh, days[0], days[-1],
+                                                                args.rolling_window, nic_input_folder,
+                                                                args.hemisphere, verbose=args.verbose)
+    except ValueError as exc:
+        print(f"Could not generate rolling composites; {exc}")
+        return
+
+    out_path = os.path.join(npz_output_folder,
+                            f"rolling_{args.rolling_window}_day_{args.cdr_plotting_thresh}_{args.nic_plotting_thresh}_"
+                            f"for_{days[0]:%Y%m%d}_to_{days[-1]:%Y%m%d}.npz")
+    pathlib.Path(npz_output_folder).mkdir(parents=True, exist_ok=True)
+
+    # Each day's frequencies go straight to a memory-mapped .npy per product, which is zipped into the npz at the end
+    frequency_paths = {product: f'{out_path}.{product}_frequency.{os.getpid()}.tmp.npy' for product in ('cdr', 'nic')}
+    frequencies = {}
+
+    # The basemap is built once and reused for every plot
+    renderer = display.get_renderer(args.lats, args.lons, args.meta) if args.rolling_plots else None
+
+    for day_idx, (day, cdr_frequency, nic_frequency) in enumerate(zip(dates, cdr_frames, nic_frames)):
+        for product, frequency in (('cdr', cdr_frequency), ('nic', nic_frequency)):
+            if product not in frequencies:
+                frequencies[product] = np.lib.format.open_memmap(frequency_paths[product], mode='w+',
+                                                                 dtype=np.float32,
+                                                                 shape=(len(dates),) + frequency.shape)
+            frequencies[product][day_idx] = frequency
+
+        if renderer is None:
+            continue
+        if not (cdr_counts[day_idx] and nic_counts[day_idx]):
+            print(f"Could not generate rolling plot for {day:%Y%m%d} because no days are available in the window")
+            continue
+
+        cdr_mask = cdr_frequency >= args.rolling_percent
+        nic_mask = nic_frequency >= args.rolling_percent
+
+        output_name = os.path.join(png_output_folder,
+                                   f"rolling_{args.rolling_window}_day_{args.cdr_plotting_thresh}_"
+                                   f"{args.nic_plotting_thresh}_for_{day:%Y%m%d}.png")
+
+        renderer.plot(f'{args.rolling_window}-Day Sea Ice Extent Present '
+                      f'{int(100 * args.rolling_percent)}% of the Time - {day:%Y-%m-%d}\n'
+                      f'Thresholds; NIC={int(100 * args.nic_plotting_thresh)}%, '
+                      f'CDR={int(100 * args.cdr_plotting_thresh)}%',
+                      [{'grid': nic_mask, 'color': 'magenta', 'legend_label': 'NIC Extent'},
+                       {'grid': cdr_mask, 'color': 'cyan', 'legend_label': 'CDR Extent'}],
+                      show=False,
+                      save=output_name)
+        instrument.count('plots rendered')
+
+    for frequency in frequencies.values():
+        frequency.flush()
+    frequencies.clear()
+
+    tmp_path = f'{out_path}.{os.getpid()}.tmp'
+    with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as npz_file:
+        for name, array in (('dates', dates.strftime('%Y%m%d').to_numpy(dtype=str)), ('cdr_days', cdr_counts),
+                            ('nic_days', nic_counts)):
+            with npz_file.open(f'{name}.npy', 'w', force_zip64=True) as member:
+                np.lib.format.write_array(member, np.asarray(array), allow_pickle=False)
+        for product, frequency_path in frequency_paths.items():
+            npz_file.write(frequency_path, f'{product}_frequency.npy')
+            os.remove(frequency_path)
+    os.replace(tmp_path, out_path)
+
+
+def create_footprint_agreement(days, args):
+    """
+    Compare the NIC and CDR footprints at the plotting thresholds over the days provided.  The daily area in each
+    footprint class and the agreement of the footprints are saved to a csv, the days each pixel spent in each class to
+    an npz file and, optionally, how often each pixel was NIC only and CDR only are plotted.
+    :param days: The days to compare (pandas datetime series)
+    :param args: argparse args (see help)
+    :return:
+    """
+    hemi_folder = HEMISPHERE_FOLDERS[args.hemisphere]
+    nic_input_folder = INPUT_FOLDER_FMT.format(hemisphere=hemi_folder, product='nic')
+    cdr_input_folder = INPUT_FOLDER_FMT.format(hemisphere=hemi_folder, product='cdr')
+    csv_output_folder = OUTPUT_CSV_FOLDER_FMT.format(hemisphere=hemi_folder, product='combined')
+    npz_output_folder = OUTPUT_NPZ_FOLDER_FMT.format(hemisphere=hemi_folder, product='combined')
+    png_output_folder = OUTPUT_PNG_FOLDER_FMT.format(hemisphere=hemi_folder, product='combined')
+
+    # 1 since the footprint is all ice at or above the plotting threshold
+    upper_threshold = 1.0
+
+    try:
+        dates, day_counts, pixel_days = agreement.accumulate_agreement(days[0], days[-1], cdr_input_folder,
+                                                                       nic_input_folder, args.hemisphere,
+                                                                       args.cdr_plotting_thresh, upper_threshold,
+                                                                       args.nic_plotting_thresh, upper_threshold,
+                                                                       verbose=args.verbose)
+    except ValueError as exc:
+        print(f"Could not compare footprints; {exc}")
+        return
+
+    out_name = (f"footprint_{args.cdr_plotting_thresh}_{args.nic_plotting_thresh}_"
+                f"for_{days[0]:%Y%m%d}_to_{days[-1]:%Y%m%d}")
+
+    agreement_df = agreement.agreement_table(dates, day_counts)
+    if args.verbose:
+        print(agreement_df)
+    pathlib.Path(csv_output_folder).mkdir(parents=True, exist_ok=True)
+    agreement_df.to_csv(os.path.join(csv_output_folder, f"{out_name}.csv"))
+
+    agreement.save_agreement(os.path.join(npz_output_folder, f"{out_name}.npz"), dates, day_counts, pixel_days)
+
+    if not args.footprint_plots:
+        return
+
+    renderer = display.get_renderer(args.lats, args.lons, args.meta)
+    for footprint_class, label, cmap in [(compare.FOOTPRINT_NIC_ONLY, 'NIC Only', 'RdPu'),
+                                         (compare.FOOTPRINT_CDR_ONLY, 'CDR Only', 'GnBu')]:
+        renderer.plot(f'Sea Ice Extent {label} - {days[0]:%Y-%m-%d} to {days[-1]:%Y-%m-%d}\n'
+                      f'Thresholds; NIC={int(100 * args.nic_plotting_thresh)}%, '
+                      f'CDR={int(100 * args.cdr_plotting_thresh)}%',
+                      [{'grid': agreement.class_frequency(pixel_days, footprint_class), 'cmap': cmap,
+                        'colorbar_label': f'Fraction of Days {label}'}],
+                      show=False,
+                      legend=False,
+                      save=os.path.join(png_output_folder,
+                                        f"{out_name}_{label.lower().replace(' ', '_')}.png"))
+        instrument.count('plots rendered')
 
 
 if __name__ == '__main__':
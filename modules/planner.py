@@ -0,0 +1,157 @@
+'''
+A module that materializes only the inputs the requested outputs need.
+
+Each output declares the artifacts it requires - CDR grids, NIC grids or the CDR metadata (latitudes, longitudes and
+projection) - and the days it needs them for.  Before an output runs, the planner looks up which of those days are
+missing from the availability indexes and only downloads and converts those days, with CDR and NIC materialized
+concurrently.  Outputs that need little (eg an animation of existing pngs, or CDR plots alone) start right away, and
+outputs that need everything only pay for what earlier runs haven't already done.
+'''
+
+import threading
+
+from joblib import Parallel, delayed
+import pandas as pd
+
+from . import download as dwn
+from . import instrument
+
+CDR_GRIDS = 'cdr grids'
+NIC_GRIDS = 'nic grids'
+METADATA = 'metadata'
+
+# When no CDR file has been downloaded yet, metadata is read from the first file found downloading this many days at a
+# time
+METADATA_PROBE_DAYS = 7
+
+
+class Planner:
+    """
+    Materializes artifacts for the requested days on demand.  Each artifact is only checked once per range of days.
+    """
+
+    def __init__(self, cdr_folder, nic_folder, hemisphere, download_jobs=4, rasterize_jobs=-1, rasterize_pool='thread',
+                 download_executor=None, verbose=False):
+        """
+        :param cdr_folder: string - CDR input folder
+        :param nic_folder: string - NIC input folder
+        :param hemisphere: string - 'south' or 'north'
+        :param download_jobs: int - maximum number of files downloaded at once
+        :param rasterize_jobs: int - number of workers rasterizing NIC shapefiles, -1 for one per CPU
+        :param rasterize_pool: string - 'thread' or 'process' NIC rasterization workers
+        :param download_executor: concurrent.futures.Executor - runs downloads, eg shared with another hemisphere's
+            planner.  Each download gets its own pool of download_jobs workers if None.
+        :param verbose: bool - increase verbosity
+        """
+        self.cdr_folder = cdr_folder
+        self.nic_folder = nic_folder
+        self.hemisphere = hemisphere
+        self.download_jobs = download_jobs
+        self.rasterize_jobs = rasterize_jobs
+        self.rasterize_pool = rasterize_pool
+        self.download_executor = download_executor
+        self.verbose = verbose
+
+        self._metadata = None
+        self._materialized = set()
+        self._lock = threading.RLock()
+
+    def require(self, artifacts, start, end):
+        """
+        Make sure artifacts are materialized for every day from start to end (inclusive).  Grids are only fetched and
+        converted for days that don't have one yet.
+        :param artifacts: iterable of CDR_GRIDS, NIC_GRIDS and METADATA
+        :param start: datetime - first day needed
+        :param end: datetime - last day needed
+        :return:
+        """
+        start = pd.Timestamp(start).normalize()
+        end = pd.Timestamp(end).normalize()
+        grids = [artifact for artifact in (CDR_GRIDS, NIC_GRIDS)
+                 if artifact in artifacts and (artifact, start, end) not in self._materialized]
+
+        # Rasterizing NIC needs the CDR metadata, so read it before CDR files are fetched alongside NIC files
+        if METADATA in artifacts or (NIC_GRIDS in grids and not self.missing_days(NIC_GRIDS, start, end).empty):
+            self.metadata(start, end)
+
+        Parallel(n_jobs=max(len(grids), 1), backend='threading')(delayed(self._materialize_grids)(artifact, start, end)
+                                                                 for artifact in grids)
+        self._materialized.update((artifact, start, end) for artifact in grids)
+
+    def missing_days(self, artifact, start, end):
+        """
+        Get the days from start to end (inclusive) without a grid.
+        :param artifact: string - CDR_GRIDS or NIC_GRIDS
+        :param start: datetime - first day
+        :param end: datetime - last day
+        :return: pandas DatetimeIndex
+        """
+        folder = self.cdr_folder if artifact == CDR_GRIDS else self.nic_folder
+        availability_func = dwn.available_cdr_dates if artifact == CDR_GRIDS else dwn.available_nic_dates
+        return pd.date_range(start=start, end=end).difference(availability_func(start, end, folder, self.hemisphere))
+
+    def _materialize_grids(self, artifact, start, end):
+        """
+        Fold legacy per-day .npy grids from start to end (inclusive) into the cube and fetch and convert the days that
+        don't have a grid yet.  Both store each grid's histogram as it's written (see the summary module).
+        """
+        product = 'cdr' if artifact == CDR_GRIDS else 'nic'
+        folder = self.cdr_folder if artifact == CDR_GRIDS else self.nic_folder
+
+        # Per-day .npy grids count as available, so fold them into the cube first or range reads would skip them
+        with instrument.stage(f'import {product} npy', hemisphere=self.hemisphere):
+            dwn.import_legacy_grids(start, end, folder, product, self.hemisphere, verbose=self.verbose)
+
+        missing = self.missing_days(artifact, start, end)
+        instrument.count(f'{product} days already materialized', (end - start).days + 1 - len(missing))
+        if missing.empty:
+            return
+        if self.verbose:
+            print(f"Materializing {len(missing)} {product} days between {missing[0]:%Y%m%d} and {missing[-1]:%Y%m%d}")
+
+        if artifact == CDR_GRIDS:
+            with instrument.stage('download cdr', hemisphere=self.hemisphere):
+                dwn.download_cdr_miz_range(missing[0], missing[-1], self.cdr_folder, hemisphere=self.hemisphere,
+                                           verbose=self.verbose, n_jobs=self.download_jobs, dates=missing,
+                                           executor=self.download_executor)
+            with instrument.stage('convert cdr', hemisphere=self.hemisphere):
+                dwn.cdr_to_np(missing[0], missing[-1], self.cdr_folder, hemisphere=self.hemisphere,
+                              verbose=self.verbose)
+        else:
+            with instrument.stage('download nic', hemisphere=self.hemisphere):
+                dwn.download_nic_miz_range(missing[0], missing[-1], self.nic_folder, hemisphere=self.hemisphere,
+                                           verbose=self.verbose, n_jobs=self.download_jobs, dates=missing,
+                                           executor=self.download_executor)
+            lats, _, meta = self.metadata(start, end)
+            print("Rasterizing numpy array data range - this may take a while if this hasn't already been done...")
+            with instrument.stage('rasterize nic', hemisphere=self.hemisphere):
+                dwn.nic_to_np(missing[0], missing[-1], self.nic_folder, meta, lats.shape, hemisphere=self.hemisphere,
+                              verbose=self.verbose, n_jobs=self.rasterize_jobs, pool=self.rasterize_pool)
+
+    def metadata(self, start, end):
+        """
+        Get the CDR latitudes, longitudes and projection from the hemisphere's metadata cache (see
+        download.cdr_metadata).  If the cache can't be built because no CDR file has been downloaded yet, CDR files
+        between start and end are downloaded a few days at a time until there is one.
+        :param start: datetime - first day
+        :param end: datetime - last day
+        :return: (lats, lons, projection parameters) - see download.get_cdr_metadata
+        """
+        with self._lock:
+            if self._metadata is not None:
+                return self._metadata
+
+            with instrument.stage('read cdr metadata', hemisphere=self.hemisphere):
+                days = pd.date_range(start=start, end=end)
+                probes = [days[first:first + METADATA_PROBE_DAYS] for first in range(0, len(days), METADATA_PROBE_DAYS)]
+                while self._metadata is None:
+                    try:
+                        self._metadata = dwn.cdr_metadata(self.cdr_folder, self.hemisphere, verbose=self.verbose)
+                    except FileNotFoundError:
+                        if not probes:
+                            raise
+                        probe = probes.pop(0)
+                        dwn.download_cdr_miz_range(probe[0], probe[-1], self.cdr_folder, hemisphere=self.hemisphere,
+                                                   verbose=self.verbose, n_jobs=self.download_jobs,
+                                                   executor=self.download_executor)
+            return self._metadata
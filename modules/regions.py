@@ -0,0 +1,280 @@
+'''
+A module that breaks sea ice areas down by ocean region.
+
+Regions are rasterized once onto the CDR grid into an integer label array - 0 for cells outside of every region
+(OTHER_REGION), n for the nth region - and the labels are cached in the CDR input folder, keyed by a digest of the
+region definitions and the grid.  A day's areas for every region and threshold then come from a single bincount over
+label x concentration bin per product, read through the cumulative histograms (see compare.areas_from_histogram), rather
+than a masked pass over the grid per region.  Every cell has exactly one label, so the regions' areas, other included,
+add up to the hemisphere's.
+
+The built-in regions are bounded by longitude and latitude.  The Antarctic regions are the usual longitude sectors of
+the Southern Ocean.  The Arctic regions are boxes approximating the seas of the usual Arctic regional breakdown, so
+cells near their borders may be labelled differently than with the exact boundaries - pass a polygon file (anything
+geopandas reads, with a column naming each polygon's region) to use exact or custom boundaries instead.
+'''
+
+import hashlib
+import json
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio.features
+
+from . import areas
+from . import compare
+from . import download as dwn
+from . import encoding
+from . import instrument
+
+# Region labels are cached per hemisphere and region definition in the CDR input folder
+LABEL_FOLDER = '.regions'
+LABEL_FNAME_FMT = '{hemisphere}_{digest}_labels.npz'
+
+# The region of cells outside of every defined region - always label 0
+OTHER_REGION = 'Other'
+
+# (name, west longitude, east longitude, south latitude, north latitude) in degrees east and north.  Longitude ranges
+# run eastward from west to east, so ranges crossing the antimeridian have west > east.  Latitudes of None don't bound
+# the region.  A cell belongs to the first region containing it.
+SOUTH_REGIONS = (
+    ('Weddell Sea', -60, 20, None, None),
+    ('Indian Ocean', 20, 90, None, None),
+    ('Western Pacific Ocean', 90, 160, None, None),
+    ('Ross Sea', 160, -130, None, None),
+    ('Amundsen-Bellingshausen Seas', -130, -60, None, None),
+)
+NORTH_REGIONS = (
+    ('Sea of Okhotsk', 135, 157, 42, 63),
+    ('Bering Sea', 157, -155, 50, 66),
+    ('Gulf of St. Lawrence', -70, -55, 43, 52),
+    ('Canadian Archipelago', -130, -80, 70, 84),
+    ('Hudson Bay', -95, -65, 50, 70),
+    ('Baffin Bay/Labrador Sea', -80, -45, 50, 84),
+    ('Greenland Sea', -45, 20, 60, 84),
+    ('Kara and Barents Seas', 20, 90, 60, 84),
+    ('Arctic Ocean', -180, 180, 66, None),
+)
+BUILTIN_REGIONS = {'south': SOUTH_REGIONS, 'north': NORTH_REGIONS}
+
+
+def box_labels(lats, lons, regions):
+    """
+    Label every grid cell with the first longitude/latitude box containing it.
+    :param lats: np array - latitude of each cell
+    :param lons: np array - longitude of each cell, in degrees east
+    :param regions: sequence of (name, west, east, south, north) - see SOUTH_REGIONS
+    :return: np uint8 array - 0 outside of every region, otherwise 1 + the index of the region
+    """
+    lons = np.mod(np.asarray(lons, dtype=float) + 180, 360) - 180
+    labels = np.zeros(np.shape(lats), dtype=np.uint8)
+    for label, (_, west, east, south, north) in reversed(list(enumerate(regions, start=1))):
+        if west < east:
+            inside = (lons >= west) & (lons < east)
+        else:
+            inside = (lons >= west) | (lons < east)
+        if south is not None:
+            inside &= lats >= south
+        if north is not None:
+            inside &= lats < north
+        labels[inside] = label
+    return labels
+
+
+def polygon_labels(region_file, name_column, cdr_meta, shape):
+    """
+    Rasterize region polygons onto the CDR grid.  Polygons sharing a name are one region.
+    :param region_file: string - polygon file readable by geopandas, eg a shapefile or GeoJSON
+    :param name_column: string - column holding each polygon's region name
+    :param cdr_meta: CDR projection information - the netCDF projection variable or projection_params output
+    :param shape: tuple of ints - shape of the CDR grid
+    :return: (tuple of region names in label order, np uint8 array - 0 outside of every region, otherwise 1 + the index
+        of the region's name).  Where polygons overlap, the first region in the file wins.
+    """
+    gdf = gpd.read_file(region_file)[[name_column, 'geometry']].to_crs(cdr_meta.proj4text)
+    names = tuple(pd.unique(gdf[name_column].astype(str)))
+    label_of = {name: label for label, name in enumerate(names, start=1)}
+
+    # Later shapes are burned over earlier ones, so burn the file backwards
+    shapes = [(geom, label_of[str(name)]) for geom, name in zip(gdf.geometry[::-1], gdf[name_column][::-1])]
+    labels = rasterio.features.rasterize(shapes=shapes,
+                                         transform=dwn.cdr_grid_transform(cdr_meta),
+                                         fill=0,
+                                         out_shape=shape,
+                                         dtype=np.uint8)
+    return names, labels
+
+
+def _definition_digest(hemisphere, cdr_meta, shape, region_file, name_column):
+    """
+    Get a short digest of everything the labels depend on - the region definitions and the grid.
+    """
+    if region_file is None:
+        regions = BUILTIN_REGIONS[hemisphere]
+    else:
+        regions = [dwn.file_digest(region_file), name_column]
+    definition = json.dumps([regions, cdr_meta.proj4text, cdr_meta.GeoTransform, list(shape)])
+    return hashlib.sha1(definition.encode()).hexdigest()[:20]
+
+
+def region_labels(cdr_input_folder, hemisphere, lats, lons, cdr_meta, region_file=None, name_column='name'):
+    """
+    Get the region label of every CDR grid cell, rasterizing the regions only if they haven't been cached for this grid.
+    :param cdr_input_folder: string - CDR input folder holding the cache
+    :param hemisphere: string - 'south' or 'north'
+    :param lats: np array - latitude of each CDR cell
+    :param lons: np array - longitude of each CDR cell
+    :param cdr_meta: CDR projection information - see download.cdr_metadata
+    :param region_file: string - polygon file to use instead of the hemisphere's built-in regions (see polygon_labels)
+    :param name_column: string - specific to region_file, the column holding each polygon's region name
+    :return: (tuple of region names in label order, starting with OTHER_REGION, np uint8 array of labels)
+    """
+    dwn.check_hemisphere(hemisphere)
+    digest = _definition_digest(hemisphere, cdr_meta, np.shape(lats), region_file, name_column)
+    cache_path = os.path.join(cdr_input_folder, LABEL_FOLDER, LABEL_FNAME_FMT.format(hemisphere=hemisphere,
+                                                                                     digest=digest))
+    if os.path.exists(cache_path):
+        instrument.count('region labels read from cache')
+        with np.load(cache_path) as cached:
+            return tuple(str(name) for name in cached['names']), cached['labels']
+
+    if region_file is None:
+        regions = BUILTIN_REGIONS[hemisphere]
+        names, labels = tuple(region[0] for region in regions), box_labels(lats, lons, regions)
+    else:
+        names, labels = polygon_labels(region_file, name_column, cdr_meta, np.shape(lats))
+    names = (OTHER_REGION,) + names
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp.npz'
+    np.savez(tmp_path, names=np.array(names), labels=labels)
+    os.replace(tmp_path, cache_path)
+    instrument.count('region labels rasterized')
+    return names, labels
+
+
+def region_histograms(grid, labels, region_count, valid=None):
+    """
+    Count the grid cells in each 1% sea ice concentration bin of every region with a single bincount, by offsetting
+    each region's codes into its own block of bins.  See compare.concentration_histogram.
+    :param grid: np array - percent codes or fractional sea ice concentration
+    :param labels: np integer array - region label of each cell, less than region_count.  Same shape as grid.
+    :param region_count: int - number of regions, other included
+    :param valid: np bool array - optional, only count cells where this is True.  Same shape as grid.
+    :return: np int array (region_count, CONCENTRATION_BINS)
+    """
+    if encoding.is_encoded(grid):
+        codes = np.asarray(grid).astype(np.intp)
+    else:
+        codes = np.rint(np.asarray(grid) * 100).astype(np.intp)
+
+    # Out of range codes would spill into the next region's bins.  CDR codes are never negative.
+    keep = None
+    if np.asarray(grid).dtype != encoding.CDR_DTYPE or codes.max(initial=0) >= compare.CONCENTRATION_BINS:
+        keep = (codes >= 0) & (codes < compare.CONCENTRATION_BINS)
+    if valid is not None:
+        keep = valid if keep is None else keep & valid
+
+    binned = labels.astype(np.intp) * compare.CONCENTRATION_BINS + codes
+    binned = binned.ravel() if keep is None else binned[keep]
+    return np.bincount(binned, minlength=region_count * compare.CONCENTRATION_BINS).reshape(
+        region_count, compare.CONCENTRATION_BINS)
+
+
+def calculate_region_areas(cdr_grid, nic_grid, labels, region_count, min_sic_nic, max_sic_nic, min_sic_cdr,
+                           max_sic_cdr):
+    """
+    Calculate the ice area between many pairs of thresholds in every region at once.  Same as
+    compare.calculate_ice_areas within each region.
+    :param cdr_grid: np array - cdr data, percent codes or fractional
+    :param nic_grid: np array - nic data, percent codes or fractional - same shape as cdr_grid
+    :param labels: np integer array - region label of each cell - see region_labels
+    :param region_count: int - number of regions, other included
+    :param min_sic_nic: float or np array - 0 to 1 - fractional percentage SIC lower threshold(s) for nic data
+    :param max_sic_nic: float or np array - 0 to 1 - fractional percentage SIC upper threshold(s) for nic data
+    :param min_sic_cdr: float or np array - 0 to 1 - fractional percentage SIC lower threshold(s) for cdr data
+    :param max_sic_cdr: float or np array - 0 to 1 - fractional percentage SIC upper threshold(s) for cdr data
+    :return: np array (regions, thresholds, 2) - areas, with the last axis ordered as compare.AREA_PRODUCTS
+    """
+    min_sic_nic, max_sic_nic, min_sic_cdr, max_sic_cdr = (np.atleast_1d(thresh) for thresh in np.broadcast_arrays(
+        min_sic_nic, max_sic_nic, min_sic_cdr, max_sic_cdr))
+
+    # We need lower thresholds that are less than upper thresholds
+    assert np.all(min_sic_nic <= max_sic_nic)
+    assert np.all(min_sic_cdr <= max_sic_cdr)
+
+    # Encoded CDR grids can't hold negative values, so only float grids need a validity mask for the NIC
+    valid = None if np.asarray(cdr_grid).dtype == encoding.CDR_DTYPE else np.asarray(cdr_grid) >= 0
+    histograms = {'cdr': region_histograms(cdr_grid, labels, region_count),
+                  'nic': region_histograms(nic_grid, labels, region_count, valid=valid)}
+    thresholds = {'nic': (min_sic_nic, max_sic_nic), 'cdr': (min_sic_cdr, max_sic_cdr)}
+    return np.stack([compare.areas_from_histogram(histograms[product], *thresholds[product])
+                     for product in compare.AREA_PRODUCTS], axis=-1)
+
+
+def calculate_region_area_range(start, end, cdr_folder, nic_folder, hemisphere, labels, region_count, min_sic_nic,
+                                max_sic_nic, min_sic_cdr, max_sic_cdr):
+    """
+    Calculate the ice area between many pairs of thresholds in every region for every day from start to end
+    (inclusive) that has both grids, read straight from the CDR and NIC grid cubes (or from legacy per-day .npy grids
+    for days that aren't in them).  See calculate_region_areas.
+    :param start: datetime - first day
+    :param end: datetime - last day
+    :param cdr_folder: string - folder holding the CDR grid cube
+    :param nic_folder: string - folder holding the NIC grid cube
+    :param hemisphere: string - 'south' or 'north'
+    :param labels: np integer array - region label of each cell - see region_labels
+    :param region_count: int - number of regions, other included
+    :param min_sic_nic: float or np array - 0 to 1 - fractional percentage SIC lower threshold(s) for nic data
+    :param max_sic_nic: float or np array - 0 to 1 - fractional percentage SIC upper threshold(s) for nic data
+    :param min_sic_cdr: float or np array - 0 to 1 - fractional percentage SIC lower threshold(s) for cdr data
+    :param max_sic_cdr: float or np array - 0 to 1 - fractional percentage SIC upper threshold(s) for cdr data
+    :return: (
+        pandas DatetimeIndex of the days calculated,
+        np array (days, regions, thresholds, 2) - areas ordered as compare.AREA_PRODUCTS
+    )
+    """
+    cdr_dates, cdr_stack, cdr_valid = dwn.get_cdr_range(start, end, cdr_folder, hemisphere)
+    nic_dates, nic_stack, nic_valid = dwn.get_nic_range(start, end, nic_folder, hemisphere)
+
+    # Both cubes are clipped to their own extents - only the days both hold can be compared.  Days only stored as
+    # legacy per-day .npy grids aren't in the cubes, so they're loaded one at a time.
+    dates = cdr_dates[cdr_valid].intersection(nic_dates[nic_valid])
+    dates = dates.union(dwn.legacy_grid_pair_dates(start, end, cdr_folder, nic_folder, hemisphere))
+    thresholds = np.broadcast(min_sic_nic, max_sic_nic, min_sic_cdr, max_sic_cdr).size
+    region_areas = np.zeros((len(dates), region_count, thresholds, len(compare.AREA_PRODUCTS)), dtype=np.int64)
+    for day_index, (cdr_index, nic_index) in enumerate(zip(cdr_dates.get_indexer(dates),
+                                                           nic_dates.get_indexer(dates))):
+        day = dates[day_index]
+        in_cubes = cdr_index >= 0 and nic_index >= 0 and cdr_valid[cdr_index] and nic_valid[nic_index]
+        with instrument.day_timer('regional stats', day):
+            cdr_grid = cdr_stack[cdr_index] if in_cubes else dwn.get_cdr(day, cdr_folder, hemisphere)
+            nic_grid = nic_stack[nic_index] if in_cubes else dwn.get_nic(day, nic_folder, hemisphere)
+            region_areas[day_index] = calculate_region_areas(cdr_grid, nic_grid, labels, region_count, min_sic_nic,
+                                                             max_sic_nic, min_sic_cdr, max_sic_cdr)
+    return dates, region_areas
+
+
+def long_table(dates, names, region_areas, threshold_range, upper_threshold):
+    """
+    Convert regional areas to one row per day, region, product and threshold, in the layout of the areas module with
+    a region column.
+    :param dates: pandas DatetimeIndex - days calculated
+    :param names: tuple of region names in label order
+    :param region_areas: np array (days, regions, thresholds, 2) - see calculate_region_area_range
+    :param threshold_range: np array - lower thresholds
+    :param upper_threshold: float - upper threshold shared by all lower thresholds
+    :return: pandas DataFrame with date, region, product, lower, upper and area columns, sorted by date
+    """
+    products = len(compare.AREA_PRODUCTS)
+    rows_per_region = len(threshold_range) * products
+    return pd.DataFrame({
+        'date': np.repeat(dates.values, len(names) * rows_per_region),
+        'region': np.tile(np.repeat(np.array(names, dtype=object), rows_per_region), len(dates)),
+        'product': np.tile(np.array(compare.AREA_PRODUCTS), len(dates) * len(names) * len(threshold_range)),
+        'lower': np.tile(np.repeat(np.round(threshold_range, areas.BOUND_DECIMALS), products), len(dates) * len(names)),
+        'upper': round(upper_threshold, areas.BOUND_DECIMALS),
+        'area': region_areas.reshape(-1),
+    })
@@ -0,0 +1,195 @@
+'''
+A module that keeps a materialized summary of the daily grids, so area statistics can be answered without reading them.
+
+Each day's summary is its concentration histogram - the number of cells in each 1% sea ice concentration bin (see
+compare.concentration_histogram).  Histograms are kept in a (time, CONCENTRATION_BINS) GridCube per product, next to
+the product's grid cube, and are stored as each grid is converted (see download.store_histograms).  The area between
+any pair of thresholds on any day is then a lookup into the day's cumulative histogram, so a stats run over the whole
+record reads a few hundred bytes per day instead of every grid.
+
+A histogram is out of date when its day's grid was written after it (see download.grid_write_times).  Histograms that
+are missing or out of date, eg for grids converted before histograms were stored, are rebuilt from the grids the next
+time they're read.
+'''
+
+import time
+
+from joblib import Parallel, delayed
+import numpy as np
+import pandas as pd
+
+from . import compare
+from . import download as dwn
+from . import instrument
+
+# Days whose histograms are built together, from a single stack of their grids
+BUILD_CHUNK_DAYS = 64
+
+
+def _stored_histograms(histograms, days):
+    """
+    Read the stored histograms of days.
+    :return: (np download.HISTOGRAM_DTYPE array (days, CONCENTRATION_BINS) with zeros for missing days, np bool array of
+        which days have a histogram)
+    """
+    stored = np.zeros((len(days), compare.CONCENTRATION_BINS), dtype=dwn.HISTOGRAM_DTYPE)
+    has_histogram = np.zeros(len(days), dtype=bool)
+    if not histograms.exists or days.empty:
+        return stored, has_histogram
+    dates, view, valid = histograms.get_range(days.min(), days.max())
+    positions = dates.get_indexer(days)
+    inside = positions >= 0
+    has_histogram[inside] = valid[positions[inside]]
+    stored[has_histogram] = view[positions[has_histogram]]
+    return stored, has_histogram
+
+
+def stale_days(days, folder, product, hemisphere):
+    """
+    Find the days with a grid whose histogram is missing or was built before the grid was last written.
+    :param days: pandas DatetimeIndex - days to check
+    :param folder: string - product input folder
+    :param product: string - 'cdr' or 'nic'
+    :param hemisphere: string - 'south' or 'north'
+    :return: pandas DatetimeIndex
+    """
+    if days.empty:
+        return days
+    availability_func = dwn.available_cdr_dates if product == 'cdr' else dwn.available_nic_dates
+    has_grid = days.isin(availability_func(days.min(), days.max(), folder, hemisphere))
+    histograms = dwn.histogram_cube(folder, product, hemisphere)
+    _, has_histogram = _stored_histograms(histograms, days)
+    outdated = histograms.written_at(days) < dwn.grid_write_times(days, product, folder, hemisphere)
+    return days[has_grid & (~has_histogram | outdated)]
+
+
+def _build_chunk(days, folder, product, hemisphere):
+    """
+    Count the histograms of a chunk of days from their grids with one bincount.  Runs in a worker, so failures are
+    returned rather than raised - if any grid can't be read, the chunk is counted a day at a time to keep the rest.
+    :return: (days built, np array (days built, CONCENTRATION_BINS), dict of error strings keyed by the days that
+        failed)
+    """
+    get_func = dwn.get_cdr if product == 'cdr' else dwn.get_nic
+    try:
+        grids = np.stack([get_func(day, folder, hemisphere) for day in days])
+        return days, compare.stack_histograms(grids).astype(dwn.HISTOGRAM_DTYPE), {}
+    except Exception:
+        pass
+
+    built, histograms, errors = [], [], {}
+    for day in days:
+        try:
+            histograms.append(compare.concentration_histogram(get_func(day, folder, hemisphere)))
+            built.append(day)
+        except Exception as exc:
+            errors[day] = str(exc)
+    histograms = np.array(histograms, dtype=dwn.HISTOGRAM_DTYPE).reshape(-1, compare.CONCENTRATION_BINS)
+    return pd.DatetimeIndex(built), histograms, errors
+
+
+def update_histograms(days, folder, product, hemisphere, n_jobs=1, backend='threading', verbose=False):
+    """
+    Build the histograms of the days that have a grid but no up to date histogram.
+    :param days: pandas DatetimeIndex - days to summarize
+    :param folder: string - product input folder
+    :param product: string - 'cdr' or 'nic'
+    :param hemisphere: string - 'south' or 'north'
+    :param n_jobs: int - number of workers building chunks of days, -1 for one per CPU
+    :param backend: string - joblib backend of the workers, eg 'threading' or 'loky'
+    :param verbose: bool - increase verbosity
+    :return: (int - number of histograms built, dict of error strings keyed by the days that couldn't be built)
+    """
+    dwn.check_hemisphere(hemisphere)
+    stale = stale_days(days, folder, product, hemisphere)
+    instrument.count(f'{product} histograms already built', len(days) - len(stale))
+    if stale.empty:
+        return 0, {}
+
+    build_start = time.perf_counter()
+    chunks = [stale[first:first + BUILD_CHUNK_DAYS] for first in range(0, len(stale), BUILD_CHUNK_DAYS)]
+    results = Parallel(n_jobs=n_jobs, backend=backend)(delayed(_build_chunk)(chunk, folder, product, hemisphere)
+                                                       for chunk in chunks)
+
+    histograms = {}
+    errors = {}
+    for built_days, chunk_histograms, chunk_errors in results:
+        errors.update(chunk_errors)
+        if verbose:
+            for day, error in chunk_errors.items():
+                print(f"Couldn't summarize the {product} grid for {day:%Y%m%d}; {error}")
+        histograms.update(zip(built_days, chunk_histograms))
+    dwn.store_histograms(folder, product, hemisphere, histograms)
+
+    if verbose:
+        print(f"Built {len(histograms)} of {len(stale)} {product} histograms in "
+              f"{time.perf_counter() - build_start:.1f}s")
+    return len(histograms), errors
+
+
+def daily_histograms(days, folder, product, hemisphere, n_jobs=1, backend='threading', verbose=False):
+    """
+    Get the histogram of every day, building any that are missing or out of date first.
+    :param days: pandas DatetimeIndex - days to read
+    :param folder: string - product input folder
+    :param product: string - 'cdr' or 'nic'
+    :param hemisphere: string - 'south' or 'north'
+    :param n_jobs: int - see update_histograms
+    :param backend: string - see update_histograms
+    :param verbose: bool - increase verbosity
+    :return: (np array (days, CONCENTRATION_BINS) with zeros for days without a grid, np bool array of which days have
+        a histogram, dict of error strings keyed by the days whose histograms couldn't be built)
+    """
+    _, errors = update_histograms(days, folder, product, hemisphere, n_jobs=n_jobs, backend=backend, verbose=verbose)
+    stored, has_histogram = _stored_histograms(dwn.histogram_cube(folder, product, hemisphere), days)
+    return stored, has_histogram, errors
+
+
+def calculate_ice_areas(days, cdr_folder, nic_folder, hemisphere, min_sic_nic, max_sic_nic, min_sic_cdr, max_sic_cdr,
+                        n_jobs=1, backend='threading', verbose=False):
+    """
+    Calculate the total ice area between many pairs of thresholds on each day from the daily histograms, without
+    reading any grids once they're summarized.  Same as compare.calculate_ice_areas for each day.
+    :param days: pandas DatetimeIndex - days to calculate, eg pd.date_range(start, end)
+    :param cdr_folder: string - CDR input folder
+    :param nic_folder: string - NIC input folder
+    :param hemisphere: string - 'south' or 'north'
+    :param min_sic_nic: float or np array - 0 to 1 - fractional percentage SIC lower threshold(s) for nic data
+    :param max_sic_nic: float or np array - 0 to 1 - fractional percentage SIC upper threshold(s) for nic data
+    :param min_sic_cdr: float or np array - 0 to 1 - fractional percentage SIC lower threshold(s) for cdr data
+    :param max_sic_cdr: float or np array - 0 to 1 - fractional percentage SIC upper threshold(s) for cdr data
+    :param n_jobs: int - see update_histograms
+    :param backend: string - see update_histograms
+    :param verbose: bool - increase verbosity
+    :return: (
+        np float array (days, thresholds, 2) - areas ordered as compare.AREA_PRODUCTS, NaN for days missing either
+            histogram,
+        np object array of strings - why each day's histograms couldn't be built, '' for days that were built or have
+            no grid
+    )
+    """
+    days = pd.DatetimeIndex(days)
+    min_sic_nic, max_sic_nic, min_sic_cdr, max_sic_cdr = (np.atleast_1d(thresh) for thresh in np.broadcast_arrays(
+        min_sic_nic, max_sic_nic, min_sic_cdr, max_sic_cdr))
+
+    # We need lower thresholds that are less than upper thresholds
+    assert np.all(min_sic_nic <= max_sic_nic)
+    assert np.all(min_sic_cdr <= max_sic_cdr)
+
+    folders = {'cdr': cdr_folder, 'nic': nic_folder}
+    thresholds = {'nic': (min_sic_nic, max_sic_nic), 'cdr': (min_sic_cdr, max_sic_cdr)}
+    areas = np.full((len(days), len(min_sic_nic), len(compare.AREA_PRODUCTS)), np.nan)
+    histograms = {product: daily_histograms(days, folders[product], product, hemisphere, n_jobs=n_jobs,
+                                            backend=backend, verbose=verbose)
+                  for product in compare.AREA_PRODUCTS}
+
+    errors = np.full(len(days), '', dtype=object)
+    for product in compare.AREA_PRODUCTS:
+        for day, error in histograms[product][2].items():
+            errors[days.get_loc(day)] = f"couldn't summarize {product} grid; {error}"
+
+    both = histograms['cdr'][1] & histograms['nic'][1]
+    for product_index, product in enumerate(compare.AREA_PRODUCTS):
+        areas[both, :, product_index] = compare.areas_from_histogram(histograms[product][0][both],
+                                                                     *thresholds[product])
+    return areas, errors
@@ -0,0 +1,260 @@
+'''
+A module that downloads many files concurrently from FTP or HTTP servers.
+
+FTP control connections are kept open and reused for every file in the same host directory.  Each file is downloaded to
+a ".part" file next to its destination, resumed from where it left off if a transfer fails, and renamed into place only
+once complete.  ftp://, http:// and https:// URLs are supported, including explicit ports and credentials, so a local
+stand-in server can be used in place of the NSIDC archive.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import ftplib
+import os
+import posixpath
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+PART_SUFFIX = '.part'
+BLOCK_SIZE = 1024 * 1024
+
+
+class PermanentTransferError(Exception):
+    """
+    A transfer failed in a way retrying won't fix (eg the file doesn't exist on the server).
+    """
+
+
+class FtpConnectionPool:
+    """
+    Idle FTP control connections keyed by (host, port, user, directory).  A connection is checked out for one transfer
+    at a time, then returned so the next file in the same directory doesn't pay for a new login and cwd.
+    """
+
+    def __init__(self, timeout=60):
+        """
+        :param timeout: float - socket timeout in seconds for new connections
+        """
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, parsed_url):
+        """
+        Check out a connection logged in and sitting in the URL's directory, reusing an idle one if possible.
+        :param parsed_url: urllib.parse.ParseResult - ftp:// URL of the file to transfer
+        :return: (key to release the connection with, ftplib.FTP)
+        """
+        key = (parsed_url.hostname, parsed_url.port or ftplib.FTP_PORT, parsed_url.username,
+               posixpath.dirname(parsed_url.path))
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return key, idle.pop()
+
+        conn = ftplib.FTP(timeout=self.timeout)
+        conn.connect(key[0], key[1])
+        conn.login(urllib.parse.unquote(parsed_url.username or 'anonymous'),
+                   urllib.parse.unquote(parsed_url.password or ''))
+        if key[3]:
+            conn.cwd(urllib.parse.unquote(key[3]))
+        return key, conn
+
+    def release(self, key, conn):
+        """
+        Return a healthy connection to the pool.
+        :param key: key returned by acquire
+        :param conn: ftplib.FTP
+        :return:
+        """
+        with self._lock:
+            self._idle.setdefault(key, []).append(conn)
+
+    @staticmethod
+    def discard(conn):
+        """
+        Close a connection that may be in a bad state instead of returning it to the pool.
+        :param conn: ftplib.FTP
+        :return:
+        """
+        try:
+            conn.close()
+        except OSError:
+            pass
+
+    def close_all(self):
+        """
+        Close every idle connection.
+        :return:
+        """
+        with self._lock:
+            conns = [conn for idle in self._idle.values() for conn in idle]
+            self._idle = {}
+        for conn in conns:
+            try:
+                conn.quit()
+            except (OSError, EOFError, ftplib.Error):
+                self.discard(conn)
+
+
+def _fetch_ftp(parsed_url, part_path, offset, ftp_pool):
+    """
+    Download (the rest of) an FTP file, appending to the part file from offset.
+    :return: int - bytes transferred
+    """
+    key, conn = ftp_pool.acquire(parsed_url)
+    transferred = [0]
+    try:
+        with open(part_path, 'ab') as part_file:
+            part_file.truncate(offset)
+
+            def write_block(block):
+                part_file.write(block)
+                transferred[0] += len(block)
+
+            name = urllib.parse.unquote(posixpath.basename(parsed_url.path))
+            conn.retrbinary(f'RETR {name}', write_block, blocksize=BLOCK_SIZE, rest=offset or None)
+    except ftplib.error_perm as exc:
+        # 5xx replies (eg 550 no such file) - the connection itself is still fine
+        ftp_pool.release(key, conn)
+        raise PermanentTransferError(str(exc)) from exc
+    except BaseException:
+        ftp_pool.discard(conn)
+        raise
+    ftp_pool.release(key, conn)
+    return transferred[0]
+
+
+def _fetch_http(url, part_path, offset, timeout):
+    """
+    Download (the rest of) an HTTP file, appending to the part file from offset when the server honors the range.
+    :return: int - bytes transferred
+    """
+    request = urllib.request.Request(url)
+    if offset:
+        request.add_header('Range', f'bytes={offset}-')
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as exc:
+        if 400 <= exc.code < 500 and exc.code not in (408, 429):
+            raise PermanentTransferError(str(exc)) from exc
+        raise
+
+    transferred = 0
+    with response, open(part_path, 'ab') as part_file:
+        # A 200 means the server ignored the range and is sending the whole file
+        part_file.truncate(offset if response.status == 206 else 0)
+        while True:
+            block = response.read(BLOCK_SIZE)
+            if not block:
+                break
+            part_file.write(block)
+            transferred += len(block)
+    return transferred
+
+
+def fetch(url, local_path, ftp_pool, retries=3, backoff=1.0, timeout=60):
+    """
+    Download a single file to local_path through a part file, resuming after failed attempts with exponential backoff.
+    :param url: string - ftp://, http:// or https:// URL
+    :param local_path: string - destination path.  Only created once the download is complete.
+    :param ftp_pool: FtpConnectionPool - connections to reuse for ftp:// URLs
+    :param retries: int - number of retries after the first attempt
+    :param backoff: float - seconds to wait before the first retry, doubled for each retry after it
+    :param timeout: float - socket timeout in seconds for HTTP requests
+    :return: int - bytes transferred
+    """
+    parsed_url = urllib.parse.urlparse(url)
+    part_path = local_path + PART_SUFFIX
+    transferred = 0
+
+    for attempt in range(retries + 1):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        try:
+            if parsed_url.scheme == 'ftp':
+                transferred += _fetch_ftp(parsed_url, part_path, offset, ftp_pool)
+            elif parsed_url.scheme in ('http', 'https'):
+                transferred += _fetch_http(url, part_path, offset, timeout)
+            else:
+                raise PermanentTransferError(f"Unsupported URL scheme {parsed_url.scheme} for {url}")
+            os.replace(part_path, local_path)
+            return transferred
+        except PermanentTransferError:
+            # Don't leave empty part files behind for files that don't exist
+            if os.path.exists(part_path) and not os.path.getsize(part_path):
+                os.remove(part_path)
+            raise
+        except (OSError, EOFError, ftplib.Error):
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+    return transferred
+
+
+def download_many(transfers, n_jobs=4, retries=3, backoff=1.0, timeout=60, verbose=False, executor=None):
+    """
+    Download many files concurrently with a bounded pool of workers sharing FTP connections.
+    :param transfers: list of (url, local_path) tuples
+    :param n_jobs: int - maximum number of concurrent transfers
+    :param retries: int - number of retries per file after the first attempt
+    :param backoff: float - seconds to wait before the first retry of a file, doubled for each retry after it
+    :param timeout: float - socket timeout in seconds
+    :param verbose: bool - increase verbosity
+    :param executor: concurrent.futures.Executor - runs the transfers instead of a new pool of n_jobs workers, so
+        downloads running at the same time (eg for both hemispheres) can share one bound on concurrent transfers
+    :return: dict - {
+            'files': number of files downloaded,
+            'failed': {url: reason} for files that couldn't be downloaded,
+            'bytes': bytes transferred,
+            'seconds': wall time,
+            'throughput': bytes per second
+        }
+    """
+    ftp_pool = FtpConnectionPool(timeout=timeout)
+    summary = {'files': 0, 'failed': {}, 'bytes': 0}
+    summary_lock = threading.Lock()
+
+    def run(url, local_path):
+        if verbose:
+            print(f"Downloading {url}")
+        try:
+            transferred = fetch(url, local_path, ftp_pool, retries=retries, backoff=backoff, timeout=timeout)
+        except (PermanentTransferError, OSError, EOFError, ftplib.Error) as exc:
+            if verbose:
+                print(f"Could not download {url} to {local_path}; {exc}")
+            with summary_lock:
+                summary['failed'][url] = str(exc)
+            return
+        with summary_lock:
+            summary['files'] += 1
+            summary['bytes'] += transferred
+
+    wall_start = time.perf_counter()
+    pool = executor if executor is not None else ThreadPoolExecutor(max_workers=max(1, n_jobs))
+    try:
+        for future in [pool.submit(run, url, local_path) for url, local_path in transfers]:
+            future.result()
+    finally:
+        if executor is None:
+            pool.shutdown()
+        ftp_pool.close_all()
+
+    summary['seconds'] = time.perf_counter() - wall_start
+    summary['throughput'] = summary['bytes'] / summary['seconds'] if summary['seconds'] else 0.0
+
+    if verbose:
+        print(format_summary(summary))
+
+    return summary
+
+
+def format_summary(summary):
+    """
+    Format a download_many summary as a one-line report.
+    :param summary: dict returned by download_many
+    :return: string
+    """
+    return (f"Downloaded {summary['files']} files ({summary['bytes'] / 1e6:.1f} MB) in {summary['seconds']:.1f}s - "
+            f"{summary['throughput'] / 1e6:.2f} MB/s, {len(summary['failed'])} failed")